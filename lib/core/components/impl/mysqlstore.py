@@ -17,6 +17,9 @@ class MySQLInventoryStore(InventoryStore):
 
         self._mysql = MySQL(config.db_params)
 
+        # Fill tables in save_data and clone_from with LOAD DATA LOCAL INFILE (requires local_infile in db_params)
+        self.bulk_load = config.get('bulk_load', False)
+
     def close(self):
         self._mysql.close()
 
@@ -29,7 +32,7 @@ class MySQLInventoryStore(InventoryStore):
         return True
 
     def new_handle(self): #override
-        config = Configuration(db_params = self._mysql.config())
+        config = Configuration(db_params = self._mysql.config(), bulk_load = self.bulk_load)
         return MySQLInventoryStore(config)
 
     def get_partitions(self, conditions): #override
@@ -154,6 +157,18 @@ class MySQLInventoryStore(InventoryStore):
 
         return files
 
+    def get_file_ids(self, blocks): #override
+        result = dict((block, set()) for block in blocks)
+        block_map = dict((block.id, block) for block in blocks if block.id != 0)
+
+        if len(block_map) == 0:
+            return result
+
+        for block_id, file_id in self._mysql.select_many('files', ('block_id', 'id'), 'block_id', block_map.keys()):
+            result[block_map[block_id]].add(file_id)
+
+        return result
+
     def get_file_id(self, lfn): #override
         LOG.debug('Loading file id for LFN %s', lfn)
 
@@ -453,7 +468,7 @@ class MySQLInventoryStore(InventoryStore):
         fields = ('id', 'name')
         mapping = lambda partition: (partition.id, partition.name)
 
-        num = self._mysql.insert_many('partitions_tmp', fields, mapping, partitions, do_update = False)
+        num = self._fill_table('partitions_tmp', fields, mapping, partitions)
 
         self._mysql.query('DROP TABLE `partitions`')
         self._mysql.query('RENAME TABLE `partitions_tmp` TO `partitions`')
@@ -471,7 +486,7 @@ class MySQLInventoryStore(InventoryStore):
 
         groups = [g for g in groups if g.name is not None]
 
-        num = self._mysql.insert_many('groups_tmp', fields, mapping, groups, do_update = False)
+        num = self._fill_table('groups_tmp', fields, mapping, groups)
 
         self._mysql.query('DROP TABLE `groups`')
         self._mysql.query('RENAME TABLE `groups_tmp` TO `groups`')
@@ -488,7 +503,7 @@ class MySQLInventoryStore(InventoryStore):
         mapping = lambda site: (site.id, site.name, site.host, Site.storage_type_name(site.storage_type), \
             site.backend, Site.status_name(site.status))
 
-        num = self._mysql.insert_many('sites_tmp', fields, mapping, sites, do_update = False)
+        num = self._fill_table('sites_tmp', fields, mapping, sites)
 
         if self._mysql.table_exists('filename_mappings_tmp'):
             self._mysql.query('DROP TABLE `filename_mappings_tmp`')
@@ -504,7 +519,7 @@ class MySQLInventoryStore(InventoryStore):
                         for idx, (lfn, pfn) in enumerate(chain):
                             yield (site.id, protocol, chain_id, idx, lfn, pfn)
 
-        self._mysql.insert_many('filename_mappings_tmp', fields, None, site_mappings(), do_update = False)
+        self._fill_table('filename_mappings_tmp', fields, None, site_mappings())
 
         self._mysql.query('DROP TABLE `sites`')
         self._mysql.query('RENAME TABLE `sites_tmp` TO `sites`')
@@ -529,7 +544,7 @@ class MySQLInventoryStore(InventoryStore):
                 if sitepartition.partition.subpartitions is None:
                     yield sitepartition
 
-        num = self._mysql.insert_many('quotas_tmp', fields, mapping, sitepartitions_baseonly(), do_update = False)
+        num = self._fill_table('quotas_tmp', fields, mapping, sitepartitions_baseonly())
 
         self._mysql.query('DROP TABLE `quotas`')
         self._mysql.query('RENAME TABLE `quotas_tmp` TO `quotas`')
@@ -557,12 +572,12 @@ class MySQLInventoryStore(InventoryStore):
                 software_versions.add(dataset.software_version)
                 yield dataset
 
-        num = self._mysql.insert_many('datasets_tmp', fields, mapping, get_dataset(), do_update = False)
+        num = self._fill_table('datasets_tmp', fields, mapping, get_dataset())
 
         fields = ('id',) + Dataset.SoftwareVersion.field_names
         mapping = lambda v: (v.id,) + v.value
 
-        self._mysql.insert_many('software_versions_tmp', fields, mapping, software_versions, do_update = False)
+        self._fill_table('software_versions_tmp', fields, mapping, software_versions)
 
         self._mysql.query('DROP TABLE `datasets`')
         self._mysql.query('RENAME TABLE `datasets_tmp` TO `datasets`')
@@ -583,7 +598,7 @@ class MySQLInventoryStore(InventoryStore):
             block.size, block.num_files, block.is_open, \
             time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block.last_update)))
 
-        num = self._mysql.insert_many('blocks_tmp', fields, mapping, blocks, do_update = False)
+        num = self._fill_table('blocks_tmp', fields, mapping, blocks)
 
         self._mysql.query('DROP TABLE `blocks`')
         self._mysql.query('RENAME TABLE `blocks_tmp` TO `blocks`')
@@ -599,7 +614,9 @@ class MySQLInventoryStore(InventoryStore):
         fields = ('id', 'block_id', 'size', 'name') + File.checksum_algorithms
         mapping = lambda lfile: (lfile.id, lfile.block.id, lfile.size, lfile.lfn) + lfile.checksum
 
-        num = self._mysql.insert_many('files_tmp', fields, mapping, files, do_update = False)
+        # Files of a block are loaded on demand through this store (Block.inventory_store), which cannot be
+        # queried while LOAD DATA streams from the same connection. Always use plain INSERTs here.
+        num = self._fill_table('files_tmp', fields, mapping, files, bulk = False)
 
         self._mysql.query('DROP TABLE `files`')
         self._mysql.query('RENAME TABLE `files_tmp` TO `files`')
@@ -615,7 +632,7 @@ class MySQLInventoryStore(InventoryStore):
         fields = ('dataset_id', 'site_id', 'growing', 'group_id')
         mapping = lambda replica: (replica.dataset.id, replica.site.id, replica.growing, replica.group.id if replica.growing else None)
 
-        num = self._mysql.insert_many('dataset_replicas_tmp', fields, mapping, replicas, do_update = False)
+        num = self._fill_table('dataset_replicas_tmp', fields, mapping, replicas)
 
         self._mysql.query('DROP TABLE `dataset_replicas`')
         self._mysql.query('RENAME TABLE `dataset_replicas_tmp` TO `dataset_replicas`')
@@ -638,7 +655,17 @@ class MySQLInventoryStore(InventoryStore):
                                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(replica.last_update)),
                                        replica.is_complete())
 
-            num = self._mysql.insert_many('block_replicas_tmp', fields, mapping, replicas, do_update = False)
+            # replicas can be a single-pass generator - collect the file rows in the same pass
+            filereplicas = []
+
+            def get_replicas():
+                for replica in replicas:
+                    if not replica.is_complete():
+                        filereplicas.extend((replica.block.id, replica.site.id, file_id) for file_id in replica.file_ids)
+
+                    yield replica
+
+            num = self._fill_table('block_replicas_tmp', fields, mapping, get_replicas())
 
             # Fill block_replica_files_tmp
             if self._mysql.table_exists('block_replica_files_tmp'):
@@ -647,16 +674,8 @@ class MySQLInventoryStore(InventoryStore):
             self._mysql.query('CREATE TABLE `block_replica_files_tmp` LIKE `block_replica_files`')
 
             fields = ('block_id', 'site_id', 'file_id')
-    
-            def get_filereplica():
-                for replica in replicas:
-                    if replica.is_complete():
-                        continue
-    
-                    for file_id in replica.file_ids:
-                        yield (replica.block.id, replica.site.id, file_id)
-    
-            self._mysql.insert_many('block_replica_files_tmp', fields, None, get_filereplicas(), do_update = False)
+
+            self._fill_table('block_replica_files_tmp', fields, None, filereplicas)
 
             self._mysql.query('DROP TABLE `block_replica_files`')
             self._mysql.query('RENAME TABLE `block_replica_files_tmp` TO `block_replica_files`')
@@ -673,7 +692,7 @@ class MySQLInventoryStore(InventoryStore):
                                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(replica.last_update)),
                                        replica.is_complete(), replica.file_ids, replica.size)
 
-            num = self._mysql.insert_many('block_replicas_tmp', fields, mapping, replicas, do_update = False)
+            num = self._fill_table('block_replicas_tmp', fields, mapping, replicas)
 
             # Use SQL-level operation to fill the sizes_tmp table
             if self._mysql.table_exists('block_replica_sizes_tmp'):
@@ -708,7 +727,24 @@ class MySQLInventoryStore(InventoryStore):
             fields_str = ', '.join('`%s`' % f for f in fields)
             self._mysql.query('TRUNCATE TABLE `%s`' % table)
             rows = source._mysql.xquery('SELECT %s FROM `%s`' % (fields_str, table))
-            self._mysql.insert_many(table, fields, None, rows, do_update = False)
+            self._fill_table(table, fields, None, rows)
+
+    def _fill_table(self, table, fields, mapping, objects, bulk = True):
+        """
+        Fill an empty table. With bulk_load, rows are streamed through MySQL.load_many with the non-unique indexes
+        disabled during the load and rebuilt in one pass at the end. Iterating over objects and mapping them then
+        happens in another thread while the connection is busy; pass bulk = False if that needs this store.
+        """
+        if not self.bulk_load or not bulk:
+            return self._mysql.insert_many(table, fields, mapping, objects, do_update = False)
+
+        LOG.debug('Bulk loading table %s', table)
+
+        self._mysql.query('ALTER TABLE `%s` DISABLE KEYS' % table)
+        try:
+            return self._mysql.load_many(table, fields, mapping, objects)
+        finally:
+            self._mysql.query('ALTER TABLE `%s` ENABLE KEYS' % table)
 
     def _yield_partitions(self): #override
         sql = 'SELECT `id`, `name` FROM `partitions`'
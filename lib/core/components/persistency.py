@@ -86,6 +86,18 @@ class InventoryStore(object):
         
         raise NotImplementedError('get_files')
 
+    def get_file_ids(self, blocks):
+        """
+        Return the ids of the files belonging to each block. Implementations should override this
+        with a bulk query; the default loads the files block by block.
+
+        @param blocks  List of Block objects.
+
+        @return {block: set(file ids)}
+        """
+
+        return dict((block, set(f.id for f in block.files)) for block in blocks)
+
     def get_file_id(self, lfn):
         """
         Return the id of a file with the given LFN.
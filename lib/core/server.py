@@ -20,6 +20,7 @@ from dynamo.core.components.host import ServerHost, OutOfSyncError
 from dynamo.core.components.appmanager import AppManager
 from dynamo.web.server import WebServer
 from dynamo.utils.log import log_exception, reset_logger
+from dynamo.utils.interface.mysql import MySQL, QueryStats
 from dynamo.utils.signaling import SignalBlocker
 from dynamo.dataformat import Configuration
 
@@ -682,6 +683,9 @@ class DynamoServer(object):
         sys.argv = [path + '/exec.py']
         if args:
             sys.argv += shlex.split(args) # split using shell-like syntax
+
+        # Query statistics of this run only (the forked process carries over those of the parent)
+        MySQL.stats = QueryStats()
     
         # Execute the script
         try:
@@ -720,6 +724,13 @@ class DynamoServer(object):
     
         finally:
             # cleanup
+            if not MySQL.stats.empty():
+                # available to the web server through the dbstats module while the work area exists
+                try:
+                    MySQL.stats.dump(path + '/_dbstats.json')
+                except:
+                    log_exception(LOG)
+
             self._post_execution(path, is_local)
     
             sys.stdout.close()
@@ -2,7 +2,7 @@ import logging
 import fnmatch
 import random
 
-from dynamo.dataformat import Site, BlockReplica
+from dynamo.dataformat import Site, Block, BlockReplica
 
 LOG = logging.getLogger(__name__)
 
@@ -21,6 +21,182 @@ class ReplicaPlacementRule(object):
         return True
 
 
+class DestinationSampler(object):
+    """
+    Weighted random selection of copy destinations among the target sites. The weight of a site is
+    its free fraction of the partition quota (1 for sites without a quota), counting the volume already
+    assigned in the current cycle. Weights are kept in a Fenwick tree so that drawing a site and updating
+    a weight are both O(log n). Per-request conditions (item size, existing replicas, placement rules) are
+    applied only to the drawn sites through rejection sampling, which leaves the selection probabilities
+    identical to a full scan over the candidates.
+    """
+
+    # Number of draws before falling back to a full scan
+    max_trials = 20
+
+    def __init__(self, sites, partition):
+        self.sites = list(sites)
+        self._index = dict((site, isite) for isite, site in enumerate(self.sites))
+
+        self.quotas = []
+        # projected occupancy fraction
+        self.occupancies = []
+        self.weights = []
+        self._tree = [0.] * (len(self.sites) + 1)
+
+        for isite, site in enumerate(self.sites):
+            site_partition = site.partitions[partition]
+            quota = site_partition.quota
+
+            self.quotas.append(quota)
+            if quota > 0.:
+                self.occupancies.append(site_partition.occupancy_fraction(physical = False))
+            else:
+                self.occupancies.append(0.)
+
+            self.weights.append(0.)
+            self._set_weight(isite, self._base_weight(isite))
+
+    def add_volume(self, site, volume):
+        """
+        Account for volume newly assigned to the site.
+        """
+
+        try:
+            isite = self._index[site]
+        except KeyError:
+            return
+
+        if self.quotas[isite] > 0.:
+            self.occupancies[isite] += float(volume) / self.quotas[isite]
+
+        if self.weights[isite] != 0.:
+            self._set_weight(isite, self._base_weight(isite))
+
+    def remove(self, site):
+        """
+        Exclude the site from further draws.
+        """
+
+        try:
+            isite = self._index[site]
+        except KeyError:
+            return
+
+        self._set_weight(isite, 0.)
+
+    def sample(self, request, is_allowed):
+        """
+        Draw a destination for the request.
+        @param request     DealerRequest
+        @param is_allowed  Function (request, site) -> bool for the site-specific checks
+
+        @return A site or None if no destination is available.
+        """
+
+        item_size = request.item_size()
+
+        rejected = set()
+
+        for _ in xrange(self.max_trials):
+            total = self._prefix_sum(len(self.sites))
+            if total <= 0.:
+                return None
+
+            isite = self._find(random.uniform(0., total))
+            if isite in rejected:
+                continue
+
+            weight = self.weights[isite]
+            if weight == 0.:
+                continue
+
+            p = self._request_weight(isite, item_size)
+
+            if p < 0. or not is_allowed(request, self.sites[isite]):
+                rejected.add(isite)
+                continue
+
+            # accept with probability p / weight -> overall probability is proportional to p
+            if random.uniform(0., weight) <= p:
+                return self.sites[isite]
+
+        # Many candidates are not usable for this request - scan the full list
+        site_array = []
+        for isite, site in enumerate(self.sites):
+            if self.weights[isite] == 0. or isite in rejected:
+                continue
+
+            p = self._request_weight(isite, item_size)
+            if p < 0. or not is_allowed(request, site):
+                continue
+
+            if len(site_array) != 0:
+                p += site_array[-1][1]
+
+            site_array.append((site, p))
+
+        if len(site_array) == 0:
+            return None
+
+        x = random.uniform(0., site_array[-1][1])
+
+        return next(site for site, p in site_array if x <= p)
+
+    def _base_weight(self, isite):
+        if self.quotas[isite] > 0.:
+            return max(0., 1. - self.occupancies[isite])
+        else:
+            return 1.
+
+    def _request_weight(self, isite, item_size):
+        if self.quotas[isite] > 0.:
+            # negative if the total projected volume exceeds the quota
+            return 1. - self.occupancies[isite] - float(item_size) / self.quotas[isite]
+        else:
+            return 1.
+
+    def _set_weight(self, isite, weight):
+        delta = weight - self.weights[isite]
+        self.weights[isite] = weight
+
+        i = isite + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & (-i)
+
+    def _prefix_sum(self, n):
+        total = 0.
+        while n > 0:
+            total += self._tree[n]
+            n -= n & (-n)
+
+        return total
+
+    def _find(self, x):
+        """
+        Return the smallest index whose cumulative weight exceeds x.
+        """
+
+        pos = 0
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+
+        while step > 0:
+            if pos + step < len(self._tree) and self._tree[pos + step] <= x:
+                pos += step
+                x -= self._tree[pos]
+
+            step //= 2
+
+        # guard against floating point round-offs and zero-weight sites at the boundary
+        while pos < len(self.sites) - 1 and self.weights[pos] == 0.:
+            pos += 1
+
+        return min(pos, len(self.sites) - 1)
+
+
 class DealerPolicy(object):
     """
     Defined for each partition and implements the concrete conditions for copies.
@@ -43,6 +219,10 @@ class DealerPolicy(object):
 
         # To be set at runtime
         self.target_sites = set()
+        self.destination_sampler = None
+
+        # Source completeness index {dataset or block: bool}, cleared every cycle
+        self._source_complete = {}
 
     def set_target_sites(self, sites, partition):
         """
@@ -53,6 +233,13 @@ class DealerPolicy(object):
             if self.is_target_site(site.partitions[partition]):
                 self.target_sites.add(site)
 
+    def init_destination_sampler(self, partition):
+        """
+        Set up the weighted destination sampler over the current target sites.
+        """
+
+        self.destination_sampler = DestinationSampler(self.target_sites, partition)
+
     def is_target_site(self, site_partition, additional_volume = 0.):
         site = site_partition.site
         quota = site_partition.quota
@@ -104,6 +291,34 @@ class DealerPolicy(object):
 
         return True
 
+    def free_volume(self, site_partition):
+        """
+        Volume that can be added to the site before it stops being a copy destination (see is_target_site
+        and find_destination_for).
+        @param site_partition  SitePartition of a target site
+
+        @return Volume in bytes (float('inf') if unlimited).
+        """
+
+        quota = site_partition.quota
+
+        if quota <= 0.:
+            return float('inf')
+
+        occupancy_fraction = site_partition.occupancy_fraction(physical = False)
+
+        # total projected volume must not exceed the quota
+        free_fraction = 1. - occupancy_fraction
+
+        if self.target_site_occupancy < 1.:
+            free_fraction = min(free_fraction, self.target_site_occupancy - occupancy_fraction)
+
+        if self.max_site_pending_fraction < 1.:
+            pending_fraction = occupancy_fraction - site_partition.occupancy_fraction(physical = True)
+            free_fraction = min(free_fraction, self.max_site_pending_fraction - pending_fraction)
+
+        return max(0., free_fraction * quota)
+
     def is_allowed_destination(self, request, site):
         """
         Check if the request item is allowed to be at site, according to the set of rules.
@@ -124,84 +339,119 @@ class DealerPolicy(object):
         return True
 
     def validate_source(self, request):
+        """
+        Check that all blocks of the requested item are complete somewhere (allowing the completion to be
+        spread over multiple replicas at file level). Results are cached for the cycle; see reset_source_cache.
+        """
+
         if request.blocks is not None:
-            for block in request.blocks:
-                for replica in block.replicas:
-                    if replica.is_complete():
-                        break
-                else:
-                    # no block complete
-                    if BlockReplica._use_file_ids:
-                        # can determine completion at file level
-                        block_files = set(f.id for f in block.files)
-                        replica_files = set()
-                        for replica in block.replicas:
-                            if replica.file_ids is None:
-                                # can't happen but hey
-                                replica_files = block_files
-                                break
-                            else:
-                                replica_files.update(replica.file_ids)
-
-                        if block_files != replica_files:
-                            # some files missing
-                            return False
-                    else:
-                        return False
+            return self._blocks_source_complete(request.blocks)
 
         elif request.block is not None:
-            for replica in request.block.replicas:
+            return self._blocks_source_complete([request.block])
+
+        else:
+            dataset = request.dataset
+
+            try:
+                return self._source_complete[dataset]
+            except KeyError:
+                pass
+
+            for replica in dataset.replicas:
+                if replica.is_complete():
+                    complete = True
+                    break
+            else:
+                complete = self._blocks_source_complete(dataset.blocks)
+
+            self._source_complete[dataset] = complete
+
+            return complete
+
+    def reset_source_cache(self):
+        """
+        Clear the source completeness index. Call at the start of each cycle.
+        """
+
+        self._source_complete.clear()
+
+    def invalidate_source(self, dataset):
+        """
+        Drop the cached source completeness of the dataset and its blocks. Call when replicas of the dataset change.
+        """
+
+        self._source_complete.pop(dataset, None)
+        for block in dataset.blocks:
+            self._source_complete.pop(block, None)
+
+    def _blocks_source_complete(self, blocks):
+        cache = self._source_complete
+
+        unknown = []
+        for block in blocks:
+            try:
+                if not cache[block]:
+                    return False
+            except KeyError:
+                unknown.append(block)
+
+        # blocks that need a file-level check
+        incomplete = []
+
+        for block in unknown:
+            for replica in block.replicas:
                 if replica.is_complete():
+                    cache[block] = True
                     break
             else:
                 # no block complete
                 if BlockReplica._use_file_ids:
                     # can determine completion at file level
-                    block_files = set(f.id for f in request.block.files)
-                    replica_files = set()
-                    for replica in request.block.replicas:
-                        if replica.file_ids is None:
-                            # can't happen but hey
-                            replica_files = block_files
-                            break
-                        else:
-                            replica_files.update(replica.file_ids)
-
-                    if block_files != replica_files:
-                        # some files missing
-                        return False
+                    incomplete.append(block)
                 else:
+                    cache[block] = False
                     return False
 
-        else:
-            replica_blocks = set()
-            for replica in request.dataset.replicas:
-                if replica.is_complete():
-                    return True
-
-                for block_replica in replica.block_replicas:
-                    if block_replica.is_complete():
-                        replica_blocks.add(block_replica.block)
-
-            if request.dataset.blocks == replica_blocks:
-                return True
-
-            if BlockReplica._use_file_ids:
-                # some blocks missing - go to file level
-                dataset_files = set(f.id for f in request.dataset.files)
-                replica_files = set()
-                for replica in request.dataset.replicas:
-                    for block_replica in replica.block_replicas:
-                        replica_files.update(f.id for f in block_replica.files())
-    
-                if dataset_files != replica_files:
-                    return False
-            else:
-                return False
+        if len(incomplete) == 0:
+            return True
 
-        return True
+        # load the file ids of all blocks at once
+        block_files = Block.inventory_store.get_file_ids(incomplete)
+
+        result = True
+
+        for block in incomplete:
+            replica_files = set()
+            for replica in block.replicas:
+                if replica.file_ids is None:
+                    # can't happen but hey
+                    replica_files = block_files[block]
+                    break
+                else:
+                    replica_files.update(replica.file_ids)
+
+            # some files missing?
+            cache[block] = (block_files[block] == replica_files)
+            if not cache[block]:
+                result = False
+
+        return result
 
     def find_destination_for(self, request, partition, candidates = None):
+        if candidates is None and self.destination_sampler is not None:
+            def is_allowed(request, site):
+                # replica must not be at the site already, and placement must be allowed by the policy
+                return request.item_already_exists(site) == 0 and self.is_allowed_destination(request, site)
+
+            destination = self.destination_sampler.sample(request, is_allowed)
+            if destination is None:
+                LOG.warning('%s has no copy destination.', request.item_name())
+                return 'No destination available'
+
+            request.destination = destination
+            return None
+
         if candidates is None:
             candidates = self.target_sites
 
@@ -1,11 +1,14 @@
+import sys
 import time
 import datetime
+import threading
 import collections
 import fnmatch
 import logging
 import random
+import bisect
 
-from dynamo.dataformat import Dataset, DatasetReplica, BlockReplica
+from dynamo.dataformat import Dataset, DatasetReplica, BlockReplica, ConfigurationError
 from dynamo.dataformat.history import CopiedReplica, HistoryRecord
 from dynamo.dealer.dealerpolicy import DealerPolicy
 from dynamo.dealer.history import DealerHistory
@@ -38,6 +41,17 @@ class Dealer(object):
         if self.test_run:
             self.copy_op.set_read_only()
 
+        # Run get_requests of the plugins in parallel threads
+        self.concurrent_plugins = config.get('concurrent_plugins', False)
+        # Placement engine: greedy (one request at a time, random destination) or packing (whole proposal set)
+        self.placement_engine = config.get('placement_engine', 'greedy')
+        if self.placement_engine not in ('greedy', 'packing'):
+            raise ConfigurationError('Unknown placement engine ' + self.placement_engine)
+
+        # Time limit (seconds) for plugins to return the requests. Plugins exceeding the limit are ignored. 0 -> no limit.
+        # Plugins with side effects (has_side_effects) are always waited for.
+        self.plugin_timeout = config.get('plugin_timeout', 0)
+
         self._setup_plugins(config)
 
     def set_read_only(self, value = True):
@@ -68,6 +82,9 @@ class Dealer(object):
         # Ask each site if it should be considered as a copy destination.
         self.policy.set_target_sites(inventory.sites.itervalues(), partition)
 
+        # Inventory content may have changed since the last cycle
+        self.policy.reset_source_cache()
+
         if len(self.policy.target_sites) == 0:
             LOG.info('No sites can accept transfers at this moment. Exiting Dealer.')
             return
@@ -156,6 +173,76 @@ class Dealer(object):
 
         self.attr_producers = list(set(get_producers(attr_names, config.attrs).itervalues()))
 
+    def _run_plugins(self, inventory):
+        """
+        Call get_requests of all plugins. If concurrent_plugins is True, each plugin runs in its own thread.
+        Plugins are executed in threads and not in forked processes because the returned requests must refer
+        to the objects of this inventory.
+        @param inventory    DynamoInventory instance.
+        @return {plugin: [DealerRequest]}
+        """
+
+        results = {} # {plugin: (requests, time, exc_info)}
+
+        def get_requests(plugin):
+            start = time.time()
+            try:
+                plugin_requests = plugin.get_requests(inventory, self.policy)
+            except:
+                results[plugin] = (None, time.time() - start, sys.exc_info())
+            else:
+                results[plugin] = (plugin_requests, time.time() - start, None)
+
+        plugins = self._plugin_priorities.keys()
+        skipped = set() # plugins not started because the time budget ran out (serial execution only)
+
+        if self.concurrent_plugins and len(plugins) > 1:
+            threads = []
+            for plugin in plugins:
+                thread = threading.Thread(target = get_requests, args = (plugin,), name = plugin.name)
+                thread.daemon = True
+                thread.start()
+                threads.append((plugin, thread))
+
+            start = time.time()
+            for plugin, thread in threads:
+                if self.plugin_timeout > 0 and not plugin.has_side_effects:
+                    thread.join(max(0., self.plugin_timeout - (time.time() - start)))
+                else:
+                    thread.join()
+
+        else:
+            start = time.time()
+            for iplugin, plugin in enumerate(plugins):
+                if self.plugin_timeout > 0 and time.time() - start > self.plugin_timeout:
+                    skipped.update(plugins[iplugin:])
+                    break
+
+                get_requests(plugin)
+
+        plugin_requests = {}
+
+        for plugin in plugins:
+            try:
+                requests, elapsed, exc_info = results[plugin]
+            except KeyError:
+                if plugin in skipped:
+                    LOG.error('Plugin %s was not run because the %d-second time budget was exhausted.', plugin.name, self.plugin_timeout)
+                    continue
+
+                LOG.error('Plugin %s did not return within %d seconds. Ignoring its requests.', plugin.name, self.plugin_timeout)
+                continue
+
+            if exc_info is not None:
+                LOG.error('Plugin %s raised an exception.', plugin.name)
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            LOG.info('Plugin %s returned %d requests in %.1f seconds.', plugin.name, len(requests), elapsed)
+
+            plugin_requests[plugin] = requests
+
+        return plugin_requests
+
     def _collect_requests(self, inventory):
         """
         Collect requests from each plugin and return a prioritized list.
@@ -168,79 +255,71 @@ class Dealer(object):
 
         reqlists = {} # {plugin: reqlist} reqlist is [(item, destination)]
 
-        for plugin, priority in self._plugin_priorities.items():
-            if priority == 0:
-                # all plugins must have priority 0 (see _setup_plugins)
-                # -> treat all as equal.
-                priority = 1
-
-            plugin_requests = plugin.get_requests(inventory, self.policy)
-
+        for plugin, plugin_requests in self._run_plugins(inventory).iteritems():
             LOG.debug('%s requesting %d items', plugin.name, len(plugin_requests))
 
             if len(plugin_requests) != 0:
                 reqlists[plugin] = plugin_requests
 
-        # Flattened list of (DealerRequest, plugin)
-        requests = []
-
         # Collect the requests based on plugin priority
         reject_stats = {
             'No source replica available': 0,
             'Dataset is not valid': 0
         }
 
-        while len(reqlists) != 0:
-            # Classic weighted random-picking algorithm
-            plugins = reqlists.keys()
+        # First reject the requests that can never be fulfilled
+        for plugin in reqlists.keys():
+            reqlist = collections.deque()
 
-            pvalues = [1. / self._plugin_priorities[p] for p in plugins]
-            sums = [sum(pvalues[:i + 1]) for i in range(len(pvalues))]
+            for request in reqlists[plugin]:
+                reject_reason = self._check_request(request)
+                if reject_reason is None:
+                    reqlist.append(request)
+                else:
+                    reject_stats[reject_reason] += 1
+
+            if len(reqlist) == 0:
+                reqlists.pop(plugin)
+            else:
+                reqlists[plugin] = reqlist
+
+        # Flattened list of (DealerRequest, plugin)
+        requests = []
+
+        # Classic weighted random-picking algorithm
+        # Select k if sum(w_{i})_{i <= k-1} w_{k} < x < sum(w_{i})_{i <= k} for x in Uniform(0, sum(w_{i}))
+        # The cumulative sums only change when a plugin runs out of requests.
+        plugins = reqlists.keys()
+        sums = []
+
+        while len(plugins) != 0:
+            if len(sums) != len(plugins):
+                sums = []
+                total = 0.
+                for p in plugins:
+                    priority = self._plugin_priorities[p]
+                    if priority == 0:
+                        # all plugins must have priority 0 (see _setup_plugins)
+                        # -> treat all as equal.
+                        priority = 1
+
+                    total += 1. / priority
+                    sums.append(total)
 
-            # Select k if sum(w_{i})_{i <= k-1} w_{k} < x < sum(w_{i})_{i <= k} for x in Uniform(0, sum(w_{i}))
             x = random.uniform(0., sums[-1])
 
             # Index of the selected plugin
-            ip = next(k for k in range(len(sums)) if x < sums[k])
+            ip = min(bisect.bisect_right(sums, x), len(plugins) - 1)
             plugin = plugins[ip]
 
             reqlist = reqlists[plugin]
-            request = reqlist.pop(0)
+            request = reqlist.popleft()
 
             if len(reqlist) == 0:
                 LOG.debug('No more requests from %s', plugin.name)
+                plugins.pop(ip)
                 reqlists.pop(plugin)
 
-            # check that there is at least one source (allow it to be incomplete - could be in production)
-            no_source = False
-            if request.block is not None:
-                if len(request.block.replicas) == 0:
-                    no_source = True
-
-            elif request.blocks is not None:
-                if len(request.blocks) == 0:
-                    no_source = True
-                else:
-                    # all blocks must have at least one copy
-                    for block in request.blocks:
-                        if len(block.replicas) == 0:
-                            no_source = True
-                            break
-
-            elif request.dataset is not None:
-                if len(request.dataset.replicas) == 0:
-                    no_source = True
-
-            if no_source:
-                LOG.debug('%s has no source', request.item_name())
-                reject_stats['No source replica available'] += 1
-                continue
-
-            if request.dataset.status not in (Dataset.STAT_PRODUCTION, Dataset.STAT_VALID):
-                LOG.debug('Dataset of %s is not valid', request.item_name())
-                reject_stats['Dataset is not valid'] += 1
-                continue
-
             # set the group here
             if request.group is None:
                 request.group = default_group
@@ -264,8 +343,48 @@ class Dealer(object):
 
             requests.append((request, plugin))
 
+        for reason in sorted(reject_stats.keys()):
+            LOG.info('%d items rejected for [%s]', reject_stats[reason], reason)
+
         return requests
 
+    def _check_request(self, request):
+        """
+        Check that the request can be fulfilled at all.
+        @param request   DealerRequest
+        @return None if the request is valid, otherwise the reason for rejection.
+        """
+
+        # check that there is at least one source (allow it to be incomplete - could be in production)
+        no_source = False
+        if request.block is not None:
+            if len(request.block.replicas) == 0:
+                no_source = True
+
+        elif request.blocks is not None:
+            if len(request.blocks) == 0:
+                no_source = True
+            else:
+                # all blocks must have at least one copy
+                for block in request.blocks:
+                    if len(block.replicas) == 0:
+                        no_source = True
+                        break
+
+        elif request.dataset is not None:
+            if len(request.dataset.replicas) == 0:
+                no_source = True
+
+        if no_source:
+            LOG.debug('%s has no source', request.item_name())
+            return 'No source replica available'
+
+        if request.dataset.status not in (Dataset.STAT_PRODUCTION, Dataset.STAT_VALID):
+            LOG.debug('Dataset of %s is not valid', request.item_name())
+            return 'Dataset is not valid'
+
+        return None
+
     def _determine_copies(self, partition, requests):
         """
         @param partition       Partition we copy into.
@@ -273,6 +392,17 @@ class Dealer(object):
         @return {plugin: [new dataset replica]}
         """
 
+        if self.placement_engine == 'packing':
+            return self._determine_copies_packing(partition, requests)
+        else:
+            return self._determine_copies_greedy(partition, requests)
+
+    def _determine_copies_greedy(self, partition, requests):
+        """
+        Place the requests one by one in the given order, choosing the destination randomly with
+        probability proportional to the free space.
+        """
+
         # returned dict
         copy_list = collections.defaultdict(list)
         copy_volumes = dict((site, 0.) for site in self.policy.target_sites) # keep track of how much we are assigning to each site
@@ -281,6 +411,9 @@ class Dealer(object):
         for plugin in self._plugin_priorities.keys():
             stats[plugin.name] = {}
 
+        # Weighted sampler of the destinations, updated as the copies are assigned
+        self.policy.init_destination_sampler(partition)
+
         reject_stats = {
             'Not a target site': 0,
             'Replica exists': 0,
@@ -310,40 +443,167 @@ class Dealer(object):
                 reject_stats[reject_reason] += 1
                 continue
 
-            LOG.debug('Copying %s to %s requested by %s', request.item_name(), request.destination.name, plugin.name)
-            try:
-                stat = stats[plugin.name][request.destination.name]
-            except KeyError:
-                stat = (0, 0)
-
-            stats[plugin.name][request.destination.name] = (stat[0] + 1, stat[0] + request.item_size())
+            self._add_copy(request, plugin, copy_list, stats)
 
-            if request.block is not None:
-                blocks = [request.block]
-                growing = False
-            elif request.blocks is not None:
-                blocks = request.blocks
-                growing = False
-            else:
-                blocks = request.dataset.blocks
-                growing = True
-
-            new_replica = DatasetReplica(request.dataset, request.destination, growing = growing, group = request.group)
-            for block in blocks:
-                new_replica.block_replicas.add(BlockReplica(block, request.destination, request.group, size = 0))
-
-            copy_list[plugin].append(new_replica)
             # New replicas may not be in the target partition, but we add the size up to be conservative
             copy_volumes[request.destination] += request.item_size()
+            self.policy.destination_sampler.add_volume(request.destination, request.item_size())
 
             if not self.policy.is_target_site(request.destination.partitions[partition], copy_volumes[request.destination]):
                 LOG.info('%s is not a target site any more.', request.destination.name)
                 self.policy.target_sites.remove(request.destination)
+                self.policy.destination_sampler.remove(request.destination)
 
             if sum(copy_volumes.itervalues()) > self.policy.max_total_cycle_volume:
                 LOG.warning('Total copy volume has exceeded the limit. No more copies will be made.')
                 break
 
+        self._print_copy_stats(stats, reject_stats)
+
+        self.policy.destination_sampler = None
+
+        return copy_list
+
+    def _determine_copies_packing(self, partition, requests):
+        """
+        Place the full set of requests at once. Requests are processed in tiers of plugin priority (highest first).
+        Within a tier, requests with a fixed destination come first, and the rest are placed in order of decreasing
+        size, each to the allowed site with the lowest projected occupancy that can still take it. Neither the
+        site limits of the policy nor max_total_cycle_volume are exceeded.
+        """
+
+        # returned dict
+        copy_list = collections.defaultdict(list)
+
+        stats = {}
+        for plugin in self._plugin_priorities.keys():
+            stats[plugin.name] = {}
+
+        reject_stats = {
+            'Not a target site': 0,
+            'Replica exists': 0,
+            'Not allowed': 0,
+            'Destination is full': 0,
+            'Invalid request': 0,
+            'No destination available': 0,
+            'Source files missing': 0,
+            'Total cycle volume exceeded': 0
+        }
+
+        # Remaining volume each site can take, and the projected occupancy used as the placement cost
+        capacities = {}
+        occupancies = {}
+        for site in self.policy.target_sites:
+            site_partition = site.partitions[partition]
+            capacities[site] = self.policy.free_volume(site_partition)
+            if site_partition.quota > 0.:
+                occupancies[site] = site_partition.occupancy_fraction(physical = False)
+            else:
+                occupancies[site] = 0.
+
+        remaining_volume = self.policy.max_total_cycle_volume
+
+        # Sort the requests into priority tiers
+        tiers = collections.defaultdict(list)
+        for request, plugin in requests:
+            if not self.policy.validate_source(request):
+                reject_stats['Source files missing'] += 1
+                continue
+
+            if request.destination is not None:
+                reject_reason = self.policy.check_destination(request, partition)
+                if reject_reason is not None:
+                    reject_stats[reject_reason] += 1
+                    continue
+
+            tiers[self._plugin_priorities[plugin]].append((request, plugin))
+
+        for priority in sorted(tiers.iterkeys()):
+            tier = tiers[priority]
+            tier.sort(key = lambda (r, p): (r.destination is None, -r.item_size()))
+
+            for request, plugin in tier:
+                item_size = request.item_size()
+
+                if item_size > remaining_volume:
+                    reject_stats['Total cycle volume exceeded'] += 1
+                    continue
+
+                if request.destination is not None:
+                    if capacities[request.destination] < item_size:
+                        reject_stats['Destination is full'] += 1
+                        continue
+
+                else:
+                    best_cost = None
+                    for site, capacity in capacities.iteritems():
+                        if capacity < item_size:
+                            continue
+
+                        if request.item_already_exists(site) != 0 or not self.policy.is_allowed_destination(request, site):
+                            continue
+
+                        quota = site.partitions[partition].quota
+                        if quota > 0.:
+                            cost = occupancies[site] + float(item_size) / quota
+                        else:
+                            cost = 0.
+
+                        # random tie-breaker
+                        cost = (cost, random.random())
+
+                        if best_cost is None or cost < best_cost:
+                            best_cost = cost
+                            request.destination = site
+
+                    if request.destination is None:
+                        reject_stats['No destination available'] += 1
+                        continue
+
+                self._add_copy(request, plugin, copy_list, stats)
+
+                site = request.destination
+                capacities[site] -= item_size
+                quota = site.partitions[partition].quota
+                if quota > 0.:
+                    occupancies[site] += float(item_size) / quota
+
+                remaining_volume -= item_size
+
+        self._print_copy_stats(stats, reject_stats)
+
+        return copy_list
+
+    def _add_copy(self, request, plugin, copy_list, stats):
+        """
+        Create a new replica for the request with a destination and append it to copy_list.
+        """
+
+        LOG.debug('Copying %s to %s requested by %s', request.item_name(), request.destination.name, plugin.name)
+        try:
+            stat = stats[plugin.name][request.destination.name]
+        except KeyError:
+            stat = (0, 0)
+
+        stats[plugin.name][request.destination.name] = (stat[0] + 1, stat[1] + request.item_size())
+
+        if request.block is not None:
+            blocks = [request.block]
+            growing = False
+        elif request.blocks is not None:
+            blocks = request.blocks
+            growing = False
+        else:
+            blocks = request.dataset.blocks
+            growing = True
+
+        new_replica = DatasetReplica(request.dataset, request.destination, growing = growing, group = request.group)
+        for block in blocks:
+            new_replica.block_replicas.add(BlockReplica(block, request.destination, request.group, size = 0))
+
+        copy_list[plugin].append(new_replica)
+
+    def _print_copy_stats(self, stats, reject_stats):
         for plugin_name in sorted(stats.keys()):
             plugin_stats = stats[plugin_name]
             for destination_name in sorted(plugin_stats.keys()):
@@ -353,8 +613,6 @@ class Dealer(object):
         for reason in sorted(reject_stats.keys()):
             LOG.info('%d items rejected for [%s]', reject_stats[reason], reason)
 
-        return copy_list
-
     def _commit_copies(self, cycle_number, inventory, copy_list, comment):
         """
         @param cycle_number  Cycle number.
@@ -386,6 +644,8 @@ class Dealer(object):
                     for block_replica in replica.block_replicas:
                         inventory.update(block_replica)
 
+                    self.policy.invalidate_source(replica.dataset)
+
                 self.history.update_entry(history_record)
 
                 total_size = sum(r.size for r in history_record.replicas)
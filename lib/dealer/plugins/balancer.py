@@ -1,5 +1,7 @@
 import logging
 import random
+import heapq
+import collections
 
 from base import BaseHandler, DealerRequest
 from dynamo.dataformat import Site
@@ -37,7 +39,17 @@ class BalancingHandler(BaseHandler):
         partition = inventory.partitions[policy.partition_name]
 
         protected_fractions = {} # {site: fraction}
-        last_copies = {} # {site: [datasets]}
+        last_copies = {} # {site: deque([datasets])}
+
+        # Number of non-partial disk replicas in the partition for each dataset
+        num_nonpartial_replicas = collections.defaultdict(int)
+        for site in inventory.sites.itervalues():
+            if site.storage_type == Site.TYPE_MSS:
+                continue
+
+            for replica in site.partitions[partition].replicas.iterkeys():
+                if not replica.is_partial():
+                    num_nonpartial_replicas[replica.dataset] += 1
 
         for site in inventory.sites.values():
             quota = site.partitions[partition].quota
@@ -65,7 +77,7 @@ class BalancingHandler(BaseHandler):
             # sort protected datasets by size (small ones first)
             protections.sort(key = lambda x: x[1])
 
-            last_copies[site] = []
+            last_copies[site] = collections.deque()
 
             for ds_name, size, reason in protections:
                 if self.max_dataset_size > 0 and size > self.max_dataset_size:
@@ -87,18 +99,7 @@ class BalancingHandler(BaseHandler):
                     # this replica has disappeared since then
                     continue
 
-                num_nonpartial = 0
-                for replica in dataset.replicas:
-                    if replica.site.storage_type == Site.TYPE_MSS:
-                        continue
-
-                    if replica.is_partial():
-                        continue
-
-                    if replica in replica.site.partitions[partition].replicas:
-                        num_nonpartial += 1
-
-                if num_nonpartial <= num_rep:
+                if num_nonpartial_replicas[dataset] <= num_rep:
                     LOG.debug('%s is a last copy at %s', ds_name, site.name)
                     last_copies[site].append(dataset)
 
@@ -110,9 +111,27 @@ class BalancingHandler(BaseHandler):
         total_size = 0
         variation = 1.
 
+        # Heaps of (fraction, site name, site) for the max (negative fraction) and min fractions.
+        # Entries are invalidated lazily: an entry is valid only if the fraction matches protected_fractions.
+        max_heap = [(-frac, site.name, site) for site, frac in protected_fractions.iteritems()]
+        min_heap = [(frac, site.name, site) for site, frac in protected_fractions.iteritems()]
+        heapq.heapify(max_heap)
+        heapq.heapify(min_heap)
+
+        def heap_top(heap, sign):
+            while len(heap) != 0:
+                frac, _, site = heap[0]
+                frac *= sign
+                if protected_fractions.get(site) == frac:
+                    return site, frac
+
+                heapq.heappop(heap)
+
+            return None, None
+
         while len(protected_fractions) != 0 and (self.max_cycle_volume <= 0. or total_size < self.max_cycle_volume):
-            maxsite, maxfrac = max(protected_fractions.items(), key = lambda x: x[1])
-            minsite, minfrac = min(protected_fractions.items(), key = lambda x: x[1])
+            maxsite, maxfrac = heap_top(max_heap, -1.)
+            minsite, minfrac = heap_top(min_heap, 1.)
 
             LOG.debug('Protected fraction variation %f', maxfrac - minfrac)
             LOG.debug('Max site: %s', maxsite.name)
@@ -122,7 +141,7 @@ class BalancingHandler(BaseHandler):
                 break
 
             try:
-                dataset = last_copies[maxsite].pop(0)
+                dataset = last_copies[maxsite].popleft()
             except IndexError: # nothing to copy from this site
                 protected_fractions.pop(maxsite)
                 continue
@@ -130,7 +149,11 @@ class BalancingHandler(BaseHandler):
             requests.append(DealerRequest(dataset))
 
             size = dataset.size
-            protected_fractions[maxsite] -= float(size) / maxsite.partitions[partition].quota
+            frac = maxfrac - float(size) / maxsite.partitions[partition].quota
+            protected_fractions[maxsite] = frac
+            heapq.heappush(max_heap, (-frac, maxsite.name, maxsite))
+            heapq.heappush(min_heap, (frac, maxsite.name, maxsite))
+
             total_size += size
 
         return requests
@@ -5,6 +5,8 @@ class BaseHandler(object):
         self.name = name
         self.required_attrs = []
         self._read_only = False
+        # True if get_requests writes persistent state (e.g. registry updates). Such plugins are never timed out.
+        self.has_side_effects = False
 
     def set_read_only(self, value = True):
         self._read_only = value
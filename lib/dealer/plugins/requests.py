@@ -14,6 +14,8 @@ class CopyRequestsHandler(BaseHandler):
 
     def __init__(self, config):
         BaseHandler.__init__(self, 'DirectRequests')
+        # get_requests updates the request registry
+        self.has_side_effects = True
 
         registry_config = Configuration(config.registry)
         registry_config['reuse_connection'] = True # need to work with table locks
@@ -8,9 +8,10 @@ class ReplicaCondition(Condition):
     def get_matching_blocks(self, replica):
         """If this is a block-level condition, return the list of matching block replicas."""
 
+        # block-level evaluations are counted by the policy line and stay out of the predicate statistics
         matching_blocks = []
         for block_replica in replica.block_replicas:
-            if self.match(block_replica):
+            if self._match(block_replica):
                 matching_blocks.append(block_replica)
 
         return matching_blocks
@@ -1,3 +1,4 @@
+import time
 import logging
 
 from dynamo.dataformat import ConfigurationError
@@ -74,10 +75,46 @@ class PolicyLine(object):
         # filled by history interface
         self.condition_id = 0
 
+        # Evaluation statistics (see set_profile)
+        self.profile = False
+        self.reset_stats()
+
     def __str__(self):
         return self.condition.text
 
+    def set_profile(self, value = True):
+        """
+        Turn on/off the collection of evaluation statistics for this line and its predicates.
+        """
+
+        self.profile = value
+        self.condition.profile = value
+
+    def reset_stats(self):
+        self.num_evaluated = 0
+        self.num_matched = 0
+        # number of block replicas examined / matched in block-level evaluations
+        self.num_block_evaluated = 0
+        self.num_block_matched = 0
+        self.time_spent = 0.
+
+        self.condition.reset_stats()
+
     def evaluate(self, replica):
+        if not self.profile:
+            return self._evaluate(replica)
+
+        start = time.time()
+        action = self._evaluate(replica)
+        self.time_spent += time.time() - start
+
+        self.num_evaluated += 1
+        if action is not None:
+            self.num_matched += 1
+
+        return action
+
+    def _evaluate(self, replica):
         action = None
 
         if self.condition.match(replica):
@@ -86,6 +123,11 @@ class PolicyLine(object):
             if issubclass(self.decision.action_cls, BlockAction):
                 # block-level
                 matching_block_replicas = self.condition.get_matching_blocks(replica)
+
+                if self.profile:
+                    self.num_block_evaluated += len(replica.block_replicas)
+                    self.num_block_matched += len(matching_block_replicas)
+
                 if len(matching_block_replicas) == len(replica.block_replicas):
                     # but all blocks matched - return dataset level
                     action = self.decision.action_cls.dataset_level(self)
@@ -106,6 +148,9 @@ class DetoxPolicy(object):
         # Iterative deletion can be turned off in specific policy files. When this is False,
         # Detox will finalize the delete and protect list in the first iteration.
         self.iterative_deletion = True
+
+        # Collect per-line and per-predicate evaluation statistics
+        self.profile = config.get('profile_policy', False)
         
         LOG.info('Reading the policy file.')
         with open(config.policy_file) as policy_def:
@@ -120,6 +165,10 @@ class DetoxPolicy(object):
                     if type(pred) is predicates.BinaryExpr and pred.variable.vtype == attrs.Attr.TIME_TYPE:
                         pred.rhs += config.time_shift * 24. * 3600.
 
+        if self.profile:
+            for line in self.policy_lines:
+                line.set_profile(True)
+
         # Check if the replicas can be deleted just before making the deletion requests.
         # Set to a function that takes a list of dataset replicas and removes from it
         # the replicas that should not be deleted.
@@ -246,3 +295,30 @@ class DetoxPolicy(object):
         replica.block_replicas.update(block_replicas_tmp)
         
         return actions
+
+    def reset_stats(self):
+        """
+        Zero the evaluation statistics of the policy lines. Called at the beginning of each cycle.
+        """
+
+        for line in self.policy_lines:
+            line.reset_stats()
+
+    def format_stats(self):
+        """
+        Format the evaluation statistics of the policy lines into a list of printable lines.
+        """
+
+        lines = []
+        lines.append('%4s %10s %10s %10s %10s %10s  %s' % ('line', 'evaluated', 'matched', 'blk_eval', 'blk_match', 'time (s)', 'condition'))
+
+        for iline, line in enumerate(self.policy_lines):
+            lines.append('%4d %10d %10d %10d %10d %10.3f  %s %s' % (iline, line.num_evaluated, line.num_matched,
+                line.num_block_evaluated, line.num_block_matched, line.time_spent,
+                line.decision.action_cls.__name__, line.condition.text))
+
+            for predicate, text in zip(line.condition.predicates, line.condition.predicate_texts):
+                lines.append('%4s %10d %10d %10s %10s %10.3f    %s' % ('', predicate.num_evaluated, predicate.num_matched,
+                    '', '', predicate.time_spent, text))
+
+        return lines
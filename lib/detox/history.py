@@ -1,9 +1,13 @@
 import os
+import sys
 import re
 import sqlite3
 import lzma
 import hashlib
+import json
 import logging
+import collections
+import threading
 
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.dataformat import Site
@@ -35,6 +39,12 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         self.snapshots_spool_dir = config.snapshots_spool_dir
         self.snapshots_archive_dir = config.snapshots_archive_dir
 
+        # Read / write size for streaming (de)compression of the archive
+        self.xz_chunk_size = config.get('xz_chunk_size', 16 * 1024 * 1024)
+
+        # Use LOAD DATA LOCAL INFILE to fill the replica snapshot tables (requires local_infile in db_params)
+        self.bulk_load = config.get('bulk_load', False)
+
     def get_cycles(self, partition, first = -1, last = -1):
         """
         Get a list of deletion cycles in range first <= cycle <= last. If first == -1, pick only the latest before last.
@@ -78,6 +88,9 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         @return {site_name:  (id, status, quota)}
         """
 
+        if self._use_archive(cycle_number, 'sites'):
+            return self._get_sites_from_archive(cycle_number, skip_unused)
+
         self._fill_snapshot_cache('sites', cycle_number)
 
         table_name = 'sites_%d' % cycle_number
@@ -107,6 +120,9 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
                 If size_only = False: a massive dict {site: [(dataset, size, decision, reason)]}
         """
 
+        if size_only and self._use_archive(cycle_number, 'replicas'):
+            return self._get_decision_sizes_from_archive(cycle_number, decisions)
+
         self._fill_snapshot_cache('replicas', cycle_number)
 
         table_name = 'replicas_%d' % cycle_number
@@ -171,6 +187,9 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
         @return  site-specific version of get_deletion_decisions with size_only = False
         """
 
+        if self._use_archive(cycle_number, 'replicas'):
+            return self._get_site_decisions_from_archive(cycle_number, site_name)
+
         self._fill_snapshot_cache('replicas', cycle_number)
 
         table_name = 'replicas_%d' % cycle_number
@@ -183,6 +202,113 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
 
         return self.db.query(query, site_name)
 
+    def _archive_file_name(self, cycle_number, suffix):
+        scycle = '%09d' % cycle_number
+        return '%s/%s/%s/snapshot_%09d%s' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6], cycle_number, suffix)
+
+    def _use_archive(self, cycle_number, template):
+        """
+        Decide whether to read the cycle data directly from the indexed archive instead of the cache tables.
+        Partition-level snapshots and cycles whose data is already in the cache are read from MySQL.
+        """
+
+        try:
+            cycle_number += 0
+        except TypeError:
+            return False
+
+        if self.db.table_exists('%s_%d' % (template, cycle_number), db = self.cache_db):
+            return False
+
+        return os.path.exists(self._archive_file_name(cycle_number, '.idx'))
+
+    def _read_archive_index(self, cycle_number):
+        with open(self._archive_file_name(cycle_number, '.idx')) as index_file:
+            return json.load(index_file)
+
+    def _read_archive_chunk(self, cycle_number, offset, length):
+        """
+        Decompress a single stream of the indexed archive and return an iterator over the split lines.
+        """
+
+        with open(self._archive_file_name(cycle_number, '.tsv.xz'), 'rb') as archive:
+            archive.seek(offset)
+            data = lzma.decompress(archive.read(length))
+
+        for line in data.split('\n'):
+            if line:
+                yield line.split('\t')
+
+    def _get_sites_from_archive(self, cycle_number, skip_unused):
+        index = self._read_archive_index(cycle_number)
+
+        site_data = []
+        for site_id, status, quota in self._read_archive_chunk(cycle_number, *index['sites']):
+            site_id = int(site_id)
+            if skip_unused and str(site_id) not in index['replicas']:
+                continue
+
+            site_data.append((site_id, status, int(quota)))
+
+        id_to_name = dict(self.db.select_many(MySQL.bare('`{0}`.`sites`'.format(self.history_db)), ('id', 'name'), 'id', [d[0] for d in site_data]))
+
+        sites_dict = {}
+        for site_id, status, quota in site_data:
+            sites_dict[id_to_name[site_id]] = (status, quota)
+
+        return sites_dict
+
+    def _get_decision_sizes_from_archive(self, cycle_number, decisions):
+        index = self._read_archive_index(cycle_number)
+
+        if type(decisions) is not list:
+            decisions = ['protect', 'delete', 'keep']
+
+        site_ids = [int(site_id) for site_id in index['replicas'].iterkeys()]
+        id_to_name = dict(self.db.select_many(MySQL.bare('`{0}`.`sites`'.format(self.history_db)), ('id', 'name'), 'id', site_ids))
+
+        product = {}
+        for site_id, (_, _, sizes) in index['replicas'].iteritems():
+            # same as the SQL version - list the site only if it has some volume in the requested decisions
+            if not any(d in sizes for d in decisions):
+                continue
+
+            v = {}
+            for decision in ['protect', 'delete', 'keep']:
+                if decision in decisions:
+                    v[decision] = sizes.get(decision, 0) * 1.e-12
+                else:
+                    v[decision] = 0
+
+            product[id_to_name[int(site_id)]] = (v['protect'], v['delete'], v['keep'])
+
+        return product
+
+    def _get_site_decisions_from_archive(self, cycle_number, site_name):
+        index = self._read_archive_index(cycle_number)
+
+        result = self.db.query('SELECT `id` FROM `{0}`.`sites` WHERE `name` = %s'.format(self.history_db), site_name)
+        if len(result) == 0:
+            return []
+
+        try:
+            offset, length, _ = index['replicas'][str(result[0])]
+        except KeyError:
+            return []
+
+        entries = []
+        for dataset_id, size, decision, condition_id in self._read_archive_chunk(cycle_number, offset, length):
+            entries.append((int(dataset_id), int(size), decision, int(condition_id)))
+
+        dataset_names = dict(self.db.select_many(MySQL.bare('`{0}`.`datasets`'.format(self.history_db)), ('id', 'name'), 'id', set(e[0] for e in entries)))
+        condition_texts = dict(self.db.select_many(MySQL.bare('`{0}`.`policy_conditions`'.format(self.history_db)), ('id', 'text'), 'id', set(e[3] for e in entries)))
+
+        product = []
+        for dataset_id, size, decision, condition_id in sorted(entries, key = lambda e: e[1], reverse = True):
+            product.append((dataset_names[dataset_id], size, decision, condition_id, condition_texts.get(condition_id)))
+
+        return product
+
     def _fill_snapshot_cache(self, template, cycle_number):
         self.db.use_db(self.cache_db)
 
@@ -208,14 +334,26 @@ class DetoxHistoryBase(DeletionHistoryDatabase):
                     except OSError:
                         pass
 
-                    scycle = '%09d' % cycle_number
-                    xz_file_name = '%s/%s/%s/snapshot_%09d.db.xz' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6], cycle_number)
+                    xz_file_name = self._archive_file_name(cycle_number, '.db.xz')
                     if not os.path.exists(xz_file_name):
                         raise RuntimeError('Archived snapshot DB ' + xz_file_name + ' does not exist')
     
+                    # decompress in chunks to avoid loading the full file into memory
                     with open(xz_file_name, 'rb') as xz_file:
                         with open(db_file_name, 'wb') as db_file:
-                            db_file.write(lzma.decompress(xz_file.read()))
+                            decompressor = lzma.LZMADecompressor()
+                            while True:
+                                chunk = xz_file.read(self.xz_chunk_size)
+                                if not chunk:
+                                    break
+
+                                db_file.write(decompressor.decompress(chunk))
+
+                            try:
+                                db_file.write(decompressor.flush())
+                            except AttributeError:
+                                # not all lzma implementations have flush()
+                                pass
 
             else:
                 db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
@@ -384,6 +522,30 @@ class DetoxHistory(DetoxHistoryBase):
             else:
                 line.condition_id = ids[0]
 
+    def save_policy_stats(self, cycle_number, policy_lines):
+        """
+        Save the evaluation statistics of the policy lines. Condition ids must be set (see save_conditions).
+        @param cycle_number  Cycle number
+        @param policy_lines  List of PolicyLine objects
+        """
+
+        if self._read_only:
+            return
+
+        fields = ('cycle_id', 'line', 'condition_id', 'num_evaluated', 'num_matched', 'num_block_evaluated', 'num_block_matched', 'time')
+        mapping = lambda (iline, line): (cycle_number, iline, line.condition_id, line.num_evaluated, line.num_matched, \
+                                         line.num_block_evaluated, line.num_block_matched, line.time_spent)
+        self.db.insert_many('deletion_policy_line_stats', fields, mapping, enumerate(policy_lines), do_update = True)
+
+        def predicate_entry():
+            for iline, line in enumerate(policy_lines):
+                condition = line.condition
+                for ipred, (predicate, text) in enumerate(zip(condition.predicates, condition.predicate_texts)):
+                    yield (cycle_number, iline, ipred, text, predicate.num_evaluated, predicate.num_matched, predicate.time_spent)
+
+        fields = ('cycle_id', 'line', 'predicate', 'text', 'num_evaluated', 'num_matched', 'time')
+        self.db.insert_many('deletion_policy_predicate_stats', fields, None, predicate_entry(), do_update = True)
+
     def save_cycle_state(self, cycle_number, deleted_list, kept_list, protected_list, quotas):
         """
         Save decisions and their reasons for all replicas.
@@ -400,110 +562,139 @@ class DetoxHistory(DetoxHistoryBase):
         if self._read_only:
             return
 
-        self.save_sites([s.name for s in quotas.iterkeys()])
-
+        site_names = set(s.name for s in quotas.iterkeys())
         datasets = set()
-        for replica, matches in deleted_list.iteritems():
-            datasets.add(replica.dataset.name)
-        for replica, matches in kept_list.iteritems():
-            datasets.add(replica.dataset.name)
-        for replica, matches in protected_list.iteritems():
-            datasets.add(replica.dataset.name)
+        for entries in [deleted_list, kept_list, protected_list]:
+            for replica in entries.iterkeys():
+                site_names.add(replica.site.name)
+                datasets.add(replica.dataset.name)
 
+        self.save_sites(site_names)
         self.save_datasets(datasets)
-    
-        reuse = self.db.reuse_connection
-        self.db.reuse_connection = True
 
-        self.db.use_db(self.cache_db)
+        # Resolve the names to ids here so that the MySQL and SQLite snapshots can be filled directly
+        site_id_map = dict(self.db.select_many('sites', ('name', 'id'), 'name', site_names))
+        dataset_id_map = dict(self.db.select_many('datasets', ('name', 'id'), 'name', datasets))
 
-        ## Replica state (deletion decisions)
-
-        # Insert full data into a temporary table with site and dataset names
-        tmp_table = 'replicas_tmp'
-        columns = [
-            '`site` varchar(32) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`dataset` varchar(512) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`size` bigint(20) unsigned NOT NULL',
-            '`decision` enum(\'delete\',\'keep\',\'protect\') CHARACTER SET latin1 COLLATE latin1_general_ci NOT NULL',
-            '`condition` int(10) unsigned NOT NULL',
-            'KEY `site_dataset` (`site`,`dataset`)'
-        ]
-        self.db.create_tmp_table(tmp_table, columns)
-
-        def replica_entry(entries, decision):
+        replica_rows = []
+        for entries, decision in [(deleted_list, 'delete'), (kept_list, 'keep'), (protected_list, 'protect')]:
             for replica, matches in entries.iteritems():
-                site_name = replica.site.name
-                dataset_name = replica.dataset.name
+                site_id = site_id_map[replica.site.name]
+                dataset_id = dataset_id_map[replica.dataset.name]
                 for condition_id, block_replicas in matches.iteritems():
                     size = sum(r.size for r in block_replicas)
-                    yield (site_name, dataset_name, size, decision, condition_id)
+                    replica_rows.append((site_id, dataset_id, size, decision, condition_id))
+
+        site_rows = []
+        for site, quota in quotas.iteritems():
+            site_rows.append((site_id_map[site.name], site.status, int(round(quota))))
+
+        ## Start filling the SQLite file in parallel with the MySQL snapshot tables
+        try:
+            cycle_number += 0
+        except TypeError:
+            # cycle_number is actually the partition name
+            db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
+            is_cycle = False
+        else:
+            # Saving quotas during a cycle
+            db_file_name = '%s/snapshot_%09d.db' % (self.snapshots_spool_dir, cycle_number)
+            is_cycle = True
+
+        # Get the decision value to name mapping from MySQL information_schema
+        # This is just a fancy way to arrive at a list [(1, 'delete'), (2, 'keep'), (3, 'protect')]
+        enum = self.db.query('SELECT `COLUMN_TYPE` FROM `information_schema`.`COLUMNS` WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = \'replicas\' AND `COLUMN_NAME` = \'decision\'', self.cache_db)[0]
+        # "enum('delete','keep','protect')" -> ['delete', 'keep', 'protect']
+        values = map(lambda s: s.replace("'", '').replace('"', ''), enum[5:-1].split(','))
+        decision_mapping = []
+        for idec, decision in enumerate(values):
+            # MySQL enum starts at 1
+            decision_mapping.append((idec + 1, decision))
 
-        fields = ('site', 'dataset', 'size', 'decision', 'condition')
-        self.db.insert_many(tmp_table, fields, None, replica_entry(deleted_list, 'delete'), do_update = False, db = self.db.scratch_db)
-        self.db.insert_many(tmp_table, fields, None, replica_entry(kept_list, 'keep'), do_update = False, db = self.db.scratch_db)
-        self.db.insert_many(tmp_table, fields, None, replica_entry(protected_list, 'protect'), do_update = False, db = self.db.scratch_db)
+        sqlite_errors = []
+        def write_sqlite():
+            try:
+                self._write_snapshot_db(db_file_name, decision_mapping, replica_rows, site_rows)
+            except:
+                sqlite_errors.append(sys.exc_info())
 
-        # Make a snapshot table
-        replica_table_name = 'replicas_%s' % cycle_number
+        sqlite_thread = threading.Thread(target = write_sqlite, name = 'DetoxSnapshot')
+        sqlite_thread.start()
 
-        if self.db.table_exists(replica_table_name):
-            self.db.query('DROP TABLE `{0}`'.format(replica_table_name))
+        try:
+            self.db.use_db(self.cache_db)
 
-        self.db.query('CREATE TABLE `{0}` LIKE `replicas`'.format(replica_table_name))
+            ## Replica state (deletion decisions)
+            replica_table_name = 'replicas_%s' % cycle_number
 
-        # Then use insert select join to convert the names to ids
-        sql = 'INSERT INTO `{0}` (`site_id`, `dataset_id`, `size`, `decision`, `condition`)'.format(replica_table_name)
-        sql += ' SELECT s.`id`, d.`id`, r.`size`, r.`decision`, r.`condition` FROM `{0}`.`{1}` AS r'.format(self.db.scratch_db, tmp_table)
-        sql += ' INNER JOIN `{0}`.`sites` AS s ON s.`name` = r.`site`'.format(self.history_db)
-        sql += ' INNER JOIN `{0}`.`datasets` AS d ON d.`name` = r.`dataset`'.format(self.history_db)
-        self.db.query(sql)
+            if self.db.table_exists(replica_table_name):
+                self.db.query('DROP TABLE `{0}`'.format(replica_table_name))
 
-        self.db.drop_tmp_table(tmp_table)
+            self.db.query('CREATE TABLE `{0}` LIKE `replicas`'.format(replica_table_name))
 
-        ## Site state (status and quotas)
+            fields = ('site_id', 'dataset_id', 'size', 'decision', 'condition')
+            if self.bulk_load:
+                self.db.load_many(replica_table_name, fields, None, replica_rows)
+            else:
+                self.db.insert_many(replica_table_name, fields, None, replica_rows, do_update = False)
 
-        # Insert full data into a temporary table with site info
-        tmp_table = 'sites_tmp'
-        columns = [
-            '`site` varchar(32) CHARACTER SET latin1 COLLATE latin1_general_cs NOT NULL',
-            '`status` enum(\'ready\',\'waitroom\',\'morgue\',\'unknown\') CHARACTER SET latin1 COLLATE latin1_general_ci NOT NULL',
-            '`quota` int(10) NOT NULL',
-            'KEY `site` (`site`)'
-        ]
-        self.db.create_tmp_table(tmp_table, columns)
+            ## Site state (status and quotas)
+            site_table_name = 'sites_%s' % cycle_number
 
-        fields = ('site', 'status', 'quota')
-        mapping = lambda (site, quota): (site.name, site.status, quota)
-        self.db.insert_many(tmp_table, fields, mapping, quotas.iteritems(), do_update = False, db = self.db.scratch_db)
+            if self.db.table_exists(site_table_name):
+                self.db.query('DROP TABLE `{0}`'.format(site_table_name))
 
-        # Make a snapshot table
-        site_table_name = 'sites_%s' % cycle_number
+            self.db.query('CREATE TABLE `{0}` LIKE `sites`'.format(site_table_name))
 
-        if self.db.table_exists(site_table_name):
-            self.db.query('DROP TABLE `{0}`'.format(site_table_name))
+            fields = ('site_id', 'status', 'quota')
+            self.db.insert_many(site_table_name, fields, None, site_rows, do_update = False)
 
-        self.db.query('CREATE TABLE `{0}` LIKE `sites`'.format(site_table_name))
+        finally:
+            sqlite_thread.join()
 
-        # Then use insert select join to convert the names to ids
-        sql = 'INSERT INTO `{0}` (`site_id`, `status`, `quota`)'.format(site_table_name)
-        sql += ' SELECT s.`id`, t.`status`, t.`quota` FROM `{0}`.`{1}` AS t'.format(self.db.scratch_db, tmp_table)
-        sql += ' INNER JOIN `{0}`.`sites` AS s ON s.`name` = t.`site`'.format(self.history_db)
-        self.db.query(sql)
+        if len(sqlite_errors) != 0:
+            exc_type, exc_value, exc_tb = sqlite_errors[0]
+            raise exc_type, exc_value, exc_tb
 
-        self.db.drop_tmp_table(tmp_table)
+        if is_cycle:
+            # This was a numbered cycle
+            # Archive the sqlite3 file
+            xz_file_name = self._archive_file_name(cycle_number, '.db.xz')
+    
+            try:
+                os.makedirs(os.path.dirname(xz_file_name))
+            except OSError:
+                pass
+    
+            with open(db_file_name, 'rb') as db_file:
+                with open(xz_file_name, 'wb') as xz_file:
+                    compressor = lzma.LZMACompressor()
+                    while True:
+                        chunk = db_file.read(self.xz_chunk_size)
+                        if not chunk:
+                            break
 
-        ## Now transfer data to an SQLite file
-        try:
-            cycle_number += 0
-        except TypeError:
-            # cycle_number is actually the partition name
-            db_file_name = '%s/snapshot_%s.db' % (self.snapshots_spool_dir, cycle_number)
-            is_cycle = False
-        else:
-            # Saving quotas during a cycle
-            db_file_name = '%s/snapshot_%09d.db' % (self.snapshots_spool_dir, cycle_number)
-            is_cycle = True
+                        xz_file.write(compressor.compress(chunk))
+
+                    xz_file.write(compressor.flush())
+
+            # Also write the per-site indexed archive used for direct lookups
+            self._write_snapshot_archive(cycle_number, replica_rows, site_rows)
+
+            self._update_cache_usage('replicas', cycle_number)
+            self._update_cache_usage('sites', cycle_number)
+
+        # Finally restore the history DB
+        self.db.use_db(self.history_db)
+
+    def _write_snapshot_db(self, db_file_name, decision_mapping, replica_rows, site_rows):
+        """
+        Write the SQLite snapshot file in a single transaction.
+        @param db_file_name      Path to the SQLite file.
+        @param decision_mapping  [(decision_id, decision)]
+        @param replica_rows      [(site_id, dataset_id, size, decision, condition)]
+        @param site_rows         [(site_id, status, quota)]
+        """
 
         try:
             os.makedirs(self.snapshots_spool_dir)
@@ -517,36 +708,25 @@ class DetoxHistory(DetoxHistoryBase):
         LOG.info('Creating snapshot SQLite3 DB %s', db_file_name)
 
         snapshot_db = sqlite3.connect(db_file_name)
-        snapshot_cursor = snapshot_db.cursor()
+        # Bulk write into a fresh file - no need for journaling
+        snapshot_db.execute('PRAGMA journal_mode = OFF')
+        snapshot_db.execute('PRAGMA synchronous = OFF')
 
         # Make enum mapping tables
-        # Get the decision value to name mapping from MySQL information_schema
-        # This is just a fancy way to arrive at a list [(1, 'delete'), (2, 'keep'), (3, 'protect')]
-        enum = self.db.query('SELECT `COLUMN_TYPE` FROM `information_schema`.`COLUMNS` WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = \'replicas\' AND `COLUMN_NAME` = \'decision\'', self.cache_db)[0]
-        # "enum('delete','keep','protect')" -> ['delete', 'keep', 'protect']
-        values = map(lambda s: s.replace("'", '').replace('"', ''), enum[5:-1].split(','))
-        decision_mapping = []
-        for idec, decision in enumerate(values):
-            # MySQL enum starts at 1
-            decision_mapping.append((idec + 1, decision))
-
         sql = 'CREATE TABLE `decisions` ('
         sql += '`id` TINYINT PRIMARY KEY NOT NULL,'
         sql += '`value` TEXT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        for value, name in decision_mapping:
-            snapshot_db.execute('INSERT INTO `decisions` VALUES (?, ?)', (value, name))
+        snapshot_db.executemany('INSERT INTO `decisions` VALUES (?, ?)', decision_mapping)
 
         sql = 'CREATE TABLE `statuses` ('
         sql += '`id` TINYINT PRIMARY KEY NOT NULL,'
         sql += '`value` TEXT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'ready\')' % Site.STAT_READY)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'waitroom\')' % Site.STAT_WAITROOM)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'morgue\')' % Site.STAT_MORGUE)
-        snapshot_db.execute('INSERT INTO `statuses` VALUES (%d, \'unknown\')' % Site.STAT_UNKNOWN)
+        statuses = [(Site.STAT_READY, 'ready'), (Site.STAT_WAITROOM, 'waitroom'), (Site.STAT_MORGUE, 'morgue'), (Site.STAT_UNKNOWN, 'unknown')]
+        snapshot_db.executemany('INSERT INTO `statuses` VALUES (?, ?)', statuses)
 
         # Fill in the replica states
         sql = 'CREATE TABLE `replicas` ('
@@ -557,14 +737,13 @@ class DetoxHistory(DetoxHistoryBase):
         sql += '`condition` MEDIUMINT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-        snapshot_db.execute('CREATE INDEX `site_dataset` ON `replicas` (`site_id`, `dataset_id`)')
 
-        sql = 'INSERT INTO `replicas` VALUES (?, ?, ?, ?, ?)'
+        decision_ids = dict((name, value) for value, name in decision_mapping)
+        mapping = lambda (site_id, dataset_id, size, decision, condition_id): (site_id, dataset_id, size, decision_ids[decision], condition_id)
+        snapshot_db.executemany('INSERT INTO `replicas` VALUES (?, ?, ?, ?, ?)', (mapping(row) for row in replica_rows))
 
-        for entry in self.db.xquery('SELECT `site_id`, `dataset_id`, `size`, 0+`decision`, `condition` FROM `{0}`'.format(replica_table_name)):
-            snapshot_cursor.execute(sql, entry)
-
-        snapshot_db.commit()
+        # Index after the bulk insert
+        snapshot_db.execute('CREATE INDEX `site_dataset` ON `replicas` (`site_id`, `dataset_id`)')
 
         # Fill in the site states
         sql = 'CREATE TABLE `sites` ('
@@ -573,42 +752,51 @@ class DetoxHistory(DetoxHistoryBase):
         sql += '`quota` INT NOT NULL'
         sql += ')'
         snapshot_db.execute(sql)
-
-        sql = 'INSERT INTO `sites` VALUES (?, ?, ?)'
-
-        for entry in self.db.xquery('SELECT `site_id`, 0+`status`, `quota` FROM `{0}`'.format(site_table_name)):
-            snapshot_cursor.execute(sql, entry)
+        snapshot_db.executemany('INSERT INTO `sites` VALUES (?, ?, ?)', site_rows)
 
         snapshot_db.commit()
 
         # Close the sqlite file
-        snapshot_cursor.close()
         snapshot_db.close()
 
-        if is_cycle:
-            # This was a numbered cycle
-            # Archive the sqlite3 file
-    
-            scycle = '%09d' % cycle_number
-            archive_dir_name = '%s/%s/%s' % (self.snapshots_archive_dir, scycle[:3], scycle[3:6])
-            xz_file_name = '%s/snapshot_%09d.db.xz' % (archive_dir_name, cycle_number)
-    
-            try:
-                os.makedirs(archive_dir_name)
-            except OSError:
-                pass
-    
-            with open(db_file_name, 'rb') as db_file:
-                with open(xz_file_name, 'wb') as xz_file:
-                    xz_file.write(lzma.compress(db_file.read()))
+    def _write_snapshot_archive(self, cycle_number, replica_rows, site_rows):
+        """
+        Write the indexed archive of the cycle. The archive (.tsv.xz) is a concatenation of independent xz
+        streams, one for the site states and one per site for the replica decisions. The index (.idx) is a
+        JSON file with the offset and length of each stream, and the decision volume sums for each site.
+        @param cycle_number      Cycle number.
+        @param replica_rows      [(site_id, dataset_id, size, decision, condition)]
+        @param site_rows         [(site_id, status, quota)]
+        """
 
-            self._update_cache_usage('replicas', cycle_number)
-            self._update_cache_usage('sites', cycle_number)
+        archive_file_name = self._archive_file_name(cycle_number, '.tsv.xz')
+        index_file_name = self._archive_file_name(cycle_number, '.idx')
 
-        # Finally restore the history DB
-        self.db.use_db(self.history_db)
+        replicas_by_site = collections.defaultdict(list)
+        for site_id, dataset_id, size, decision, condition_id in replica_rows:
+            replicas_by_site[site_id].append((dataset_id, size, decision, condition_id))
+
+        index = {'sites': None, 'replicas': {}}
+
+        with open(archive_file_name, 'wb') as archive:
+            def write_stream(rows):
+                offset = archive.tell()
+                archive.write(lzma.compress(''.join('\t'.join(str(v) for v in row) + '\n' for row in rows)))
+                return [offset, archive.tell() - offset]
+
+            index['sites'] = write_stream((site_id, Site.status_name(status), quota) for site_id, status, quota in site_rows)
+
+            for site_id in sorted(replicas_by_site.iterkeys()):
+                rows = replicas_by_site[site_id]
+
+                sizes = collections.defaultdict(int)
+                for _, size, decision, _ in rows:
+                    sizes[decision] += size
+
+                index['replicas'][str(site_id)] = write_stream(rows) + [sizes]
 
-        self.db.reuse_connection = reuse
+        with open(index_file_name, 'w') as index_file:
+            json.dump(index, index_file)
 
     def make_cycle_entry(self, cycle_number, site):
         history_record = self.make_entry(site.name)
@@ -68,6 +68,9 @@ class Detox(object):
         self.history.save_conditions(self.policy.policy_lines)
 
         LOG.info('Applying policy to replicas.')
+        if self.policy.profile:
+            self.policy.reset_stats()
+
         deleted, kept, protected, reowned = self._execute_policy(partition_repository)
 
         partition = partition_repository.partitions[self.policy.partition_name]
@@ -76,6 +79,10 @@ class Detox(object):
         LOG.info('Saving deletion decisions and site states.')
         self.history.save_cycle_state(cycle_tag, deleted, kept, protected, quotas)
 
+        if create_cycle and self.policy.profile:
+            LOG.info('Saving policy evaluation statistics.')
+            self.history.save_policy_stats(cycle_tag, self.policy.policy_lines)
+
         if create_cycle:
             LOG.info('Committing deletion.')
             comment = 'Dynamo -- Automatic cache release request for %s partition.' % self.policy.partition_name
@@ -481,6 +488,11 @@ class Detox(object):
             if not line.has_match:
                 LOG.warning('Policy %s had no matching replica.' % str(line))
 
+        if self.policy.profile:
+            LOG.info('Policy evaluation statistics:')
+            for stat_line in self.policy.format_stats():
+                LOG.info(stat_line)
+
         # Do a last-minute check whether we can really delete these replicas
 #        if policy.predelete_check is not None:
 #            policy.predelete_check(list_chunk)
@@ -74,6 +74,17 @@ class FileDeletionQuery(FileQuery):
         """
         raise NotImplementedError('get_deletion_status')
 
+    def get_deletion_status_many(self, batch_ids):
+        """
+        Query the external agent about tasks in multiple batches. Plugins that can query the agent
+        concurrently should override this method and yield the results as they become available.
+        @param batch_ids  List of integer ids of the deletion task batches.
+
+        @return  Iterator of (batch_id, [(task_id, status, exit code, message, start time (UNIX), finish time (UNIX))])
+        """
+        for batch_id in batch_ids:
+            yield batch_id, self.get_deletion_status(batch_id)
+
     def write_deletion_history(self, history_db, task_id, history_id):
         """
         Enter whatever specific information this plugin has to the history DB.
@@ -83,6 +94,16 @@ class FileDeletionQuery(FileQuery):
         """
         raise NotImplementedError('write_deletion_history')
 
+    def write_deletion_histories(self, history_db, task_history_ids):
+        """
+        Batched version of write_deletion_history. Plugins that can write the history of a whole batch
+        at once should override this method.
+        @param history_db        HistoryDatabase instance
+        @param task_history_ids  List of (deletion task id, ID in the history file_deletions table)
+        """
+        for task_id, history_id in task_history_ids:
+            self.write_deletion_history(history_db, task_id, history_id)
+
     def forget_deletion_status(self, task_id):
         """
         Delete the internal record (if there is any) of the specific task.
@@ -90,6 +111,14 @@ class FileDeletionQuery(FileQuery):
         """
         raise NotImplementedError('fotget_deletion_status')
 
+    def forget_deletion_statuses(self, task_ids):
+        """
+        Batched version of forget_deletion_status.
+        @param task_ids  List of integer ids of the deletion tasks.
+        """
+        for task_id in task_ids:
+            self.forget_deletion_status(task_id)
+
     def forget_deletion_batch(self, batch_id):
         """
         Delete the internal record (if there is any) of the specific batch.
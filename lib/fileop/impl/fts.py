@@ -6,6 +6,8 @@ import collections
 import json
 import logging
 import errno
+import heapq
+import threading
 
 import fts3.rest.client.easy as fts3
 from fts3.rest.client.request import Request
@@ -16,7 +18,8 @@ from dynamo.fileop.transfer import FileTransferOperation, FileTransferQuery
 from dynamo.fileop.deletion import FileDeletionOperation, FileDeletionQuery
 from dynamo.fileop.errors import find_msg_code
 from dynamo.utils.interface.mysql import MySQL
-from dynamo.dataformat import Site
+from dynamo.utils.parallel import Map
+from dynamo.dataformat import Configuration, ConfigurationError, Site
 
 LOG = logging.getLogger(__name__)
 
@@ -31,7 +34,33 @@ class ResetDroppedConnectionFilter(object):
 fts_connection_logger = logging.getLogger('requests.packages.urllib3.connectionpool')
 fts_connection_logger.addFilter(ResetDroppedConnectionFilter())
 
+class RateLimiter(object):
+    """
+    Spaces out calls so that at most max_rate calls are made per second. Thread-safe.
+    """
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self._next_time = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.max_rate <= 0:
+            return
+
+        with self._lock:
+            now = time.time()
+            if self._next_time > now:
+                time.sleep(self._next_time - now)
+                now = self._next_time
+
+            self._next_time = now + 1. / self.max_rate
+
 class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOperation, FileDeletionQuery):
+    # Rate limiters shared by all instances talking to the same server
+    _rate_limiters = {}
+    _rate_limiters_lock = threading.Lock()
+
     def __init__(self, config):
         FileTransferOperation.__init__(self, config)
         FileTransferQuery.__init__(self, config)
@@ -56,52 +85,51 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
         # Reuse the context object
         self.keep_context = config.get('keep_context', True)
         self._context = None
+        # Status queries call FTS from multiple threads
+        self._context_lock = threading.Lock()
+
+        # Batching strategy
+        #  fixed: chunks of batch_size tasks in the order given
+        #  link: one batch per (source, destination, source storage type) link (per site for deletions),
+        #        balanced in file count and bytes, with the links interleaved in the output
+        self.batching = config.get('batching', 'fixed')
+        if self.batching not in ('fixed', 'link'):
+            raise ConfigurationError('Unknown batching strategy %s' % self.batching)
+
+        # Maximum total bytes in a batch when batching = link (0 = unlimited). Only a single file larger than
+        # the limit can make a batch exceed it.
+        self.batch_max_bytes = config.get('batch_max_bytes', 0)
+
+        # Pending task counts are taken from the bookkeeping tables and reconciled with the FTS server
+        # at this interval (seconds). The excess found on the server at reconciliation (e.g. jobs submitted by
+        # other clients) is carried over as an offset. 0 = never reconcile.
+        self.pending_reconcile_interval = config.get('pending_reconcile_interval', 3600)
+        self._pending_offset = {'transfer': 0, 'deletion': 0}
+        self._last_reconcile = {'transfer': 0., 'deletion': 0.}
+
+        # Number of job status queries run in parallel
+        self.status_query_threads = config.get('status_query_threads', 8)
+
+        # Maximum number of calls per second to the server (0 = unlimited)
+        with FTSFileOperation._rate_limiters_lock:
+            try:
+                self._rate_limiter = FTSFileOperation._rate_limiters[self.server_url]
+            except KeyError:
+                self._rate_limiter = FTSFileOperation._rate_limiters[self.server_url] = RateLimiter(config.get('max_call_rate', 0))
 
     def num_pending_transfers(self): #override
-        # Check the number of files in queue
-        # We first thought about counting files with /files, but FTS seems to return only 1000 maximum even when "limit" is set much larger
-        #files = self._ftscallurl('/files?state_in=ACTIVE,SUBMITTED,READY&limit=%d' % self.max_pending_transfers)
-        #return len(files)
-
-        num_pending = 0
-        file_states = ['SUBMITTED', 'READY', 'ACTIVE', 'STAGING', 'STARTED']
-
-        jobs = self._ftscall('list_jobs', state_in = ['SUBMITTED', 'ACTIVE', 'STAGING'])
-        for job in jobs:
-            job_info = self._ftscall('get_job_status', job['job_id'], list_files = True)
-            for file_info in job_info['files']:
-                if file_info['file_state'] in file_states:
-                    num_pending += 1
-                    if num_pending == self.max_pending_transfers + 1:
-                        # don't need to query more
-                        return num_pending
-
-        return num_pending
+        return self._num_pending('transfer')
 
     def num_pending_deletions(self): #override
-        # See above
-        #files = self._ftscallurl('/files?state_in=ACTIVE,SUBMITTED,READY&limit=%d' % self.max_pending_deletions)
-        #return len(files)
-
-        num_pending = 0
-        file_states = ['SUBMITTED', 'READY', 'ACTIVE']
-
-        jobs = self._ftscall('list_jobs', state_in = ['SUBMITTED', 'ACTIVE'])
-        for job in jobs:
-            job_info = self._ftscall('get_job_status', job['job_id'], list_files = True)
-            for file_info in job_info['dm']:
-                if file_info['file_state'] in file_states:
-                    num_pending += 1
-                    if num_pending == self.max_pending_deletions + 1:
-                        # don't need to query more
-                        return num_pending
-
-        return num_pending
+        return self._num_pending('deletion')
 
     def form_batches(self, tasks): #override
         if len(tasks) == 0:
             return []
 
+        if self.batching == 'link':
+            return self._form_link_batches(tasks)
+
         # FTS3 has no restriction on how to group the transfers, but cannot apparently take thousands
         # of tasks at once
         batches = [[]]
@@ -250,46 +278,60 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
         self.db.query(sql)
 
     def get_transfer_status(self, batch_id): #override
+        for _, results in self.get_transfer_status_many([batch_id]):
+            return results
+
+        return []
+
+    def get_transfer_status_many(self, batch_ids): #override
         if self.server_id == 0:
             self._set_server_id()
 
-        results = self._get_status(batch_id, 'transfer')
+        for batch_id, results_by_type in self._get_status_many(batch_ids, 'transfer'):
+            results = results_by_type.get('transfer', [])
 
-        staged_tasks = []
+            staged_tasks = []
 
-        for task_id, status, exitcode, msg, start_time, finish_time in self._get_status(batch_id, 'staging'):
-            if status == FileQuery.STAT_DONE:
-                staged_tasks.append(task_id)
-                results.append((task_id, FileQuery.STAT_QUEUED, -1, None, None, None))
-            else:
-                # these tasks won't appear in results from _get_status('transfer')
-                # because no transfer jobs have been submitted yet
-                results.append((task_id, status, exitcode, None, start_time, finish_time))
+            for task_id, status, exitcode, msg, start_time, finish_time in results_by_type.get('staging', []):
+                if status == FileQuery.STAT_DONE:
+                    staged_tasks.append(task_id)
+                    results.append((task_id, FileQuery.STAT_QUEUED, -1, None, None, None))
+                else:
+                    # these tasks won't appear in results from _get_status('transfer')
+                    # because no transfer jobs have been submitted yet
+                    results.append((task_id, status, exitcode, None, start_time, finish_time))
+
+            if len(staged_tasks) != 0:
+                transfers = []
+                pfn_to_tid = {}
+                for task_id, source_pfn, dest_pfn, checksum, filesize in self.db.select_many('fts_staging_queue', ('id', 'source', 'destination', 'checksum', 'size'), 'id', staged_tasks):
+                    transfers.append(fts3.new_transfer(source_pfn, dest_pfn, checksum = checksum, filesize = filesize))
+                    pfn_to_tid[dest_pfn] = task_id
+
+                if self.checksum_algorithm:
+                    verify_checksum = 'target'
+                else:
+                    verify_checksum = None
 
-        if len(staged_tasks) != 0:
-            transfers = []
-            pfn_to_tid = {}
-            for task_id, source_pfn, dest_pfn, checksum, filesize in self.db.select_many('fts_staging_queue', ('id', 'source', 'destination', 'checksum', 'size'), 'id', staged_tasks):
-                transfers.append(fts3.new_transfer(source_pfn, dest_pfn, checksum = checksum, filesize = filesize))
-                pfn_to_tid[dest_pfn] = task_id
+                job = fts3.new_job(transfers, retry = self.fts_retry, overwrite = False, verify_checksum = verify_checksum, metadata = self.metadata_string)
+                success = self._submit_job(job, 'transfer', batch_id, pfn_to_tid)
+                if success and not self._read_only:
+                    self.db.delete_many('fts_staging_queue', 'id', pfn_to_tid.values())
 
-            if self.checksum_algorithm:
-                verify_checksum = 'target'
-            else:
-                verify_checksum = None
+            yield batch_id, results
 
-            job = fts3.new_job(transfers, retry = self.fts_retry, overwrite = False, verify_checksum = verify_checksum, metadata = self.metadata_string)
-            success = self._submit_job(job, 'transfer', batch_id, pfn_to_tid)
-            if success and not self._read_only:
-                self.db.delete_many('fts_staging_queue', 'id', pfn_to_tid.values())
+    def get_deletion_status(self, batch_id): #override
+        for _, results in self.get_deletion_status_many([batch_id]):
+            return results
 
-        return results
+        return []
 
-    def get_deletion_status(self, batch_id): #override
+    def get_deletion_status_many(self, batch_ids): #override
         if self.server_id == 0:
             self._set_server_id()
 
-        return self._get_status(batch_id, 'deletion')
+        for batch_id, results_by_type in self._get_status_many(batch_ids, 'deletion'):
+            yield batch_id, results_by_type.get('deletion', [])
 
     def write_transfer_history(self, history_db, task_id, history_id): #override
         self._write_history(history_db, task_id, history_id, 'transfer')
@@ -297,18 +339,142 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
     def write_deletion_history(self, history_db, task_id, history_id): #override
         self._write_history(history_db, task_id, history_id, 'deletion')
 
+    def write_transfer_histories(self, history_db, task_history_ids): #override
+        self._write_histories(history_db, task_history_ids, 'transfer')
+
+    def write_deletion_histories(self, history_db, task_history_ids): #override
+        self._write_histories(history_db, task_history_ids, 'deletion')
+
     def forget_transfer_status(self, task_id): #override
         return self._forget_status(task_id, 'transfer')
 
     def forget_deletion_status(self, task_id): #override
         return self._forget_status(task_id, 'deletion')
 
+    def forget_transfer_statuses(self, task_ids): #override
+        return self._forget_statuses(task_ids, 'transfer')
+
+    def forget_deletion_statuses(self, task_ids): #override
+        return self._forget_statuses(task_ids, 'deletion')
+
     def forget_transfer_batch(self, task_id): #override
         return self._forget_batch(task_id, 'transfer')
 
     def forget_deletion_batch(self, task_id): #override
         return self._forget_batch(task_id, 'deletion')
 
+    def _form_link_batches(self, tasks):
+        by_link = collections.defaultdict(list)
+
+        for task in tasks:
+            if hasattr(task, 'subscription'):
+                # staging and disk transfers end up in different FTS jobs anyway
+                link = (task.source, task.subscription.destination, task.source.storage_type == Site.TYPE_MSS)
+            else:
+                link = (task.desubscription.site,)
+
+            by_link[link].append(task)
+
+        def task_size(task):
+            if hasattr(task, 'subscription'):
+                return task.subscription.file.size
+            else:
+                return task.desubscription.file.size
+
+        link_batches = []
+
+        for link_tasks in by_link.itervalues():
+            num_batches = (len(link_tasks) - 1) / self.batch_size + 1
+            if self.batch_max_bytes > 0:
+                total_size = sum(task_size(t) for t in link_tasks)
+                num_batches = max(num_batches, (total_size - 1) / self.batch_max_bytes + 1)
+
+            batches = [[] for _ in xrange(num_batches)]
+
+            # Largest first, each to the batch with the least bytes that is not full yet.
+            # A new batch is opened if the task would bring that batch over batch_max_bytes
+            # (a single file larger than the limit makes a batch of its own).
+            heap = [(0, ib) for ib in xrange(num_batches)]
+            for task in sorted(link_tasks, key = task_size, reverse = True):
+                if len(heap) == 0:
+                    heap.append((0, len(batches)))
+                    batches.append([])
+
+                size, ib = heapq.heappop(heap)
+                if self.batch_max_bytes > 0 and len(batches[ib]) != 0 and size + task_size(task) > self.batch_max_bytes:
+                    heapq.heappush(heap, (size, ib))
+                    size, ib = 0, len(batches)
+                    batches.append([])
+
+                batches[ib].append(task)
+                if len(batches[ib]) < self.batch_size:
+                    heapq.heappush(heap, (size + task_size(task), ib))
+
+            link_batches.append([b for b in batches if len(b) != 0])
+
+        # Interleave the links so that a slow link does not take up the whole submission budget
+        link_batches.sort(key = lambda b: len(b), reverse = True)
+
+        output = []
+        for ib in xrange(len(link_batches[0])):
+            for batches in link_batches:
+                if ib < len(batches):
+                    output.append(batches[ib])
+
+        return output
+
+    def _num_pending(self, optype):
+        if self.server_id == 0:
+            self._set_server_id()
+
+        # Tasks are deleted from the bookkeeping tables once RLFSM archives them
+        sql = 'SELECT COUNT(*) FROM `fts_{op}_tasks` AS t'
+        sql += ' INNER JOIN `fts_{op}_batches` AS b ON b.`id` = t.`fts_batch_id`'
+        sql += ' WHERE b.`fts_server_id` = %s'
+        num_local = self.db.query(sql.format(op = optype), self.server_id)[0]
+
+        now = time.time()
+        if self.pending_reconcile_interval > 0 and now - self._last_reconcile[optype] > self.pending_reconcile_interval:
+            try:
+                num_server = self._num_pending_on_server(optype)
+            except:
+                exc_type, exc, tb = sys.exc_info()
+                LOG.error('Failed to count pending %ss on FTS: Exception %s (%s)', optype, exc_type.__name__, str(exc))
+            else:
+                LOG.info('Pending %ss at %s: %d in bookkeeping, %d on the server.', optype, self.server_url, num_local, num_server)
+                # Local rows include finished tasks not yet archived, so the server can also count fewer.
+                # Such a deficit disappears with the archival and must not be carried over.
+                self._pending_offset[optype] = max(num_server - num_local, 0)
+
+            self._last_reconcile[optype] = now
+
+        return num_local + self._pending_offset[optype]
+
+    def _num_pending_on_server(self, optype):
+        # We first thought about counting files with /files, but FTS seems to return only 1000 maximum even when "limit" is set much larger
+        #files = self._ftscallurl('/files?state_in=ACTIVE,SUBMITTED,READY&limit=%d' % self.max_pending_transfers)
+        #return len(files)
+
+        num_pending = 0
+
+        if optype == 'transfer':
+            job_states = ['SUBMITTED', 'ACTIVE', 'STAGING']
+            file_states = ['SUBMITTED', 'READY', 'ACTIVE', 'STAGING', 'STARTED']
+            key = 'files'
+        else:
+            job_states = ['SUBMITTED', 'ACTIVE']
+            file_states = ['SUBMITTED', 'READY', 'ACTIVE']
+            key = 'dm'
+
+        jobs = self._ftscall('list_jobs', state_in = job_states)
+        for job in jobs:
+            job_info = self._ftscall('get_job_status', job['job_id'], list_files = True)
+            for file_info in job_info[key]:
+                if file_info['file_state'] in file_states:
+                    num_pending += 1
+
+        return num_pending
+
     def _ftscall(self, method, *args, **kwd):
         return self._do_ftscall(binding = (method, args, kwd))
 
@@ -317,17 +483,18 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
         return self._do_ftscall(url = url)
 
     def _do_ftscall(self, binding = None, url = None):
-        if self._context is None:
-            # request_class = Request -> use "requests"-based https call (instead of default PyCURL,
-            # which may not be able to handle proxy certificates depending on the cURL installation)
-            # verify = False -> do not verify the server certificate
-            context = fts3.Context(self.server_url, ucert = self.x509proxy, ukey = self.x509proxy,
-                                   request_class = Request, verify = False)
-
-            if self.keep_context:
-                self._context = context
-        else:
-            context = self._context
+        with self._context_lock:
+            if self._context is None:
+                # request_class = Request -> use "requests"-based https call (instead of default PyCURL,
+                # which may not be able to handle proxy certificates depending on the cURL installation)
+                # verify = False -> do not verify the server certificate
+                context = fts3.Context(self.server_url, ucert = self.x509proxy, ukey = self.x509proxy,
+                                       request_class = Request, verify = False)
+
+                if self.keep_context:
+                    self._context = context
+            else:
+                context = self._context
 
         if binding is not None:
             reqstring = binding[0]
@@ -338,6 +505,8 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
 
         wait_time = 1.
         for attempt in xrange(10):
+            self._rate_limiter.wait()
+
             try:
                 if binding is not None:
                     method, args, kwd = binding
@@ -430,108 +599,157 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
                 except:
                     LOG.error('Failed to cancel FTS job %s', job_id)
     
-    def _get_status(self, batch_id, optype):
-        if optype == 'transfer' or optype == 'staging':
-            sql = 'SELECT `id`, `job_id` FROM `fts_transfer_batches`'
-            sql += ' WHERE `task_type` = %s AND `fts_server_id` = %s AND `batch_id` = %s'
-            batch_data = self.db.query(sql, optype, self.server_id, batch_id)
+    def _get_status_many(self, batch_ids, optype):
+        """
+        Query FTS about the jobs of multiple batches in parallel.
+        @param batch_ids  List of batch ids
+        @param optype     'transfer' or 'deletion'
+
+        @return Iterator of (batch_id, {task_type: [(task_id, status, exitcode, message, start_time, finish_time)]}),
+                in the order the queries for the batches complete. task_type is 'transfer' or 'staging' for transfers.
+        """
+
+        if optype == 'transfer':
+            sql = 'SELECT `batch_id`, `id`, `job_id`, `task_type` FROM `fts_transfer_batches`'
             task_table_name = 'fts_transfer_tasks'
         else:
-            sql = 'SELECT `id`, `job_id` FROM `fts_deletion_batches`'
-            sql += ' WHERE `fts_server_id` = %s AND `batch_id` = %s'
-            batch_data = self.db.query(sql, self.server_id, batch_id)
+            sql = 'SELECT `batch_id`, `id`, `job_id`, \'deletion\' FROM `fts_deletion_batches`'
             task_table_name = 'fts_deletion_tasks'
 
-        message_pattern = re.compile('(?:DESTINATION|SOURCE|TRANSFER) \[([0-9]+)\] (.*)')
+        jobs = []
+        # batch_id -> number of jobs waiting for the status
+        num_pending_jobs = collections.defaultdict(int)
 
-        results = []
+        for batch_id, fts_batch_id, job_id, task_type in self.db.execute_many(sql, 'batch_id', batch_ids, ['`fts_server_id` = %d' % self.server_id]):
+            jobs.append((batch_id, fts_batch_id, job_id, task_type))
+            num_pending_jobs[batch_id] += 1
 
-        for fts_batch_id, job_id in batch_data:
-            LOG.debug('Checking status of FTS %s batch %s', optype, job_id)
+        # batches with no job on this server
+        for batch_id in batch_ids:
+            if batch_id not in num_pending_jobs:
+                yield batch_id, {}
 
-            sql = 'SELECT `fts_file_id`, `id` FROM `{table}` WHERE `fts_batch_id` = %s'.format(table = task_table_name)
-            fts_to_task = dict(self.db.xquery(sql, fts_batch_id))
+        if len(jobs) == 0:
+            return
 
+        # fts_batch_id -> {fts_file_id: task_id}
+        fts_to_task = collections.defaultdict(dict)
+        sql = 'SELECT `fts_batch_id`, `fts_file_id`, `id` FROM `%s`' % task_table_name
+        for fts_batch_id, fts_file_id, task_id in self.db.execute_many(sql, 'fts_batch_id', [j[1] for j in jobs]):
+            fts_to_task[fts_batch_id][fts_file_id] = task_id
+
+        def get_job_status(batch_id, fts_batch_id, job_id, task_type):
+            LOG.debug('Checking status of FTS %s batch %s', task_type, job_id)
             try:
                 result = self._ftscall('get_job_status', job_id = job_id, list_files = True)
             except:
                 LOG.error('Failed to get job status for FTS job %s', job_id)
+                result = None
+
+            return batch_id, fts_batch_id, task_type, result
+
+        pool = Map(Configuration(num_threads = self.status_query_threads, repeat_on_exception = False))
+
+        # batch_id -> {task_type: results}
+        batch_results = collections.defaultdict(dict)
+
+        for batch_id, fts_batch_id, task_type, result in pool.execute(get_job_status, jobs, async = True):
+            results = batch_results[batch_id].setdefault(task_type, [])
+
+            if result is not None:
+                results.extend(self._parse_job_status(result, fts_to_task[fts_batch_id], task_type))
+
+            num_pending_jobs[batch_id] -= 1
+            if num_pending_jobs[batch_id] == 0:
+                yield batch_id, batch_results.pop(batch_id)
+
+    def _parse_job_status(self, job_status, fts_to_task, optype):
+        """
+        @param job_status   Job status returned by FTS get_job_status
+        @param fts_to_task  {fts_file_id: task_id}
+        @param optype       'transfer', 'staging', or 'deletion'
+
+        @return [(task_id, status, exitcode, message, start_time, finish_time)]
+        """
+
+        message_pattern = re.compile('(?:DESTINATION|SOURCE|TRANSFER) \[([0-9]+)\] (.*)')
+
+        results = []
+
+        if optype == 'transfer' or optype == 'staging':
+            fts_files = job_status['files']
+        else:
+            fts_files = job_status['dm']
+
+        for fts_file in fts_files:
+            try:
+                task_id = fts_to_task[fts_file['file_id']]
+            except KeyError:
                 continue
-    
-            if optype == 'transfer' or optype == 'staging':
-                fts_files = result['files']
-            else:
-                fts_files = result['dm']
 
-            for fts_file in fts_files:
-                try:
-                    task_id = fts_to_task[fts_file['file_id']]
-                except KeyError:
-                    continue
-    
-                state = fts_file['file_state']
-                exitcode = -1
-                start_time = None
-                finish_time = None
-                get_time = False
+            state = fts_file['file_state']
+            exitcode = -1
+            start_time = None
+            finish_time = None
+            get_time = False
 
+            try:
+                message = fts_file['reason']
+            except KeyError:
+                message = None
+
+            if message is not None:
+                # Check if reason follows a known format (from which we can get the exit code)
+                matches = message_pattern.match(message)
+                if matches is not None:
+                    exitcode = int(matches.group(1))
+                    message = matches.group(2)
+                # Additionally, if the message is a known one, convert the exit code
+                c = find_msg_code(message)
+                if c is not None:
+                    exitcode = c
+
+            if state == 'FINISHED':
+                status = FileQuery.STAT_DONE
+                exitcode = 0
+                get_time = True
+
+            elif state == 'FAILED':
+                status = FileQuery.STAT_FAILED
+                get_time = True
+
+            elif state == 'CANCELED':
+                status = FileQuery.STAT_CANCELLED
+                get_time = True
+
+            elif state == 'SUBMITTED':
+                status = FileQuery.STAT_NEW
+
+            else:
+                status = FileQuery.STAT_QUEUED
+
+            if optype == 'transfer' and exitcode == errno.EEXIST:
+                # Transfer + destination exists -> not an error
+                status = FileQuery.STAT_DONE
+                exitcode = 0
+            elif optype == 'deletion' and exitcode == errno.ENOENT:
+                # Deletion + destination does not exist -> not an error
+                status = FileQuery.STAT_DONE
+                exitcode = 0
+                
+            if get_time:
                 try:
-                    message = fts_file['reason']
-                except KeyError:
-                    message = None
-
-                if message is not None:
-                    # Check if reason follows a known format (from which we can get the exit code)
-                    matches = message_pattern.match(message)
-                    if matches is not None:
-                        exitcode = int(matches.group(1))
-                        message = matches.group(2)
-                    # Additionally, if the message is a known one, convert the exit code
-                    c = find_msg_code(message)
-                    if c is not None:
-                        exitcode = c
-
-                if state == 'FINISHED':
-                    status = FileQuery.STAT_DONE
-                    exitcode = 0
-                    get_time = True
-
-                elif state == 'FAILED':
-                    status = FileQuery.STAT_FAILED
-                    get_time = True
-
-                elif state == 'CANCELED':
-                    status = FileQuery.STAT_CANCELLED
-                    get_time = True
-
-                elif state == 'SUBMITTED':
-                    status = FileQuery.STAT_NEW
+                    start_time = calendar.timegm(time.strptime(fts_file['start_time'], '%Y-%m-%dT%H:%M:%S'))
+                except TypeError: # start time is NULL (can happen when the job is cancelled)
+                    start_time = None
+                try:
+                    finish_time = calendar.timegm(time.strptime(fts_file['finish_time'], '%Y-%m-%dT%H:%M:%S'))
+                except TypeError:
+                    start_time = None
 
-                else:
-                    status = FileQuery.STAT_QUEUED
-
-                if optype == 'transfer' and exitcode == errno.EEXIST:
-                    # Transfer + destination exists -> not an error
-                    status = FileQuery.STAT_DONE
-                    exitcode = 0
-                elif optype == 'deletion' and exitcode == errno.ENOENT:
-                    # Deletion + destination does not exist -> not an error
-                    status = FileQuery.STAT_DONE
-                    exitcode = 0
-                    
-                if get_time:
-                    try:
-                        start_time = calendar.timegm(time.strptime(fts_file['start_time'], '%Y-%m-%dT%H:%M:%S'))
-                    except TypeError: # start time is NULL (can happen when the job is cancelled)
-                        start_time = None
-                    try:
-                        finish_time = calendar.timegm(time.strptime(fts_file['finish_time'], '%Y-%m-%dT%H:%M:%S'))
-                    except TypeError:
-                        start_time = None
-
-                LOG.debug('%s %d: %s, %d, %s, %s, %s', optype, task_id, FileQuery.status_name(status), exitcode, message, start_time, finish_time)
-    
-                results.append((task_id, status, exitcode, message, start_time, finish_time))
+            LOG.debug('%s %d: %s, %d, %s, %s, %s', optype, task_id, FileQuery.status_name(status), exitcode, message, start_time, finish_time)
+
+            results.append((task_id, status, exitcode, message, start_time, finish_time))
 
         return results
 
@@ -559,6 +777,37 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
 
             history_db.db.insert_update('fts_file_{op}s'.format(op = optype), ('id', 'fts_batch_id', 'fts_file_id'), history_id, batch_id, fts_file_id)
 
+    def _write_histories(self, history_db, task_history_ids, optype):
+        if len(task_history_ids) == 0:
+            return
+
+        if not self._read_only:
+            history_db.db.insert_update('fts_servers', ('url',), self.server_url)
+
+        try:
+            server_id = history_db.db.query('SELECT `id` FROM `fts_servers` WHERE `url` = %s', self.server_url)[0]
+        except IndexError:
+            server_id = 0
+
+        history_ids = dict(task_history_ids)
+
+        sql = 'SELECT t.`id`, b.`job_id`, t.`fts_file_id` FROM `fts_{op}_tasks` AS t'
+        sql += ' INNER JOIN `fts_{op}_batches` AS b ON b.`id` = t.`fts_batch_id`'
+
+        task_data = self.db.execute_many(sql.format(op = optype), MySQL.bare('t.`id`'), history_ids.keys())
+
+        if len(task_data) == 0 or self._read_only:
+            return
+
+        job_ids = list(set(d[1] for d in task_data))
+
+        history_db.db.insert_many('fts_batches', ('fts_server_id', 'job_id'), lambda j: (server_id, j), job_ids)
+        batch_ids = dict(history_db.db.select_many('fts_batches', ('job_id', 'id'), 'job_id', job_ids, ['`fts_server_id` = %d' % server_id]))
+
+        fields = ('id', 'fts_batch_id', 'fts_file_id')
+        mapping = lambda d: (history_ids[d[0]], batch_ids[d[1]], d[2])
+        history_db.db.insert_many('fts_file_{op}s'.format(op = optype), fields, mapping, task_data)
+
     def _forget_status(self, task_id, optype):
         if self._read_only:
             return
@@ -566,6 +815,12 @@ class FTSFileOperation(FileTransferOperation, FileTransferQuery, FileDeletionOpe
         sql = 'DELETE FROM `fts_{optype}_tasks` WHERE `id` = %s'.format(optype = optype)
         self.db.query(sql, task_id)
 
+    def _forget_statuses(self, task_ids, optype):
+        if self._read_only:
+            return
+
+        self.db.delete_many('fts_{optype}_tasks'.format(optype = optype), 'id', task_ids)
+
     def _forget_batch(self, batch_id, optype):
         if self._read_only:
             return
@@ -1,6 +1,7 @@
 import sys
 import collections
 import logging
+import socket
 
 from dynamo.fileop.base import FileQuery
 from dynamo.fileop.transfer import FileTransferOperation, FileTransferQuery
@@ -23,6 +24,10 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
 
         self.db = MySQL(config.db_params)
 
+        # Path of the local socket of dynamo-fileopd (daemon.notify_socket). If set, the daemon is poked
+        # after each new batch instead of waiting for its next polling cycle.
+        self.notify_socket = config.get('notify_socket', '')
+
     def num_pending_transfers(self): #override
         # FOD can throttle itself.
         return 0
@@ -86,6 +91,7 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
             sql = 'INSERT INTO `standalone_transfer_batches` (`batch_id`, `source_site`, `destination_site`) VALUES (%s, %s, %s)'
             self.db.query(sql, batch_id, source.name, destination.name)
             self.db.insert_many('standalone_transfer_tasks', fields, None, yield_task_entry())
+            self._notify_daemon()
 
         LOG.debug('Inserted %d entries to standalone_transfer_tasks for batch %d.', len(batch_tasks), batch_id)
 
@@ -119,6 +125,7 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
             sql = 'INSERT INTO `standalone_deletion_batches` (`batch_id`, `site`) VALUES (%s, %s)'
             self.db.query(sql, batch_id, site.name)
             self.db.insert_many('standalone_deletion_tasks', fields, None, yield_task_entry())
+            self._notify_daemon()
 
         LOG.debug('Inserted %d entries to standalone_deletion_tasks for batch %d.', len(batch_tasks), batch_id)
 
@@ -168,6 +175,12 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
     def forget_deletion_status(self, task_id): #override
         return self._forget_status(task_id, 'deletion')
 
+    def forget_transfer_statuses(self, task_ids): #override
+        return self._forget_statuses(task_ids, 'transfer')
+
+    def forget_deletion_statuses(self, task_ids): #override
+        return self._forget_statuses(task_ids, 'deletion')
+
     def forget_transfer_batch(self, batch_id): #override
         return self._forget_batch(batch_id, 'transfer')
 
@@ -178,6 +191,19 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
         sql = 'UPDATE `standalone_{op}_tasks` SET `status` = \'cancelled\''.format(op = optype)
         self.db.execute_many(sql, 'id', task_ids, ['`status` IN (\'new\', \'queued\')'])
 
+    def _notify_daemon(self):
+        if not self.notify_socket:
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto('new', self.notify_socket)
+        except socket.error as err:
+            # Daemon is not running or is on another host; it will find the batch at the next poll
+            LOG.debug('Could not notify the file operations daemon: %s', str(err))
+        finally:
+            sock.close()
+
     def _get_status(self, batch_id, optype):
         sql = 'SELECT q.`id`, a.`status`, a.`exitcode`, a.`message`, UNIX_TIMESTAMP(a.`start_time`), UNIX_TIMESTAMP(a.`finish_time`) FROM `standalone_{op}_tasks` AS a'
         sql += ' INNER JOIN `{op}_tasks` AS q ON q.`id` = a.`id`'
@@ -193,6 +219,12 @@ class StandaloneFileOperation(FileTransferOperation, FileTransferQuery, FileDele
         sql = 'DELETE FROM `standalone_{op}_tasks` WHERE `id` = %s'.format(op = optype)
         self.db.query(sql, task_id)
 
+    def _forget_statuses(self, task_ids, optype):
+        if self._read_only:
+            return
+
+        self.db.delete_many('standalone_{op}_tasks'.format(op = optype), 'id', task_ids)
+
     def _forget_batch(self, batch_id, optype):
         if self._read_only:
             return
@@ -10,7 +10,7 @@ from dynamo.fileop.base import FileQuery
 from dynamo.fileop.transfer import FileTransferOperation, FileTransferQuery
 from dynamo.fileop.deletion import FileDeletionOperation, FileDeletionQuery, DirDeletionOperation
 from dynamo.fileop.errors import irrecoverable_errors
-from dynamo.dataformat import Configuration, Block, Site, BlockReplica
+from dynamo.dataformat import Configuration, ConfigurationError, Block, Site, BlockReplica
 from dynamo.history.history import HistoryDatabase
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.policy.condition import Condition
@@ -60,6 +60,35 @@ class RLFSM(object):
             self.id = None
             self.desubscription = desubscription
 
+    class LinkStats(object):
+        """
+        Rolling (exponentially weighted) throughput and failure rate of a source-destination link.
+        """
+        __slots__ = ['throughput', 'failure_rate', 'num_samples']
+
+        def __init__(self):
+            self.throughput = None
+            self.failure_rate = 0.
+            self.num_samples = 0
+
+        def update(self, succeeded, size, duration, decay):
+            """
+            @param succeeded  Boolean
+            @param size       File size in bytes
+            @param duration   Transfer time in seconds (None if unknown)
+            @param decay      Weight of the new sample
+            """
+            self.num_samples += 1
+
+            self.failure_rate = (1. - decay) * self.failure_rate + decay * (0. if succeeded else 1.)
+
+            if succeeded and duration is not None and duration > 0 and size > 0:
+                throughput = float(size) / duration
+                if self.throughput is None:
+                    self.throughput = throughput
+                else:
+                    self.throughput = (1. - decay) * self.throughput + decay * throughput
+
     # default config
     _config = ''
 
@@ -126,6 +155,26 @@ class RLFSM(object):
 
         self.sites_in_downtime = []
 
+        # Source selection mode
+        #  random: random choice among the untried sources
+        #  throughput: source of the fastest healthy link, with random exploration
+        self.source_selection = config.get('source_selection', 'random')
+        if self.source_selection not in ('random', 'throughput'):
+            raise ConfigurationError('Unknown source selection mode %s' % self.source_selection)
+
+        # Probability to select an untried source randomly in throughput mode
+        self.source_exploration = config.get('source_exploration', 0.1)
+        # Weight of a new transfer result in the rolling link statistics
+        self.link_stats_decay = config.get('link_stats_decay', 0.1)
+
+        # {(source name, destination name): LinkStats}, updated at archival
+        self.link_stats = {}
+
+        # Keep evaluated subscriptions in memory across cycles and only process the changes
+        self.resident_subscriptions = config.get('resident_subscriptions', False)
+        # {(op, status): {subscription id: ((status, last_update), inventory fingerprint, (De)Subscription)}}
+        self._subscription_cache = {}
+
         # Cycle thread
         self.main_cycle = None
         self.cycle_stop = threading.Event()
@@ -521,7 +570,7 @@ class RLFSM(object):
 
     def get_subscriptions(self, inventory, op = None, status = None):
         """
-        Return a list containing Subscription and Desubscription objects ordered by the id.
+        Return a list containing Subscription and Desubscription objects ordered by the site and the block ids.
         @param inventory   Dynamo inventory
         @param op          If set to 'transfer' or 'deletion', limit to the operation type.
         @param status      If not None, set to list of status strings to limit the query.
@@ -544,14 +593,88 @@ class RLFSM(object):
         if status is not None:
             constraints.append('u.`status` IN ' + MySQL.stringify_sequence(status))
 
-        if len(constraints) != 0:
-            get_all += ' WHERE ' + ' AND '.join(constraints)
+        if self.resident_subscriptions:
+            # Reuse the subscriptions evaluated in the previous cycles if neither the table row nor
+            # the inventory state of the block changed. Only the rest go through the full query below.
+            if status is None:
+                cache_key = (op, None)
+            else:
+                cache_key = (op, tuple(sorted(status)))
+
+            try:
+                cache = self._subscription_cache[cache_key]
+            except KeyError:
+                cache = self._subscription_cache[cache_key] = {}
+
+            # last_update has a one-second resolution. A retry that fails again within the same second
+            # only shows in the failure history, so the failure count and last failure id are part of the row state.
+            failures = {}
+            if op != 'deletion':
+                sql = 'SELECT `subscription_id`, COUNT(*), MAX(`id`) FROM `failed_transfers` GROUP BY `subscription_id`'
+                for sub_id, num_failures, last_failure in self.db.xquery(sql):
+                    failures[sub_id] = (num_failures, last_failure)
+
+            sql = 'SELECT u.`id`, u.`status`, u.`hold_reason`, UNIX_TIMESTAMP(u.`last_update`) FROM `file_subscriptions` AS u'
+            if len(constraints) != 0:
+                sql += ' WHERE ' + ' AND '.join(constraints)
 
-        get_all += ' ORDER BY s.`id`, f.`block_id`'
+            row_states = {}
+            for sub_id, st, hold_reason, last_update in self.db.xquery(sql):
+                row_states[sub_id] = (st, hold_reason, last_update) + failures.get(sub_id, (0, 0))
+
+            for sub_id in cache.keys():
+                if sub_id not in row_states:
+                    cache.pop(sub_id)
+
+            block_fingerprints = {}
+            dataset_blocks = {}
+            to_evaluate = []
+
+            for sub_id, row_state in row_states.iteritems():
+                try:
+                    cached_state, fingerprint, subscription = cache[sub_id]
+                except KeyError:
+                    to_evaluate.append(sub_id)
+                    continue
+
+                if cached_state == row_state and self._subscription_fingerprint(inventory, subscription, block_fingerprints, dataset_blocks) == fingerprint:
+                    subscriptions.append(subscription)
+                else:
+                    cache.pop(sub_id)
+                    to_evaluate.append(sub_id)
+
+            LOG.debug('Reusing %d resident subscriptions, evaluating %d.', len(subscriptions), len(to_evaluate))
+
+            rows = self.db.execute_many(get_all, MySQL.bare('u.`id`'), to_evaluate, order_by = 's.`id`, f.`block_id`')
+
+        else:
+            cache = None
 
-        get_tried_sites = 'SELECT s.`name`, f.`exitcode` FROM `failed_transfers` AS f'
-        get_tried_sites += ' INNER JOIN `sites` AS s ON s.`id` = f.`source_id`'
-        get_tried_sites += ' WHERE f.`subscription_id` = %s'
+            if len(constraints) != 0:
+                get_all += ' WHERE ' + ' AND '.join(constraints)
+
+            get_all += ' ORDER BY s.`id`, f.`block_id`'
+
+            rows = self.db.query(get_all)
+
+        # Failure history of all retrying transfers, loaded in one go and grouped by subscription id
+        tried_sites = collections.defaultdict(list)
+        if op != 'deletion' and (status is None or 'retry' in status):
+            get_tried_sites = 'SELECT f.`subscription_id`, s.`name`, f.`exitcode` FROM `failed_transfers` AS f'
+            get_tried_sites += ' INNER JOIN `file_subscriptions` AS u ON u.`id` = f.`subscription_id`'
+            get_tried_sites += ' INNER JOIN `sites` AS s ON s.`id` = f.`source_id`'
+
+            if cache is None:
+                get_tried_sites += ' WHERE u.`delete` = 0 AND u.`status` = \'retry\''
+                get_tried_sites += ' ORDER BY f.`subscription_id`, f.`id`'
+                tried_rows = self.db.xquery(get_tried_sites)
+            else:
+                # only the subscriptions to evaluate need the failure history
+                additional_conditions = ['u.`delete` = 0', 'u.`status` = \'retry\'']
+                tried_rows = self.db.execute_many(get_tried_sites, MySQL.bare('f.`subscription_id`'), to_evaluate, additional_conditions, order_by = 'f.`subscription_id`, f.`id`')
+
+            for sub_id, source_name, exitcode in tried_rows:
+                tried_sites[sub_id].append((source_name, exitcode))
 
         _destination_name = ''
         _block_id = -1
@@ -559,12 +682,14 @@ class RLFSM(object):
         no_source = []
         all_failed = []
         to_done = []
+        to_cancel = []
 
         COPY = 0
         DELETE = 1
 
-        for row in self.db.query(get_all):
+        for row in rows:
             sub_id, st, optype, block_id, file_name, site_name = row
+            db_status = st
 
             if site_name != _destination_name:
                 _destination_name = site_name
@@ -598,10 +723,7 @@ class RLFSM(object):
             if dest_replica is None and st != 'cancelled':
                 LOG.debug('Destination replica for %s does not exist. Canceling the subscription.', file_name)
                 # Replica was invalidated
-                sql = 'UPDATE `file_subscriptions` SET `status` = \'cancelled\''
-                sql += ' WHERE `id` = %s'
-                if not self._read_only:
-                    self.db.query(sql, sub_id)
+                to_cancel.append(sub_id)
 
                 if status is not None and 'cancelled' not in status:
                     # We are not asked to return cancelled subscriptions
@@ -642,7 +764,7 @@ class RLFSM(object):
 
                 if st == 'retry':
                     failed_sources = {}
-                    for source_name, exitcode in self.db.query(get_tried_sites, sub_id):
+                    for source_name, exitcode in tried_sites.get(sub_id, []):
                         try:
                             source = inventory.sites[source_name]
                         except KeyError:
@@ -676,6 +798,9 @@ class RLFSM(object):
                     subscription = RLFSM.Subscription(sub_id, st, lfile, destination, disk_sources, tape_sources, failed_sources)
                     subscriptions.append(subscription)
 
+                    if cache is not None and st == db_status:
+                        self._make_resident(cache, row_states[sub_id], subscription, inventory, block_fingerprints, dataset_blocks)
+
             elif optype == DELETE:
                 if st not in ('done', 'held', 'cancelled') and not dest_replica.has_file(lfile):
                     LOG.debug('%s is already gone from %s', file_name, site_name)
@@ -687,6 +812,9 @@ class RLFSM(object):
                     desubscription = RLFSM.Desubscription(sub_id, st, lfile, destination)
                     subscriptions.append(desubscription)
 
+                    if cache is not None and st == db_status:
+                        self._make_resident(cache, row_states[sub_id], desubscription, inventory, block_fingerprints, dataset_blocks)
+
         if len(to_done) + len(no_source) + len(all_failed) != 0:
             msg = 'Subscriptions terminated directly: %d done' % len(to_done)
             if len(no_source) != 0:
@@ -697,6 +825,7 @@ class RLFSM(object):
             LOG.info(msg)
 
         if not self._read_only:
+            self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'cancelled\'', 'id', to_cancel)
             self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'done\', `last_update` = NOW()', 'id', to_done)
             self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'held\', `hold_reason` = \'no_source\', `last_update` = NOW()', 'id', no_source)
             self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'held\', `hold_reason` = \'all_failed\', `last_update` = NOW()', 'id', all_failed)
@@ -713,8 +842,66 @@ class RLFSM(object):
             sql += ' WHERE u.`id` IS NULL'
             self.db.query(sql)
 
+        if cache is not None:
+            # resident subscriptions come first and execute_many orders within each batch only
+            def sort_key(sub):
+                if type(sub) is RLFSM.Subscription:
+                    return (sub.destination.id, sub.file.block.id)
+                else:
+                    return (sub.site.id, sub.file.block.id)
+
+            subscriptions.sort(key = sort_key)
+
         return subscriptions
 
+    def _subscription_fingerprint(self, inventory, subscription, block_fingerprints, dataset_blocks):
+        """
+        Return a hashable summary of the inventory state a (de)subscription evaluation depends on,
+        or None if the destination or the block is no longer in the inventory.
+        @param block_fingerprints  {id(block): fingerprint} cache for the current cycle
+        @param dataset_blocks      {id(dataset): {block name: block}} cache for the current cycle
+        """
+        if type(subscription) is RLFSM.Subscription:
+            site = subscription.destination
+        else:
+            site = subscription.site
+
+        if inventory.sites.get(site.name) is not site:
+            return None
+
+        block = subscription.file.block
+
+        try:
+            return block_fingerprints[id(block)]
+        except KeyError:
+            pass
+
+        dataset = inventory.datasets.get(block.dataset.name)
+        if dataset is block.dataset:
+            try:
+                blocks = dataset_blocks[id(dataset)]
+            except KeyError:
+                # Dataset.find_block is a linear search
+                blocks = dataset_blocks[id(dataset)] = dict((b.name, b) for b in dataset.blocks)
+
+        if dataset is not block.dataset or blocks.get(block.name) is not block:
+            fingerprint = None
+        else:
+            fingerprint = frozenset((r.site.name, r.site.status, r.size, r.last_update, r.num_files) for r in block.replicas)
+
+        block_fingerprints[id(block)] = fingerprint
+        return fingerprint
+
+    def _make_resident(self, cache, row_state, subscription, inventory, block_fingerprints, dataset_blocks):
+        fingerprint = self._subscription_fingerprint(inventory, subscription, block_fingerprints, dataset_blocks)
+        if fingerprint is not None:
+            cache[subscription.id] = (row_state, fingerprint, subscription)
+
+    def _drop_resident_subscriptions(self, subscription_ids):
+        for cache in self._subscription_cache.itervalues():
+            for sub_id in subscription_ids:
+                cache.pop(sub_id, None)
+
     def close_subscriptions(self, done_ids):
         """
         Get subscription completion acknowledgments.
@@ -838,19 +1025,103 @@ class RLFSM(object):
         return self.db.query(sql)
 
     def _update_status(self, optype):
+        done_subscriptions = []
+        num_success = 0
+        num_failure = 0
+        num_cancelled = 0
+
+        # Collect completed tasks
+
+        if optype == 'transfer':
+            queries = [(query, query.get_transfer_status_many) for _, query in self.transfer_queries]
+        else:
+            queries = [(query, query.get_deletion_status_many) for _, query in self.deletion_queries]
+
+        def get_results():
+            # Results are processed as they arrive. Batches unknown to a query (empty result) are passed to the next one.
+            # If no query knows a batch, it is handed over with empty results (and therefore deleted) with the last query.
+            batch_ids = self.db.query('SELECT `id` FROM `{op}_batches`'.format(op = optype))
+
+            for iq, (query, get_status_many) in enumerate(queries):
+                is_last = (iq == len(queries) - 1)
+                unclaimed = []
+
+                for batch_id, results in get_status_many(batch_ids):
+                    if len(results) == 0 and not is_last:
+                        unclaimed.append(batch_id)
+                    else:
+                        yield batch_id, query, results
+
+                batch_ids = unclaimed
+
+        for batch_id, query, results in get_results():
+            batch_complete = True
+
+            finished = []
+
+            for result in results:
+                task_id, status, exitcode, message, start_time, finish_time = result
+                # start_time and finish_time can be None
+                LOG.debug('%s result: %d %s %d %s %s', optype, task_id, FileQuery.status_name(status), exitcode, start_time, finish_time)
+
+                if status == FileQuery.STAT_DONE:
+                    num_success += 1
+                elif status == FileQuery.STAT_FAILED:
+                    num_failure += 1
+                elif status == FileQuery.STAT_CANCELLED:
+                    num_cancelled += 1
+                else:
+                    batch_complete = False
+                    continue
+
+                finished.append(result)
+
+            if len(finished) != 0:
+                done_subscriptions.extend(self._archive_tasks(optype, batch_id, query, finished))
+
+            if batch_complete:
+                if not self._read_only:
+                    self.db.query('DELETE FROM `{op}_batches` WHERE `id` = %s'.format(op = optype), batch_id)
+
+                if optype == 'transfer':
+                    query.forget_transfer_batch(batch_id)
+                else:
+                    query.forget_deletion_batch(batch_id)
+
+            if self.cycle_stop.is_set():
+                break
+
+        if num_success + num_failure + num_cancelled != 0:
+            LOG.info('Archived file %s: %d succeeded, %d failed, %d cancelled.', optype, num_success, num_failure, num_cancelled)
+        else:
+            LOG.debug('Archived file %s: %d succeeded, %d failed, %d cancelled.', optype, num_success, num_failure, num_cancelled)
+
+        return done_subscriptions
+
+    def _archive_tasks(self, optype, batch_id, query, finished):
+        """
+        Archive the terminated tasks of one batch and update the subscriptions. All database operations
+        are done in bulk for the whole batch.
+        @param optype    'transfer' or 'deletion'
+        @param batch_id  Batch id
+        @param query     File(Transfer|Deletion)Query object that reported the results
+        @param finished  List of (task_id, status, exitcode, message, start_time, finish_time) for terminated tasks
+
+        @return  List of subscription ids whose tasks succeeded
+        """
+
         if optype == 'transfer':
-            site_columns = 'ss.`name`, sd.`name`'
+            site_columns = 'q.`source_id`, ss.`name`, sd.`name`'
             site_joins = ' INNER JOIN `sites` AS ss ON ss.`id` = q.`source_id`'
             site_joins += ' INNER JOIN `sites` AS sd ON sd.`id` = u.`site_id`'
         else:
             site_columns = 's.`name`'
             site_joins = ' INNER JOIN `sites` AS s ON s.`id` = u.`site_id`'
 
-        get_task_data = 'SELECT u.`id`, f.`name`, f.`size`, UNIX_TIMESTAMP(q.`created`), ' + site_columns + ' FROM `{op}_tasks` AS q'
+        get_task_data = 'SELECT q.`id`, u.`id`, f.`name`, f.`size`, UNIX_TIMESTAMP(q.`created`), ' + site_columns + ' FROM `{op}_tasks` AS q'
         get_task_data += ' INNER JOIN `file_subscriptions` AS u ON u.`id` = q.`subscription_id`'
         get_task_data += ' INNER JOIN `files` AS f ON f.`id` = u.`file_id`'
         get_task_data += site_joins
-        get_task_data += ' WHERE q.`id` = %s'
 
         get_task_data = get_task_data.format(op = optype)
 
@@ -863,180 +1134,184 @@ class RLFSM(object):
 
         history_fields = ('file_id', 'exitcode', 'message', 'batch_id', 'created', 'started', 'finished', 'completed') + history_site_fields
 
-        if optype == 'transfer':
-            insert_failure = 'INSERT INTO `failed_transfers` (`id`, `subscription_id`, `source_id`, `exitcode`)'
-            insert_failure += ' SELECT `id`, `subscription_id`, `source_id`, %s FROM `transfer_tasks` WHERE `id` = %s'
-            insert_failure += ' ON DUPLICATE KEY UPDATE `id`=VALUES(`id`)'
-            delete_failures = 'DELETE FROM `failed_transfers` WHERE `subscription_id` = %s'
+        task_table_name = '{op}_tasks'.format(op = optype)
 
-        get_subscription_status = 'SELECT `status` FROM `file_subscriptions` WHERE `id` = %s'
+        task_data = {}
+        for row in self.db.execute_many(get_task_data, MySQL.bare('q.`id`'), [r[0] for r in finished]):
+            task_data[row[0]] = row[1:]
 
-        update_subscription = 'UPDATE `file_subscriptions` SET `status` = %s, `last_update` = NOW() WHERE `id` = %s'
-        delete_subscription = 'DELETE FROM `file_subscriptions` WHERE `id` = %s'
+        lost_ids = [r[0] for r in finished if r[0] not in task_data]
+        if len(lost_ids) != 0:
+            for task_id in lost_ids:
+                LOG.warning('%s task %d got lost.', optype, task_id)
 
-        delete_task = 'DELETE FROM `{op}_tasks` WHERE `id` = %s'.format(op = optype)
+            if optype == 'transfer':
+                query.forget_transfer_statuses(lost_ids)
+            else:
+                query.forget_deletion_statuses(lost_ids)
 
-        delete_batch = 'DELETE FROM `{op}_batches` WHERE `id` = %s'.format(op = optype)
+            if not self._read_only:
+                self.db.delete_many(task_table_name, 'id', lost_ids)
 
-        done_subscriptions = []
-        num_success = 0
-        num_failure = 0
-        num_cancelled = 0
+            finished = [r for r in finished if r[0] in task_data]
 
-        # Collect completed tasks
+        if len(finished) == 0:
+            return []
 
-        for batch_id in self.db.query('SELECT `id` FROM `{op}_batches`'.format(op = optype)):
-            results = []
+        # Register the sites and files to the history DB and fetch their ids in one go
+        if optype == 'transfer':
+            site_names = set()
+            for data in task_data.itervalues():
+                site_names.add(data[5])
+                site_names.add(data[6])
+        else:
+            site_names = set(data[4] for data in task_data.itervalues())
+
+        site_names = list(site_names)
+        file_data = list(set(data[1:3] for data in task_data.itervalues()))
+
+        history_site_id_map = dict(zip(site_names, self.history_db.save_sites(site_names, get_ids = True)))
+        history_file_id_map = dict(zip([f[0] for f in file_data], self.history_db.save_files(file_data, get_ids = True)))
+
+        # local time
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        history_entries = []
+        for task_id, status, exitcode, message, start_time, finish_time in finished:
+            data = task_data[task_id]
+            lfn, create_time = data[1], data[3]
 
             if optype == 'transfer':
-                for _, query in self.transfer_queries:
-                    results = query.get_transfer_status(batch_id)
-                    if len(results) != 0:
-                        break
+                source_name, dest_name = data[5:]
+                history_site_ids = (history_site_id_map[source_name], history_site_id_map[dest_name])
+                LOG.debug('Archiving transfer of %s from %s to %s (exitcode %d)', lfn, source_name, dest_name, exitcode)
 
+                if status != FileQuery.STAT_CANCELLED:
+                    self._update_link_stats(source_name, dest_name, status == FileQuery.STAT_DONE, data[2], start_time, finish_time)
             else:
-                for _, query in self.deletion_queries:
-                    results = query.get_deletion_status(batch_id)
-                    if len(results) != 0:
-                        break
+                site_name = data[4]
+                history_site_ids = (history_site_id_map[site_name],)
+                LOG.debug('Archiving deletion of %s at %s (exitcode %d)', lfn, site_name, exitcode)
 
-            batch_complete = True
+            if start_time is None:
+                sql_start_time = None
+            else:
+                sql_start_time = datetime.datetime(*time.localtime(start_time)[:6])
 
-            for task_id, status, exitcode, message, start_time, finish_time in results:
-                # start_time and finish_time can be None
-                LOG.debug('%s result: %d %s %d %s %s', optype, task_id, FileQuery.status_name(status), exitcode, start_time, finish_time)
+            if finish_time is None:
+                sql_finish_time = None
+            else:
+                sql_finish_time = datetime.datetime(*time.localtime(finish_time)[:6])
 
-                if status == FileQuery.STAT_DONE:
-                    num_success += 1
-                elif status == FileQuery.STAT_FAILED:
-                    num_failure += 1
-                elif status == FileQuery.STAT_CANCELLED:
-                    num_cancelled += 1
-                else:
-                    batch_complete = False
-                    continue
+            values = (history_file_id_map[lfn], exitcode, message, batch_id, datetime.datetime(*time.localtime(create_time)[:6]),
+                sql_start_time, sql_finish_time, now) + history_site_ids
 
-                try:
-                    task_data = self.db.query(get_task_data, task_id)[0]
-                except IndexError:
-                    LOG.warning('%s task %d got lost.', optype, task_id)
-                    if optype == 'transfer':
-                        query.forget_transfer_status(task_id)
-                    else:
-                        query.forget_deletion_status(task_id)
+            history_entries.append((task_id, values))
 
-                    if not self._read_only:
-                        self.db.query(delete_task, task_id)
+        if self._read_only:
+            task_history_ids = [(task_id, 0) for task_id, _ in history_entries]
+        else:
+            # Insert all history rows under a table lock and read back the ids assigned above the previous maximum.
+            # (file_id, site ids) is unique within a batch.
+            history_db = self.history_db.db
+            history_db.lock_tables(write = [history_table_name])
 
-                    continue
+            try:
+                max_id = history_db.query('SELECT IFNULL(MAX(`id`), 0) FROM `%s`' % history_table_name)[0]
+                history_db.insert_many(history_table_name, history_fields, lambda e: e[1], history_entries, do_update = False)
 
-                subscription_id, lfn, size, create_time = task_data[:4]
+                sql = 'SELECT `id`, `file_id`, ' + ', '.join('`%s`' % f for f in history_site_fields)
+                sql += ' FROM `%s` WHERE `id` > %%s' % history_table_name
+                history_id_map = dict((row[1:], row[0]) for row in history_db.query(sql, max_id))
+            finally:
+                history_db.unlock_tables()
 
-                if optype == 'transfer':
-                    source_name, dest_name = task_data[4:]
-                    history_site_ids = (
-                        self.history_db.save_sites([source_name], get_ids = True)[0],
-                        self.history_db.save_sites([dest_name], get_ids = True)[0]
-                    )
-                else:
-                    site_name = task_data[4]
-                    history_site_ids = (self.history_db.save_sites([site_name], get_ids = True)[0],)
+            task_history_ids = [(task_id, history_id_map[(values[0],) + values[8:]]) for task_id, values in history_entries]
 
-                file_id = self.history_db.save_files([(lfn, size)], get_ids = True)[0]
+        if optype == 'transfer':
+            query.write_transfer_histories(self.history_db, task_history_ids)
+        else:
+            query.write_deletion_histories(self.history_db, task_history_ids)
 
-                if start_time is None:
-                    sql_start_time = None
-                else:
-                    sql_start_time = datetime.datetime(*time.localtime(start_time)[:6])
+        # We check the subscription status and update accordingly. Need to lock the tables.
+        subscription_ids = [task_data[r[0]][0] for r in finished]
 
-                if finish_time is None:
-                    sql_finish_time = None
-                else:
-                    sql_finish_time = datetime.datetime(*time.localtime(finish_time)[:6])
+        to_done = []
+        to_retry = []
+        to_delete = []
+        failures = []
 
-                values = (file_id, exitcode, message, batch_id, datetime.datetime(*time.localtime(create_time)[:6]),
-                    sql_start_time, sql_finish_time, MySQL.bare('NOW()')) + history_site_ids
+        if not self._read_only:
+            self.db.lock_tables(write = ['file_subscriptions'])
 
-                if optype == 'transfer':
-                    LOG.debug('Archiving transfer of %s from %s to %s (exitcode %d)', lfn, source_name, dest_name, exitcode)
-                else:
-                    LOG.debug('Archiving deletion of %s at %s (exitcode %d)', lfn, site_name, exitcode)
+        try:
+            subscription_status = dict(self.db.select_many('file_subscriptions', ('id', 'status'), 'id', subscription_ids))
 
-                if self._read_only:
-                    history_id = 0
-                else:
-                    history_id = self.history_db.db.insert_get_id(history_table_name, history_fields, values)
+            for task_id, status, exitcode, _, _, _ in finished:
+                data = task_data[task_id]
+                subscription_id = data[0]
 
-                if optype == 'transfer':
-                    query.write_transfer_history(self.history_db, task_id, history_id)
-                else:
-                    query.write_deletion_history(self.history_db, task_id, history_id)
+                try:
+                    sub_status = subscription_status[subscription_id]
+                except KeyError:
+                    continue
 
-                # We check the subscription status and update accordingly. Need to lock the tables.
-                if not self._read_only:
-                    self.db.lock_tables(write = ['file_subscriptions'])
+                if sub_status == 'inbatch':
+                    if status == FileQuery.STAT_DONE:
+                        LOG.debug('Subscription %d done.', subscription_id)
+                        to_done.append(subscription_id)
 
-                try:
-                    subscription_status = self.db.query(get_subscription_status, subscription_id)[0]
+                    elif status == FileQuery.STAT_FAILED:
+                        LOG.debug('Subscription %d failed (exit code %d). Flagging retry.', subscription_id, exitcode)
+                        to_retry.append(subscription_id)
+                        if optype == 'transfer':
+                            failures.append((task_id, subscription_id, data[4], exitcode))
 
-                    if subscription_status == 'inbatch':
-                        if status == FileQuery.STAT_DONE:
-                            LOG.debug('Subscription %d done.', subscription_id)
-                            if not self._read_only:
-                                self.db.query(update_subscription, 'done', subscription_id)
-        
-                        elif status == FileQuery.STAT_FAILED:
-                            LOG.debug('Subscription %d failed (exit code %d). Flagging retry.', subscription_id, exitcode)
-                            if not self._read_only:
-                                self.db.query(update_subscription, 'retry', subscription_id)
-        
-                    elif subscription_status == 'cancelled':
-                        # subscription is cancelled and task terminated -> delete the subscription now, irrespective of the task status
-                        LOG.debug('Subscription %d is cancelled.', subscription_id)
-                        if not self._read_only:
-                            self.db.query(delete_subscription, subscription_id)
-                finally:
-                    if not self._read_only:
-                        self.db.unlock_tables()
+                elif sub_status == 'cancelled':
+                    # subscription is cancelled and task terminated -> delete the subscription now, irrespective of the task status
+                    LOG.debug('Subscription %d is cancelled.', subscription_id)
+                    to_delete.append(subscription_id)
 
-                if not self._read_only:
-                    if optype == 'transfer':
-                        if subscription_status == 'cancelled' or (subscription_status == 'inbatch' and status == FileQuery.STAT_DONE):
-                            # Delete entries from failed_transfers table
-                            self.db.query(delete_failures, subscription_id)
-    
-                        elif subscription_status == 'inbatch' and status == FileQuery.STAT_FAILED:
-                            # Insert entry to failed_transfers table
-                            self.db.query(insert_failure, exitcode, task_id)
-        
-                    self.db.query(delete_task, task_id)
+            if not self._read_only:
+                self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'done\', `last_update` = NOW()', 'id', to_done)
+                self.db.execute_many('UPDATE `file_subscriptions` SET `status` = \'retry\', `last_update` = NOW()', 'id', to_retry)
+                self.db.delete_many('file_subscriptions', 'id', to_delete)
 
-                if status == FileQuery.STAT_DONE:
-                    done_subscriptions.append(subscription_id)
+        finally:
+            if not self._read_only:
+                self.db.unlock_tables()
 
-                if optype == 'transfer':
-                    query.forget_transfer_status(task_id)
-                else:
-                    query.forget_deletion_status(task_id)
+        if not self._read_only:
+            if optype == 'transfer':
+                # Delete entries from failed_transfers table for completed and cancelled subscriptions
+                self.db.delete_many('failed_transfers', 'subscription_id', to_done + to_delete)
 
-                if self.cycle_stop.is_set():
-                    break
+                # Insert entries to failed_transfers table
+                fields = ('id', 'subscription_id', 'source_id', 'exitcode')
+                self.db.insert_many('failed_transfers', fields, None, failures, update_columns = ('id',))
 
-            if batch_complete:
-                if not self._read_only:
-                    self.db.query(delete_batch, batch_id)
+            self.db.delete_many(task_table_name, 'id', [r[0] for r in finished])
 
-                if optype == 'transfer':
-                    query.forget_transfer_batch(batch_id)
-                else:
-                    query.forget_deletion_batch(batch_id)
+        task_ids = [r[0] for r in finished]
+        if optype == 'transfer':
+            query.forget_transfer_statuses(task_ids)
+        else:
+            query.forget_deletion_statuses(task_ids)
 
-        if num_success + num_failure + num_cancelled != 0:
-            LOG.info('Archived file %s: %d succeeded, %d failed, %d cancelled.', optype, num_success, num_failure, num_cancelled)
+        return [task_data[r[0]][0] for r in finished if r[1] == FileQuery.STAT_DONE]
+
+    def _update_link_stats(self, source_name, dest_name, succeeded, size, start_time, finish_time):
+        try:
+            stats = self.link_stats[(source_name, dest_name)]
+        except KeyError:
+            stats = self.link_stats[(source_name, dest_name)] = RLFSM.LinkStats()
+
+        if start_time is None or finish_time is None:
+            duration = None
         else:
-            LOG.debug('Archived file %s: %d succeeded, %d failed, %d cancelled.', optype, num_success, num_failure, num_cancelled)
+            duration = finish_time - start_time
 
-        return done_subscriptions
+        stats.update(succeeded, size, duration, self.link_stats_decay)
 
     def _select_source(self, subscriptions):
         """
@@ -1046,7 +1321,43 @@ class RLFSM(object):
         @return  List of TransferTask objects
         """
 
-        def find_site_to_try(sources, failed_sources):
+        def choose_untried(candidates, destination):
+            if self.source_selection == 'random' or random.random() < self.source_exploration:
+                LOG.debug('Selecting randomly')
+                return random.choice(candidates)
+
+            # Links never measured are explored first
+            unknown = []
+            best_score = -1.
+            best_site = None
+            for site in candidates:
+                try:
+                    stats = self.link_stats[(site.name, destination.name)]
+                except KeyError:
+                    stats = None
+
+                if stats is None:
+                    unknown.append(site)
+                    continue
+
+                if stats.throughput is None:
+                    # only failures so far
+                    score = 0.
+                else:
+                    score = stats.throughput * (1. - stats.failure_rate)
+
+                if score > best_score:
+                    best_score = score
+                    best_site = site
+
+            if len(unknown) != 0:
+                LOG.debug('Selecting randomly among %d unmeasured links', len(unknown))
+                return random.choice(unknown)
+
+            LOG.debug('%s has the best link score %.1f', best_site.name, best_score)
+            return best_site
+
+        def find_site_to_try(sources, failed_sources, destination):
             not_tried = set(sources)
             if failed_sources is not None:
                 not_tried -= set(failed_sources.iterkeys())
@@ -1075,17 +1386,16 @@ class RLFSM(object):
                     return by_failure[0]
 
             else:
-                LOG.debug('Selecting randomly')
-                return random.choice(list(not_tried))
+                return choose_untried(list(not_tried), destination)
 
         tasks = []
 
         for subscription in subscriptions:
             LOG.debug('Selecting a disk source for subscription %d (%s to %s)', subscription.id, subscription.file.lfn, subscription.destination.name)
-            source = find_site_to_try(subscription.disk_sources, subscription.failed_sources)
+            source = find_site_to_try(subscription.disk_sources, subscription.failed_sources, subscription.destination)
             if source is None:
                 LOG.debug('Selecting a tape source for subscription %d', subscription.id)
-                source = find_site_to_try(subscription.tape_sources, subscription.failed_sources)
+                source = find_site_to_try(subscription.tape_sources, subscription.failed_sources, subscription.destination)
 
             if source is None:
                 # If both disk and tape failed irrecoveably, the subscription must be placed in held queue in get_subscriptions.
@@ -1125,6 +1435,8 @@ class RLFSM(object):
 
         result = transfer_operation.start_transfers(batch_id, tasks)
 
+        self._drop_resident_subscriptions([t.subscription.id for t in tasks])
+
         successful = [task for task, success in result.iteritems() if success]
 
         if not self._read_only:
@@ -1171,6 +1483,8 @@ class RLFSM(object):
         
         result = deletion_operation.start_deletions(batch_id, tasks)
 
+        self._drop_resident_subscriptions([t.desubscription.id for t in tasks])
+
         successful = [task for task, success in result.iteritems() if success]
 
         if not self._read_only:
@@ -67,6 +67,17 @@ class FileTransferQuery(FileQuery):
         """
         raise NotImplementedError('get_transfer_status')
 
+    def get_transfer_status_many(self, batch_ids):
+        """
+        Query the external agent about tasks in multiple batches. Plugins that can query the agent
+        concurrently should override this method and yield the results as they become available.
+        @param batch_ids  List of integer ids of the transfer task batches.
+
+        @return  Iterator of (batch_id, [(task_id, status, exit code, message, start time (UNIX), finish time (UNIX))])
+        """
+        for batch_id in batch_ids:
+            yield batch_id, self.get_transfer_status(batch_id)
+
     def write_transfer_history(self, history_db, task_id, history_id):
         """
         Enter whatever specific information this plugin has to the history DB.
@@ -76,6 +87,16 @@ class FileTransferQuery(FileQuery):
         """
         raise NotImplementedError('write_transfer_history')
 
+    def write_transfer_histories(self, history_db, task_history_ids):
+        """
+        Batched version of write_transfer_history. Plugins that can write the history of a whole batch
+        at once should override this method.
+        @param history_db        HistoryDatabase instance
+        @param task_history_ids  List of (transfer task id, ID in the history file_transfers table)
+        """
+        for task_id, history_id in task_history_ids:
+            self.write_transfer_history(history_db, task_id, history_id)
+
     def forget_transfer_status(self, task_id):
         """
         Delete the internal record (if there is any) of the specific task.
@@ -83,6 +104,14 @@ class FileTransferQuery(FileQuery):
         """
         raise NotImplementedError('fotget_transfer_status')
 
+    def forget_transfer_statuses(self, task_ids):
+        """
+        Batched version of forget_transfer_status.
+        @param task_ids  List of integer ids of the transfer tasks.
+        """
+        for task_id in task_ids:
+            self.forget_transfer_status(task_id)
+
     def forget_transfer_batch(self, batch_id):
         """
         Delete the internal record (if there is any) of the specific batch.
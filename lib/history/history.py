@@ -1,6 +1,68 @@
+import collections
+import threading
+
 from dynamo.utils.interface.mysql import MySQL
 from dynamo.dataformat import Configuration
 
+class NameIdCache(object):
+    """
+    Bounded name -> id map of one history DB table. Least recently used entries are evicted first.
+    For tables with columns other than the name, the last written row (payload) is kept with the id.
+    Thread-safe; instances are shared by all HistoryDatabase objects pointing to the same table.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # name -> (id, payload)
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, names, payloads = None):
+        """
+        @param names     List of names
+        @param payloads  If not None, list of payloads in the order of names. Names cached with a different payload
+                         are reported missing.
+        @return  ({name: id} for the cached names, [names not in cache])
+        """
+        found = {}
+        missing = []
+
+        with self._lock:
+            for iname, name in enumerate(names):
+                try:
+                    # pop and reinsert to mark as recently used
+                    id_value, payload = self._ids[name] = self._ids.pop(name)
+                except KeyError:
+                    missing.append(name)
+                    continue
+
+                if payloads is not None and payloads[iname] != payload:
+                    missing.append(name)
+                else:
+                    found[name] = id_value
+
+        return found, missing
+
+    def update(self, name_ids, payloads = None):
+        """
+        @param name_ids  Iterable of (name, id)
+        @param payloads  If not None, {name: payload}
+        """
+        with self._lock:
+            for name, id_value in name_ids:
+                self._ids.pop(name, None)
+                if payloads is None:
+                    self._ids[name] = (id_value, None)
+                else:
+                    self._ids[name] = (id_value, payloads.get(name))
+
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
 class HistoryDatabase(object):
     """
     Interface to the history database. This is a MySQL-specific implementation, and we actually
@@ -13,6 +75,10 @@ class HistoryDatabase(object):
     # default configuration
     _config = Configuration()
 
+    # name -> id caches shared within the process, keyed by (host, db, table)
+    _id_caches = {}
+    _id_caches_lock = threading.Lock()
+
     @staticmethod
     def set_default(config):
         HistoryDatabase._config = Configuration(config)
@@ -23,6 +89,12 @@ class HistoryDatabase(object):
 
         self.db = MySQL(config.db_params)
 
+        # Maximum number of entries per table in the name -> id caches
+        self.id_cache_size = config.get('id_cache_size', 100000)
+
+        db_config = self.db.config()
+        self._id_cache_key = (db_config.get('host', ''), db_config.get('db', ''))
+
         self.set_read_only(config.get('read_only', False))
 
     def set_read_only(self, value = True):
@@ -32,76 +104,23 @@ class HistoryDatabase(object):
         """
         @param user_list  [(name, dn)]
         """
-        if self._read_only:
-            if get_ids:
-                return [0] * len(user_list)
-            else:
-                return
-
-        self.db.insert_many('users', ('name', 'dn'), None, user_list, do_update = True)
-
-        if get_ids:
-            return self.db.select_many('users', ('id',), 'dn', [u[1] for u in user_list])
+        # users are identified by the DN
+        return self._save_names('users', 'dn', user_list, lambda u: u[1], ('name', 'dn'), None, get_ids)
 
     def save_user_services(self, service_names, get_ids = False):
-        if self._read_only:
-            if get_ids:
-                return [0] * len(service_names)
-            else:
-                return
-
-        self.db.insert_many('user_services', ('name',), MySQL.make_tuple, service_names, do_update = True)
-
-        if get_ids:
-            return self.db.select_many('user_services', ('id',), 'name', service_names)
+        return self._save_names('user_services', 'name', service_names, None, ('name',), MySQL.make_tuple, get_ids)
 
     def save_partitions(self, partition_names, get_ids = False):
-        if self._read_only:
-            if get_ids:
-                return [0] * len(partition_names)
-            else:
-                return
-
-        self.db.insert_many('partitions', ('name',), MySQL.make_tuple, partition_names, do_update = True)
-
-        if get_ids:
-            return self.db.select_many('partitions', ('id',), 'name', partition_names)
+        return self._save_names('partitions', 'name', partition_names, None, ('name',), MySQL.make_tuple, get_ids)
 
     def save_sites(self, site_names, get_ids = False):
-        if self._read_only:
-            if get_ids:
-                return [0] * len(site_names)
-            else:
-                return
-
-        self.db.insert_many('sites', ('name',), MySQL.make_tuple, site_names, do_update = True)
-
-        if get_ids:
-            return self.db.select_many('sites', ('id',), 'name', site_names)
+        return self._save_names('sites', 'name', site_names, None, ('name',), MySQL.make_tuple, get_ids)
 
     def save_groups(self, group_names, get_ids = False):
-        if self._read_only:
-            if get_ids:
-                return [0] * len(group_names)
-            else:
-                return
-
-        self.db.insert_many('groups', ('name',), MySQL.make_tuple, group_names, do_update = True)
-
-        if get_ids:
-            return self.db.select_many('groups', ('id',), 'name', group_names)
+        return self._save_names('groups', 'name', group_names, None, ('name',), MySQL.make_tuple, get_ids)
 
     def save_datasets(self, dataset_names, get_ids = False):
-        if self._read_only:
-            if get_ids:
-                return [0] * len(dataset_names)
-            else:
-                return
-
-        self.db.insert_many('datasets', ('name',), MySQL.make_tuple, dataset_names, do_update = True)
-
-        if get_ids:
-            return self.db.select_many('datasets', ('id',), 'name', dataset_names)
+        return self._save_names('datasets', 'name', dataset_names, None, ('name',), MySQL.make_tuple, get_ids)
 
     def save_blocks(self, block_list, get_ids = False):
         """
@@ -146,13 +165,70 @@ class HistoryDatabase(object):
             return ids
 
     def save_files(self, file_data, get_ids = False):
+        """
+        @param file_data  [(name, size)]
+        """
+        return self._save_names('files', 'name', file_data, lambda f: f[0], ('name', 'size'), None, get_ids)
+
+    def get_id_cache(self, table):
+        """
+        Return the process-wide name -> id cache for the table.
+        """
+        key = self._id_cache_key + (table,)
+
+        with HistoryDatabase._id_caches_lock:
+            try:
+                return HistoryDatabase._id_caches[key]
+            except KeyError:
+                cache = HistoryDatabase._id_caches[key] = NameIdCache(self.id_cache_size)
+                return cache
+
+    def _save_names(self, table, key_column, entries, key_of, fields, mapping, get_ids):
+        """
+        Insert the entries not found in the name -> id cache of the table and resolve their ids in bulk.
+        Entries with columns beyond the key (key_of not None) are also upserted if they differ from the cached row.
+        @param table       Table name
+        @param key_column  Unique column identifying the entry
+        @param entries     List of entries to save
+        @param key_of      Function that returns the key value of an entry. If None, the entry itself is the key.
+        @param fields      Columns to insert
+        @param mapping     Mapping passed to insert_many
+        @param get_ids     If True, return the list of ids in the order of the entries
+
+        @return  List of ids if get_ids is True
+        """
         if self._read_only:
             if get_ids:
-                return [0] * len(file_data)
+                return [0] * len(entries)
             else:
                 return
 
-        self.db.insert_many('files', ('name', 'size'), None, file_data, do_update = True)
+        if key_of is None:
+            keys = entries
+            payloads = None
+        else:
+            keys = [key_of(e) for e in entries]
+            payloads = [tuple(e) for e in entries]
+
+        cache = self.get_id_cache(table)
+
+        ids, missing = cache.get_many(keys, payloads)
+
+        if len(missing) != 0:
+            missing_set = set(missing)
+            if key_of is None:
+                to_insert = missing_set
+            else:
+                to_insert = [e for e in entries if key_of(e) in missing_set]
+
+            self.db.insert_many(table, fields, mapping, to_insert, do_update = True)
+
+            new_ids = self.db.select_many(table, (key_column, 'id'), key_column, list(missing_set))
+            if key_of is None:
+                cache.update(new_ids)
+            else:
+                cache.update(new_ids, dict((key_of(e), tuple(e)) for e in to_insert))
+            ids.update(new_ids)
 
         if get_ids:
-            return self.db.select_many('files', ('id',), 'name', [f[0] for f in file_data])
+            return [ids.get(k, 0) for k in keys]
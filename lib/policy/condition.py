@@ -1,3 +1,5 @@
+import time
+
 from dynamo.policy.predicates import Predicate
 
 class Condition(object):
@@ -7,6 +9,11 @@ class Condition(object):
         self.text = text
         self.predicates = []
         self.required_attrs = set()
+        # text of the individual predicates, in the same order as self.predicates
+        self.predicate_texts = []
+
+        # When True, match() records per-predicate evaluation counts and timing
+        self.profile = False
 
         pred_strs = map(str.strip, text.split(' and '))
 
@@ -34,6 +41,7 @@ class Condition(object):
             rhs_expr = ' '.join(words[2:])
 
             self.predicates.append(Predicate.get(variable, operator, rhs_expr))
+            self.predicate_texts.append(pred_str)
 
     def __str__(self):
         return 'Condition \'%s\'' % self.text
@@ -42,12 +50,36 @@ class Condition(object):
         return 'Condition(\'%s\')' % self.text
 
     def match(self, obj):
+        if self.profile:
+            return self._match_profiled(obj)
+
+        return self._match(obj)
+
+    def _match(self, obj):
         for predicate in self.predicates:
             if not predicate(obj):
                 return False
 
         return True
 
+    def _match_profiled(self, obj):
+        for predicate in self.predicates:
+            start = time.time()
+            result = predicate(obj)
+            predicate.time_spent += time.time() - start
+            predicate.num_evaluated += 1
+
+            if not result:
+                return False
+
+            predicate.num_matched += 1
+
+        return True
+
+    def reset_stats(self):
+        for predicate in self.predicates:
+            predicate.reset_stats()
+
     def get_variable(self, expr, variables):
         """Return an Attr object using the expr from the given variables dictionary."""
 
@@ -33,6 +33,14 @@ class Predicate(object):
     def __init__(self, variable):
         self.variable = variable
 
+        # Evaluation statistics, filled only when the owning Condition is profiled
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_evaluated = 0
+        self.num_matched = 0
+        self.time_spent = 0.
+
     def __call__(self, obj):
         """
         Call _eval of the inherited classes.
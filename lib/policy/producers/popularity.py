@@ -1,5 +1,8 @@
 import logging
 import calendar
+import sqlite3
+import threading
+import time
 
 LOG = logging.getLogger(__name__)
 
@@ -19,6 +22,15 @@ class FilePopularity(object):
     Sets one attr:
       last_access:  timestamp
       num_access:   int
+
+    Usage is accumulated per dataset in a persistent SQLite store (config.cache_file; in-memory if not given).
+    Each load only folds in the usage rows with last_access not older than the high-water mark of the namespace,
+    and then fills the dataset attributes in bulk from the store. Rows of files not (yet) in the inventory are
+    kept pending in the store and retried at every load for config.pending_lifetime seconds (default 30 days).
+    Store entries of datasets that are no longer in the inventory are dropped at every load.
+
+    The per-file access counts of the usage summary are assumed to be cumulative. A count that goes down (e.g.
+    the summary was reset) becomes the new baseline of the file and does not reduce the dataset count.
     """
 
     produces = ['last_access', 'num_access']
@@ -29,32 +41,155 @@ class FilePopularity(object):
         # because config can only hold lists, convert them to tuples
         self.namespaces = map(tuple, config.namespaces)
 
+        self.pending_lifetime = config.get('pending_lifetime', 3600 * 24 * 30)
+
+        self._cache = sqlite3.connect(config.get('cache_file', ':memory:'), check_same_thread = False)
+        self._cache_lock = threading.Lock()
+
+        with self._cache_lock:
+            cursor = self._cache.cursor()
+            # num_access is the raw sum of file accesses; normalization to the number of files happens at fill time
+            cursor.execute('CREATE TABLE IF NOT EXISTS `files` (`lfn` TEXT PRIMARY KEY, `dataset` TEXT NOT NULL, `num_access` INTEGER NOT NULL, `last_access` INTEGER NOT NULL)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS `files_dataset` ON `files` (`dataset`)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS `datasets` (`name` TEXT PRIMARY KEY, `num_access` INTEGER NOT NULL, `last_access` INTEGER NOT NULL)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS `high_water_marks` (`namespace` TEXT PRIMARY KEY, `last_access` INTEGER NOT NULL)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS `pending` (`lfn` TEXT PRIMARY KEY, `namespace` TEXT NOT NULL, `num_access` INTEGER NOT NULL, `last_access` INTEGER NOT NULL)')
+            self._cache.commit()
+
     def load(self, inventory):
+        with self._cache_lock:
+            for namespace, replacement in self.namespaces:
+                self._update_cache(inventory, namespace, replacement)
+
+            self._prune_cache(inventory)
+            self._fill_attributes(inventory)
+
+    def _update_cache(self, inventory, namespace, replacement):
+        """
+        Fold the usage rows not older than the high-water mark of the namespace and the pending rows into the store.
+        File usage summary values are cumulative, so a file whose last_access did not move has nothing new to add,
+        and folding the same row again is harmless. Negative deltas are clamped at 0.
+        """
+
+        cursor = self._cache.cursor()
+
+        cursor.execute('SELECT `last_access` FROM `high_water_marks` WHERE `namespace` = ?', (namespace,))
+        row = cursor.fetchone()
+        if row is None:
+            high_water_mark = 0
+        else:
+            high_water_mark = row[0]
+
+        usage_summary = self.pop_engine.get_namespace_usage_summary(namespace)
+
+        # new rows keyed by LFN
+        updates = {}
+        new_mark = high_water_mark
+
+        for (name, n_access, last_access) in usage_summary:
+            # last_access is given in datetime.datetime
+            utc_access = calendar.timegm(last_access.utctimetuple())
+            # rows with the same timestamp as the mark may have arrived after the last load
+            if utc_access < high_water_mark:
+                continue
+
+            updates[replacement + name] = (n_access, utc_access)
+            if utc_access > new_mark:
+                new_mark = utc_access
+
+        # rows of files that could not be resolved in the previous loads (superseded by newer summary rows)
+        for lfn, n_access, utc_access in cursor.execute('SELECT `lfn`, `num_access`, `last_access` FROM `pending` WHERE `namespace` = ?', (namespace,)).fetchall():
+            if lfn not in updates:
+                updates[lfn] = (n_access, utc_access)
+
+        if len(updates) == 0:
+            return
+
+        LOG.info('Folding %d new file usage records of namespace %s into the popularity store.', len(updates), namespace)
+
+        # previously recorded values of the updated files
+        known = {}
+        lfns = updates.keys()
+        for pos in xrange(0, len(lfns), 500):
+            chunk = lfns[pos:pos + 500]
+            sql = 'SELECT `lfn`, `dataset`, `num_access` FROM `files` WHERE `lfn` IN (%s)' % ','.join(['?'] * len(chunk))
+            for lfn, dataset_name, num_access in cursor.execute(sql, chunk):
+                known[lfn] = (dataset_name, num_access)
 
-        # need namespace
-        for namespace, replacement in self.namespaces:
-
-            usage_summary = self.pop_engine.get_namespace_usage_summary(namespace)
-    
-            for (name,n_access,last_access) in usage_summary:
-                
-                # last_access is given in datetime.datetime
-                utc_access = calendar.timegm(last_access.utctimetuple())
-    
-                lfn = replacement + name
+        file_rows = []
+        pending_rows = []
+        # dataset name -> [access delta, last access]
+        dataset_deltas = {}
+
+        for lfn, (n_access, utc_access) in updates.iteritems():
+            try:
+                dataset_name, num_access = known[lfn]
+            except KeyError:
+                # only files never seen before need to be resolved through the inventory
                 file_object = inventory.find_file(lfn)
                 if file_object is None:
+                    pending_rows.append((lfn, namespace, n_access, utc_access))
                     continue
 
-                dataset = file_object.block.dataset
-                attribute = dataset.attr
-    
-                if 'num_access' not in attribute:
-                    attribute['num_access'] = float(n_access) / dataset.num_files
-                else:
-                    attribute['num_access'] += float(n_access) / dataset.num_files
-    
-                if 'last_access' not in attribute:
-                    attribute['last_access'] = utc_access
-                elif attribute['last_access'] < utc_access:
-                    attribute['last_access'] = utc_access
+                dataset_name = file_object.block.dataset.name
+                num_access = 0
+
+            file_rows.append((lfn, dataset_name, n_access, utc_access))
+
+            try:
+                delta = dataset_deltas[dataset_name]
+            except KeyError:
+                delta = dataset_deltas[dataset_name] = [0, 0]
+
+            if n_access > num_access:
+                delta[0] += n_access - num_access
+            if delta[1] < utc_access:
+                delta[1] = utc_access
+
+        cursor.executemany('INSERT OR REPLACE INTO `files` VALUES (?, ?, ?, ?)', file_rows)
+        cursor.executemany('DELETE FROM `pending` WHERE `lfn` = ?', ((row[0],) for row in file_rows))
+        cursor.executemany('INSERT OR REPLACE INTO `pending` VALUES (?, ?, ?, ?)', pending_rows)
+
+        cursor.executemany('INSERT OR IGNORE INTO `datasets` VALUES (?, 0, 0)', ((name,) for name in dataset_deltas.iterkeys()))
+        sql = 'UPDATE `datasets` SET `num_access` = `num_access` + ?, `last_access` = MAX(`last_access`, ?) WHERE `name` = ?'
+        cursor.executemany(sql, ((n, t, name) for name, (n, t) in dataset_deltas.iteritems()))
+
+        cursor.execute('INSERT OR REPLACE INTO `high_water_marks` VALUES (?, ?)', (namespace, new_mark))
+
+        self._cache.commit()
+
+    def _prune_cache(self, inventory):
+        """
+        Drop the pending rows older than pending_lifetime and the entries of datasets not in the inventory.
+        """
+
+        cursor = self._cache.cursor()
+
+        oldest = int(time.time()) - self.pending_lifetime
+        cursor.execute('DELETE FROM `pending` WHERE `last_access` < ?', (oldest,))
+        if cursor.rowcount > 0:
+            LOG.info('Dropped %d unresolved file usage records older than %d seconds.', cursor.rowcount, self.pending_lifetime)
+
+        deleted = [name for name in cursor.execute('SELECT `name` FROM `datasets`').fetchall() if name[0] not in inventory.datasets]
+        if len(deleted) != 0:
+            LOG.info('Dropping %d datasets no longer in the inventory from the popularity store.', len(deleted))
+            cursor.executemany('DELETE FROM `files` WHERE `dataset` = ?', deleted)
+            cursor.executemany('DELETE FROM `datasets` WHERE `name` = ?', deleted)
+
+        self._cache.commit()
+
+    def _fill_attributes(self, inventory):
+        cursor = self._cache.cursor()
+
+        for dataset_name, num_access, last_access in cursor.execute('SELECT `name`, `num_access`, `last_access` FROM `datasets`'):
+            try:
+                dataset = inventory.datasets[dataset_name]
+            except KeyError:
+                continue
+
+            if dataset.num_files == 0:
+                continue
+
+            attribute = dataset.attr
+            attribute['num_access'] = float(num_access) / dataset.num_files
+            attribute['last_access'] = last_access
@@ -3,6 +3,10 @@ import sys
 import logging
 import time
 import re
+import json
+import tempfile
+import itertools
+import threading
 import multiprocessing
 from ConfigParser import ConfigParser
 
@@ -28,6 +32,241 @@ else:
 from dynamo.dataformat import Configuration
 
 LOG = logging.getLogger(__name__)
+SLOW_LOG = logging.getLogger(__name__ + '.slow')
+
+class QueryStats(object):
+    """
+    Aggregates of the statements executed in this process, keyed by the statement template (SQL text with
+    literals replaced by ? and value lists collapsed). MySQL.stats is the process-wide instance.
+    """
+
+    # Upper edges of the timing histogram bins in seconds. The last bin is open-ended.
+    bin_edges = (0.001, 0.01, 0.1, 1., 10., 100.)
+
+    _literal_pattern = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b""")
+    _list_pattern = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+    _rows_pattern = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+    _space_pattern = re.compile(r'\s+')
+
+    @staticmethod
+    def make_template(sql):
+        template = QueryStats._literal_pattern.sub('?', sql)
+        template = QueryStats._list_pattern.sub('(?)', template)
+        template = QueryStats._rows_pattern.sub('(?)', template)
+        # (?) lists nested in a tuple IN list, e.g. ((?),(?)) -> (?)
+        template = QueryStats._list_pattern.sub('(?)', template)
+
+        return QueryStats._space_pattern.sub(' ', template).strip()[:1000]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {template: [count, total time, max time, rows, retries, lock wait, histogram]}
+        self._templates = {}
+        self.start_time = time.time()
+
+    def empty(self):
+        return len(self._templates) == 0
+
+    def add(self, sql, duration, lock_wait, num_rows, num_retries):
+        template = QueryStats.make_template(sql)
+
+        ibin = 0
+        while ibin != len(QueryStats.bin_edges) and duration >= QueryStats.bin_edges[ibin]:
+            ibin += 1
+
+        with self._lock:
+            try:
+                entry = self._templates[template]
+            except KeyError:
+                entry = self._templates[template] = [0, 0., 0., 0, 0, 0., [0] * (len(QueryStats.bin_edges) + 1)]
+
+            entry[0] += 1
+            entry[1] += duration
+            if duration > entry[2]:
+                entry[2] = duration
+            entry[3] += num_rows
+            entry[4] += num_retries
+            entry[5] += lock_wait
+            entry[6][ibin] += 1
+
+    def get(self):
+        """
+        @return {'start_time': t, 'end_time': t, 'bin_edges': [..], 'templates': [{..}]}, templates sorted by total time.
+        """
+
+        templates = []
+
+        with self._lock:
+            for template, (count, total_time, max_time, num_rows, num_retries, lock_wait, histogram) in self._templates.iteritems():
+                templates.append({
+                    'template': template,
+                    'count': count,
+                    'total_time': total_time,
+                    'mean_time': total_time / count,
+                    'max_time': max_time,
+                    'rows': num_rows,
+                    'retries': num_retries,
+                    'lock_wait': lock_wait,
+                    'histogram': list(histogram)
+                })
+
+        templates.sort(key = lambda t: t['total_time'], reverse = True)
+
+        return {'start_time': self.start_time, 'end_time': time.time(), 'bin_edges': list(QueryStats.bin_edges), 'templates': templates}
+
+    def dump(self, path):
+        """
+        Write the output of get() to a JSON file.
+        """
+
+        with open(path, 'w') as out:
+            json.dump(self.get(), out, indent = 1)
+
+
+class ConnectionPool(object):
+    """
+    Connections shared by the threads using one pooled MySQL interface (see MySQL.pool_size).
+    Each checked-out connection belongs to one thread until it is checked back in or discarded.
+    Idle connections are pinged before reuse when they have been idle longer than ping_interval,
+    and closed when idle longer than idle_timeout. Connections held by threads that have exited
+    are reclaimed when the pool runs out.
+    """
+
+    def __init__(self, parameters, size, ping_interval, idle_timeout):
+        self.parameters = parameters
+        self.size = size
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+
+        # [(connection, last checkin time)], oldest first
+        self._idle = []
+        # {thread ident: connection} (connection is None while it is being opened)
+        self._owners = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    def checkout(self):
+        """
+        Return an open connection for the calling thread. Blocks while the pool is exhausted.
+        """
+
+        ident = threading.current_thread().ident
+
+        with self._cond:
+            while True:
+                self._reap_idle()
+
+                while len(self._idle) != 0:
+                    connection, last_used = self._idle.pop()
+                    if time.time() - last_used > self.ping_interval:
+                        try:
+                            connection.ping()
+                        except MySQLdb.Error:
+                            LOG.debug('Dropping a dead pooled connection.')
+                            self._close(connection)
+                            continue
+
+                    self._owners[ident] = connection
+                    return connection
+
+                if len(self._owners) < self.size:
+                    # reserve the slot and open the connection outside the lock
+                    self._owners[ident] = None
+                    break
+
+                self._reap_orphans()
+                if len(self._owners) < self.size:
+                    continue
+
+                self._cond.wait(1.)
+
+        try:
+            connection = MySQLdb.connect(**self.parameters)
+        except:
+            with self._cond:
+                self._owners.pop(ident, None)
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._owners[ident] = connection
+
+        return connection
+
+    def checkin(self):
+        """
+        Put the connection of the calling thread back to the idle list.
+        """
+
+        with self._cond:
+            connection = self._owners.pop(threading.current_thread().ident, None)
+            if connection is not None:
+                self._idle.append((connection, time.time()))
+            self._cond.notify()
+
+    def discard(self):
+        """
+        Close the connection of the calling thread and free its slot.
+        """
+
+        with self._cond:
+            connection = self._owners.pop(threading.current_thread().ident, None)
+            self._cond.notify_all()
+
+        if connection is not None:
+            self._close(connection)
+
+    def close_idle(self):
+        with self._cond:
+            while len(self._idle) != 0:
+                self._close(self._idle.pop()[0])
+
+    def _reap_idle(self):
+        now = time.time()
+        while len(self._idle) != 0 and now - self._idle[0][1] > self.idle_timeout:
+            self._close(self._idle.pop(0)[0])
+
+    def _reap_orphans(self):
+        alive = set(thread.ident for thread in threading.enumerate())
+        for ident in self._owners.keys():
+            if ident not in alive:
+                LOG.debug('Reclaiming the pooled connection of exited thread %s.', ident)
+                connection = self._owners.pop(ident)
+                if connection is not None:
+                    self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+
+class SessionState(object):
+    """
+    Connection and the state tied to it. One instance per MySQL object in the default mode.
+    """
+
+    def __init__(self, lock_type):
+        self.connection = None
+        # Avoid interference in case the module is used from multiple threads
+        self.lock = lock_type()
+        # MySQL tables can be locked by multiple statements but are unlocked with one.
+        # In nested functions with each one locking different tables, we need to call UNLOCK TABLES
+        # only after the outermost function asks for it.
+        self.locked_tables = []
+        # Temporary tables created and not yet dropped
+        self.tmp_tables = set()
+        # Depth of start_session calls
+        self.session_depth = 0
+        self.last_insert_id = 0
+
+
+class ThreadSessionState(threading.local, SessionState):
+    """
+    Per-thread SessionState used in the pooled mode.
+    """
+
 
 class MySQL(object):
     """Generic thread-safe MySQL interface (for an interface)."""
@@ -35,6 +274,12 @@ class MySQL(object):
     _default_config = Configuration()
     _default_parameters = {'': {}} # {user: config}
 
+    # Suffix of temporary tables made by _execute_on_tmp_table
+    _tmp_table_serial = itertools.count()
+
+    # Process-wide query statistics, filled by the instances with collect_stats
+    stats = QueryStats()
+
     @staticmethod
     def set_default(config):
         MySQL._default_config = Configuration(config)
@@ -77,6 +322,24 @@ class MySQL(object):
     @staticmethod
     def make_tuple(obj):
         return (obj,)
+
+    @staticmethod
+    def tsv_escape(value):
+        """
+        Converts a value to a field string for LOAD DATA INFILE with the default FIELDS and LINES options.
+        """
+        if value is None:
+            return '\\N'
+        elif type(value) is bool:
+            return '1' if value else '0'
+        elif type(value) is str:
+            return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+        elif type(value) is unicode:
+            return MySQL.tsv_escape(value.encode('utf-8'))
+        elif type(value) is float:
+            return repr(value)
+        else:
+            return str(value)
     
     def __init__(self, config = None):
         config = Configuration(config)
@@ -108,17 +371,26 @@ class MySQL(object):
         if 'db' in config:
             self._connection_parameters['db'] = config['db']
 
-        self._connection = None
-
-        # Avoid interference in case the module is used from multiple threads
-        self._connection_lock = multiprocessing.RLock()
+        # Allow LOAD DATA LOCAL INFILE (used by load_many)
+        if config.get('local_infile', MySQL._default_config.get('local_infile', False)):
+            self._connection_parameters['local_infile'] = 1
+
+        # Number of connections shared among the threads using this interface. If 0, all threads share one
+        # connection and are serialized by one lock. Otherwise each thread works on its own connection:
+        # with reuse_connection, a thread keeps its connection until release() or its exit; without, the
+        # connection goes back to the pool after each statement unless the thread is in a session.
+        self.pool_size = config.get('pool_size', MySQL._default_config.get('pool_size', 0))
+
+        if self.pool_size > 0:
+            ping_interval = config.get('pool_ping_interval', MySQL._default_config.get('pool_ping_interval', 60))
+            idle_timeout = config.get('pool_idle_timeout', MySQL._default_config.get('pool_idle_timeout', 600))
+            self._pool = ConnectionPool(self._connection_parameters, self.pool_size, ping_interval, idle_timeout)
+            self._state = ThreadSessionState(threading.RLock)
+        else:
+            self._pool = None
+            self._state = SessionState(multiprocessing.RLock)
 
-        # MySQL tables can be locked by multiple statements but are unlocked with one.
-        # In nested functions with each one locking different tables, we need to call UNLOCK TABLES
-        # only after the outermost function asks for it.
-        self._locked_tables = []
-        
-        # Use with care! If False, table locks and temporary tables cannot be used
+        # Use with care! If False, table locks and temporary tables cannot be used outside of a session
         self.reuse_connection = config.get('reuse_connection', MySQL._default_config.get('reuse_connection', True))
 
         # Default 1M characters
@@ -127,10 +399,58 @@ class MySQL(object):
         # Default database for CREATE TEMPORARY TABLE
         self.scratch_db = config.get('scratch_db', MySQL._default_config.get('scratch_db', ''))
 
-        # Row id of the last insertion. Will be nonzero if the table has an auto-increment primary key.
-        # **NOTE** While core execution of query() and xquery() are locked and thread-safe, last_insert_id is not.
-        # Use insert_and_get_id() in a threaded environment.
-        self.last_insert_id = 0
+        # Pools in execute_many etc. longer than this are loaded into a temporary table in scratch_db and
+        # joined against instead of being expanded into IN lists. 0 = never (default).
+        # Only for SELECTs or servers that can semi-join in UPDATE / DELETE (MySQL >= 8.0.21); otherwise the
+        # subquery is evaluated per row of the target table. String keys are compared as binary (case-sensitive).
+        self.tmp_join_threshold = config.get('tmp_join_threshold', MySQL._default_config.get('tmp_join_threshold', 0))
+
+        # Record each statement executed through query() and xquery() in MySQL.stats
+        self.collect_stats = config.get('collect_stats', MySQL._default_config.get('collect_stats', False))
+
+        # Statements taking longer than this many seconds are reported to the <module>.slow logger. 0 = never.
+        self.slow_query_time = config.get('slow_query_time', MySQL._default_config.get('slow_query_time', 0))
+
+        # Also report the EXPLAIN output of slow SELECT statements
+        self.slow_query_explain = config.get('slow_query_explain', MySQL._default_config.get('slow_query_explain', False))
+
+    # Connection and session attributes live in self._state, which is per thread in the pooled mode.
+
+    @property
+    def _connection(self):
+        return self._state.connection
+
+    @_connection.setter
+    def _connection(self, connection):
+        if connection is None:
+            if self._pool is not None and self._state.connection is not None:
+                self._pool.discard()
+
+            # temporary tables go away with the connection
+            self._state.tmp_tables.clear()
+
+        self._state.connection = connection
+
+    @property
+    def _connection_lock(self):
+        return self._state.lock
+
+    @property
+    def _locked_tables(self):
+        return self._state.locked_tables
+
+    @property
+    def last_insert_id(self):
+        """
+        Row id of the last insertion. Will be nonzero if the table has an auto-increment primary key.
+        **NOTE** In the default mode, while core execution of query() and xquery() are locked and thread-safe,
+        last_insert_id is not. Use insert_get_id() in a threaded environment. In the pooled mode the value is per thread.
+        """
+        return self._state.last_insert_id
+
+    @last_insert_id.setter
+    def last_insert_id(self, value):
+        self._state.last_insert_id = value
 
     def db_name(self):
         return self._connection_parameters['db']
@@ -149,10 +469,58 @@ class MySQL(object):
         return self.query('SELECT @@hostname')[0]
 
     def close(self):
+        """
+        Close the connection. In the pooled mode, close the connection of the calling thread and all idle connections.
+        """
         if self._connection is not None:
             self._connection.close()
             self._connection = None
 
+        if self._pool is not None:
+            self._pool.close_idle()
+
+    def release(self):
+        """
+        Pooled mode: hand the connection of the calling thread back to the pool. Threads of a pooled interface with
+        reuse_connection should call this when they are done with the database. A connection with locked tables or
+        in a session is kept, and one with temporary tables left is closed instead of pooled.
+        """
+        if self._pool is None or self._connection is None:
+            return
+
+        if self._is_pinned():
+            return
+
+        if len(self._state.tmp_tables) != 0:
+            self._connection = None
+        else:
+            self._pool.checkin()
+            self._state.connection = None
+
+    def start_session(self):
+        """
+        Pin the connection of the calling thread until the matching end_session(). Temporary tables and table locks
+        can be used within a session even when reuse_connection is False. Sessions can be nested.
+        """
+        self._connection_lock.acquire()
+        self._state.session_depth += 1
+
+    def end_session(self):
+        try:
+            if self._state.session_depth == 0:
+                raise RuntimeError('Call to end_session does not match start_session')
+
+            self._state.session_depth -= 1
+
+            if self._state.session_depth == 0 and not self.reuse_connection:
+                self.close_cursor(None)
+
+        except:
+            self._fully_unlock()
+            raise
+        else:
+            self._connection_lock.release()
+
     def config(self):
         conf = Configuration()
         for key in ['host', 'user', 'passwd', 'db']:
@@ -170,14 +538,26 @@ class MySQL(object):
             pass
 
         conf['reuse_connection'] = self.reuse_connection
+        conf['pool_size'] = self.pool_size
+        if self._pool is not None:
+            conf['pool_ping_interval'] = self._pool.ping_interval
+            conf['pool_idle_timeout'] = self._pool.idle_timeout
         conf['max_query_len'] = self.max_query_len
         conf['scratch_db'] = self.scratch_db
+        conf['tmp_join_threshold'] = self.tmp_join_threshold
+        conf['collect_stats'] = self.collect_stats
+        conf['slow_query_time'] = self.slow_query_time
+        conf['slow_query_explain'] = self.slow_query_explain
+        conf['local_infile'] = ('local_infile' in self._connection_parameters)
 
         return conf
 
     def get_cursor(self, cursor_cls = MySQLdb.connections.Connection.default_cursor):
         if self._connection is None:
-            self._connection = MySQLdb.connect(**self._connection_parameters)
+            if self._pool is None:
+                self._connection = MySQLdb.connect(**self._connection_parameters)
+            else:
+                self._connection = self._pool.checkout()
 
         return self._connection.cursor(cursor_cls)
 
@@ -185,9 +565,15 @@ class MySQL(object):
         if cursor is not None:
             cursor.close()
     
-        if not self.reuse_connection and self._connection is not None:
-            self._connection.close()
-            self._connection = None
+        if not self.reuse_connection and self._connection is not None and not self._is_pinned():
+            if self._pool is None:
+                self._connection.close()
+                self._connection = None
+            else:
+                self.release()
+
+    def _is_pinned(self):
+        return self._state.session_depth != 0 or len(self._state.locked_tables) != 0
 
     def query(self, sql, *args, **kwd):
         """
@@ -209,7 +595,9 @@ class MySQL(object):
         except KeyError:
             silent = False
 
+        lock_start = time.time()
         self._connection_lock.acquire()
+        lock_wait = time.time() - lock_start
 
         cursor = None
         try:
@@ -222,6 +610,9 @@ class MySQL(object):
                     LOG.debug(sql)
                 else:
                     LOG.debug(sql + ' % ' + str(args))
+
+            num_retries = 0
+            exec_start = time.time()
     
             try:
                 for _ in range(num_attempts):
@@ -239,6 +630,7 @@ class MySQL(object):
                             LOG.error(str(sys.exc_info()[1]))
 
                         last_except = sys.exc_info()[1]
+                        num_retries += 1
 
                         # reconnect to server
                         cursor.close()
@@ -261,6 +653,14 @@ class MySQL(object):
     
             result = cursor.fetchall()
 
+            if self.collect_stats or self.slow_query_time > 0:
+                if cursor.description is None:
+                    num_rows = cursor.rowcount
+                else:
+                    num_rows = len(result)
+
+                self._record(sql, args, time.time() - exec_start, lock_wait, num_rows, num_retries)
+
             if cursor.description is None:
                 # Was an insert, update, or delete query - really? Is there no other way to identify this?
                 if cursor.lastrowid != 0:
@@ -342,7 +742,9 @@ class MySQL(object):
          - values if one column is called
         """
 
+        lock_start = time.time()
         self._connection_lock.acquire()
+        lock_wait = time.time() - lock_start
 
         cursor = None
         try:
@@ -355,6 +757,10 @@ class MySQL(object):
                     LOG.debug(sql)
                 else:
                     LOG.debug(sql + ' % ' + str(args))
+
+            timed = self.collect_stats or self.slow_query_time > 0
+            num_retries = 0
+            exec_start = time.time()
     
             try:
                 for _ in range(10):
@@ -364,6 +770,7 @@ class MySQL(object):
                     except MySQLdb.OperationalError:
                         LOG.error(str(sys.exc_info()[1]))
                         last_except = sys.exc_info()[1]
+                        num_retries += 1
                         # reconnect to server
                         cursor.close()
                         self._connection = None
@@ -381,18 +788,31 @@ class MySQL(object):
     
             if cursor.description is None:
                 raise RuntimeError('xquery cannot be used for non-SELECT statements')
+
+            # time spent by the caller between the rows is not counted
+            exec_time = time.time() - exec_start
+            num_rows = 0
     
             row = cursor.fetchone()
             if row is not None:
                 single_column = (len(row) == 1)
         
                 while row:
+                    num_rows += 1
                     if single_column:
                         yield row[0]
                     else:
                         yield row
         
-                    row = cursor.fetchone()
+                    if timed:
+                        fetch_start = time.time()
+                        row = cursor.fetchone()
+                        exec_time += time.time() - fetch_start
+                    else:
+                        row = cursor.fetchone()
+
+            if timed:
+                self._record(sql, args, exec_time, lock_wait, num_rows, num_retries)
 
             self.close_cursor(cursor)
             self._connection_lock.release()
@@ -550,6 +970,90 @@ class MySQL(object):
 
         return num_inserted
 
+    def load_many(self, table, fields, mapping, objects, db = ''):
+        """
+        Bulk version of insert_many without update. Rows are streamed as TSV through a named pipe, which is
+        ingested with LOAD DATA LOCAL INFILE while being written. Falls back to insert_many if local_infile is not
+        enabled for this interface.
+        @param table          Table name.
+        @param fields         Name of columns. If None, all columns are filled.
+        @param mapping        Typically a lambda that takes an element in the objects list and return a tuple corresponding to a row to insert.
+        @param objects        List or iterator of objects to insert. Iterated in a separate thread; must not use this interface.
+        @param db             DB name.
+
+        @return  total number of inserted rows.
+        """
+
+        if 'local_infile' not in self._connection_parameters:
+            return self.insert_many(table, fields, mapping, objects, do_update = False, db = db)
+
+        try:
+            if len(objects) == 0:
+                return 0
+        except TypeError:
+            pass
+
+        if db == '':
+            db = self.db_name()
+
+        pipe_dir = tempfile.mkdtemp(prefix = 'dynamo_')
+        pipe_path = os.path.join(pipe_dir, table + '.tsv')
+        os.mkfifo(pipe_path, 0600)
+
+        # Writer thread feeds the pipe while the server reads from it. Exceptions are passed back through writer_error.
+        writer_error = []
+
+        def write_rows():
+            # objects must be iterated entirely in this thread (e.g. an xquery generator holds a lock while iterating)
+            itr = iter(objects)
+            try:
+                # blocks until LOAD DATA opens the pipe
+                with open(pipe_path, 'w') as pipe:
+                    for row in itr:
+                        if mapping is not None:
+                            row = mapping(row)
+
+                        pipe.write('\t'.join(MySQL.tsv_escape(v) for v in row))
+                        pipe.write('\n')
+            except:
+                writer_error.append(sys.exc_info())
+            finally:
+                if hasattr(itr, 'close'):
+                    # release e.g. the connection held by an xquery generator
+                    itr.close()
+
+        writer = threading.Thread(target = write_rows, name = 'load_many')
+        writer.daemon = True
+        writer.start()
+
+        try:
+            sql = 'LOAD DATA LOCAL INFILE %s INTO TABLE `{0}`.`{1}`'.format(db, table)
+            if fields:
+                sql += ' (%s)' % ','.join('`%s`' % f for f in fields)
+
+            # no retry - the pipe can be read only once
+            num_rows = self.query(sql, pipe_path, retries = 0)
+
+        finally:
+            while writer.is_alive():
+                # If LOAD DATA failed, the writer may be stuck opening or writing to the pipe. Opening and closing
+                # the read end unblocks the open, and the next write fails on the closed pipe.
+                try:
+                    os.close(os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+
+                writer.join(0.1)
+            os.unlink(pipe_path)
+            os.rmdir(pipe_dir)
+
+        if len(writer_error) != 0:
+            # the pipe was closed early and the load is incomplete
+            exc_type, exc, tb = writer_error[0]
+            raise exc_type, exc, tb
+
+        return num_rows
+
     def insert_select_many(self, insert_table, insert_fields, select_table, select_fields, key, pool, do_update = True, db = '', update_columns = None, additional_conditions = [], order_by = ''):
         """
         INSERT INTO insert_table (insert_fields) SELECT select_fields FROM select_table WHERE key IN pool
@@ -613,8 +1117,8 @@ class MySQL(object):
         @param write  Same as read
         """
 
-        if not self.reuse_connection:
-            raise RuntimeError('MySQL locks cannot be used when reuse_connection = False.')
+        if not self.reuse_connection and self._state.session_depth == 0:
+            raise RuntimeError('MySQL locks cannot be used when reuse_connection = False outside of a session.')
 
         terms = []
 
@@ -757,6 +1261,21 @@ class MySQL(object):
             execute(pool_expr)
             return
 
+        if self.tmp_join_threshold > 0 and self.scratch_db:
+            # look ahead to see if the pool is large enough for a temporary table
+            head = [obj]
+            head.extend(itertools.islice(itr, self.tmp_join_threshold))
+            if len(head) > self.tmp_join_threshold:
+                # column types are determined from the full pool
+                head.extend(itr)
+                columns = MySQL._tmp_key_columns(head)
+                if columns is not None:
+                    self._execute_on_tmp_table(execute, head, columns)
+                    return
+
+            itr = iter(head)
+            obj = itr.next()
+
         # type-checking the element - all elements must share a type
         if type(obj) is tuple or type(obj) is list:
             escape = MySQL.stringify_sequence
@@ -789,6 +1308,114 @@ class MySQL(object):
 
             execute(pool_expr)
 
+    @staticmethod
+    def _tmp_key_columns(pool):
+        """
+        Column definitions of the temporary key table for the pool. Strings are stored as binary to avoid collation
+        mismatches with the joined table, in columns sized to the longest value.
+        @param pool  List of scalars or tuples
+        @return List of column definitions (keys k0, k1, ..), or None if the pool cannot be loaded into a key table
+                (element types not uniform or not supported, e.g. None, Decimal, datetime, or keys too long).
+        """
+
+        if type(pool[0]) is tuple or type(pool[0]) is list:
+            num_columns = len(pool[0])
+            rows = pool
+        else:
+            num_columns = 1
+            rows = ((v,) for v in pool)
+
+        # column kind and maximum string length in bytes
+        kinds = [None] * num_columns
+        str_lens = [1] * num_columns
+
+        for row in rows:
+            if len(row) != num_columns:
+                return None
+
+            for icol, value in enumerate(row):
+                vtype = type(value)
+                if vtype is bool:
+                    kind = 'bool'
+                elif vtype is int or vtype is long:
+                    kind = 'int'
+                elif vtype is float:
+                    kind = 'float'
+                elif vtype is str or vtype is unicode:
+                    kind = 'str'
+                    if vtype is unicode:
+                        value = value.encode('utf-8')
+                    if len(value) > str_lens[icol]:
+                        str_lens[icol] = len(value)
+                else:
+                    return None
+
+                if kinds[icol] is None:
+                    kinds[icol] = kind
+                elif kinds[icol] != kind:
+                    return None
+
+        # MyISAM keys are limited to 1000 bytes (+2 for the length of each varbinary)
+        key_len = sum((str_lens[i] + 2) if kinds[i] == 'str' else 8 for i in xrange(num_columns))
+        if key_len > 1000:
+            return None
+
+        column_types = {'bool': 'tinyint', 'int': 'bigint', 'float': 'double'}
+
+        columns = []
+        for icol, kind in enumerate(kinds):
+            if kind == 'str':
+                column_type = 'varbinary(%d)' % str_lens[icol]
+            else:
+                column_type = column_types[kind]
+
+            columns.append('`k%d` %s NOT NULL' % (icol, column_type))
+
+        columns.append('PRIMARY KEY (%s)' % ','.join('`k%d`' % i for i in xrange(num_columns)))
+
+        return columns
+
+    def _execute_on_tmp_table(self, execute, pool, columns):
+        """
+        Load the pool into a temporary table in scratch_db and call execute once with a subquery on the table.
+        @param columns  Column definitions from _tmp_key_columns
+        """
+
+        pool = iter(pool)
+        obj = pool.next()
+
+        if type(obj) is tuple or type(obj) is list:
+            mapping = None
+        else:
+            mapping = MySQL.make_tuple
+
+        fields = tuple('k%d' % i for i in xrange(len(columns) - 1))
+
+        table = 'many_keys_%d' % MySQL._tmp_table_serial.next()
+
+        self.start_session()
+        try:
+            self.create_tmp_table(table, columns)
+
+            LOG.debug('Loading a large pool into temporary table %s', table)
+
+            pool = itertools.chain([obj], pool)
+            if 'local_infile' in self._connection_parameters:
+                # duplicate keys are skipped by LOAD DATA LOCAL
+                self.load_many(table, fields, mapping, pool, db = self.scratch_db)
+            else:
+                # ON DUPLICATE KEY UPDATE absorbs duplicate keys
+                self.insert_many(table, fields, mapping, pool, db = self.scratch_db)
+
+            execute('(SELECT %s FROM `%s`.`%s`)' % (','.join('`%s`' % f for f in fields), self.scratch_db, table))
+
+            self.drop_tmp_table(table)
+            self.end_session()
+
+        except:
+            self._fully_unlock()
+            raise
+
     def table_exists(self, table, db = ''):
         if not db:
             db = self.db_name()
@@ -803,8 +1430,8 @@ class MySQL(object):
         @param db       Optional DB name (default is scratch_db).
         """
 
-        if not self.reuse_connection:
-            raise RuntimeError('Temporary tables cannot be created when reuse_connection = False.')
+        if not self.reuse_connection and self._state.session_depth == 0:
+            raise RuntimeError('Temporary tables cannot be created when reuse_connection = False outside of a session.')
 
         if not db:
             db = self.scratch_db
@@ -818,6 +1445,8 @@ class MySQL(object):
 
         self.query(sql)
 
+        self._state.tmp_tables.add((db, table))
+
     def truncate_tmp_table(self, table, db = ''):
         if not db:
             db = self.scratch_db
@@ -847,6 +1476,8 @@ class MySQL(object):
 
         self.query('SET sql_notes = 1')
 
+        self._state.tmp_tables.discard((db, table))
+
     def make_map(self, table, objects, object_id_map = None, id_object_map = None, key = None, tmp_join = False):
         objitr = iter(objects)
 
@@ -889,8 +1520,40 @@ class MySQL(object):
 
         LOG.debug('make_map %s (%d) obejcts', table, num_obj)
 
+    def _record(self, sql, args, duration, lock_wait, num_rows, num_retries):
+        """
+        Add an executed statement to the statistics and report it if slow. Called while the connection is still held.
+        """
+
+        if self.collect_stats:
+            MySQL.stats.add(sql, duration, lock_wait, num_rows, num_retries)
+
+        if self.slow_query_time <= 0 or duration < self.slow_query_time:
+            return
+
+        SLOW_LOG.warning('%.3f s (lock wait %.3f s, %d rows, %d retries): %s', duration, lock_wait, num_rows, num_retries, sql[:10000])
+        if len(args) != 0:
+            SLOW_LOG.warning('Arguments: %s', str(args)[:10000])
+
+        if not self.slow_query_explain or sql.lstrip()[:6].upper() != 'SELECT':
+            return
+
+        cursor = None
+        try:
+            cursor = self._connection.cursor()
+            cursor.execute('EXPLAIN ' + sql, args)
+            columns = [desc[0] for desc in cursor.description]
+            for row in cursor.fetchall():
+                SLOW_LOG.warning('EXPLAIN: %s', ', '.join('%s=%s' % item for item in zip(columns, row)))
+        except MySQLdb.Error:
+            SLOW_LOG.warning('EXPLAIN failed: %s', str(sys.exc_info()[1]))
+        finally:
+            if cursor is not None:
+                cursor.close()
+
     def _fully_unlock(self):
         # Call when the thread crashed. Fully releases the lock
+        self._state.session_depth = 0
         while True:
             try:
                 self._connection_lock.release()
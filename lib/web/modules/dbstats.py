@@ -0,0 +1,47 @@
+import os
+import json
+
+from dynamo.web.modules._base import WebModule
+from dynamo.web.exceptions import MissingParameter, ExtraParameter, IllFormedRequest, InvalidRequest
+
+class ApplicationDBStats(WebModule):
+    """
+    Show the MySQL query statistics of an application run with collect_stats enabled.
+    The statistics are read from _dbstats.json in the work area, written by the server when the application exits.
+    """
+
+    def __init__(self, config):
+        WebModule.__init__(self, config)
+        self.require_appmanager = True
+
+    def run(self, caller, request, inventory):
+        if 'appid' not in request:
+            raise MissingParameter('appid')
+
+        for key in request.iterkeys():
+            if key != 'appid':
+                raise ExtraParameter(key)
+
+        try:
+            app_id = int(request['appid'])
+        except ValueError:
+            raise IllFormedRequest('appid', request['appid'], hint = 'appid must be an integer')
+
+        applications = self.appmanager.get_applications(app_id = app_id)
+        if len(applications) == 0:
+            raise InvalidRequest('Unknown application %d' % app_id)
+
+        stats_path = applications[0]['path'] + '/_dbstats.json'
+        if not os.path.exists(stats_path):
+            self.message = 'No statistics'
+            return None
+
+        with open(stats_path) as source:
+            return json.load(source)
+
+
+export_data = {
+    'application': ApplicationDBStats
+}
+
+export_web = {}
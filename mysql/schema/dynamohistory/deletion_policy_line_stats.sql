@@ -0,0 +1,11 @@
+CREATE TABLE `deletion_policy_line_stats` (
+  `cycle_id` int(10) NOT NULL,
+  `line` smallint(5) unsigned NOT NULL,
+  `condition_id` int(11) unsigned NOT NULL,
+  `num_evaluated` int(10) unsigned NOT NULL DEFAULT '0',
+  `num_matched` int(10) unsigned NOT NULL DEFAULT '0',
+  `num_block_evaluated` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `num_block_matched` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `time` float NOT NULL DEFAULT '0',
+  PRIMARY KEY (`cycle_id`,`line`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
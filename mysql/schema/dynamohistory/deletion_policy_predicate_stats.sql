@@ -0,0 +1,10 @@
+CREATE TABLE `deletion_policy_predicate_stats` (
+  `cycle_id` int(10) NOT NULL,
+  `line` smallint(5) unsigned NOT NULL,
+  `predicate` smallint(5) unsigned NOT NULL,
+  `text` varchar(512) COLLATE latin1_general_cs NOT NULL,
+  `num_evaluated` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `num_matched` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `time` float NOT NULL DEFAULT '0',
+  PRIMARY KEY (`cycle_id`,`line`,`predicate`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1 COLLATE=latin1_general_cs;
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+
+#######################################################################
+## Local stand-in for an FTS3 server, for testing and benchmarking the
+## FTS file operation backend without a production FTS.
+## Speaks the subset of the FTS3 REST API used by the fts3 python
+## client calls in dynamo.fileop.impl.fts (submit, get_job_status with
+## file lists, list_jobs, cancel) plus the endpoints the client touches
+## when creating a context and checking the delegation.
+## Transfers are simulated per link (source host -> destination host):
+## files on a link are served one after another at the link throughput,
+## after a fixed latency, and fail with the configured probability.
+## File states are computed from the clock when queried; nothing is
+## moved anywhere.
+##
+## Simulation parameters are given in a JSON file (--config):
+## {
+##   "default": {"throughput": 50, "failure_rate": 0.02, "latency": 2},
+##   "links": {"HOST_A->HOST_B": {"throughput": 10, "failure_rate": 0.5}},
+##   "staging": {"latency": 60, "failure_rate": 0},
+##   "deletion": {"rate": 100, "failure_rate": 0, "latency": 1},
+##   "api_latency": 0
+## }
+## throughput in MB/s, rate in files/s, latencies in seconds. Missing
+## entries take the values above.
+#######################################################################
+
+import sys
+import re
+import json
+import time
+import uuid
+import errno
+import random
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'default': {'throughput': 50., 'failure_rate': 0., 'latency': 2.},
+    'links': {},
+    'staging': {'latency': 60., 'failure_rate': 0.},
+    'deletion': {'rate': 100., 'failure_rate': 0., 'latency': 1.},
+    'api_latency': 0.
+}
+
+TERMINAL_STATES = ('FINISHED', 'FAILED', 'CANCELED')
+
+def format_time(t):
+    if t is None:
+        return None
+
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t))
+
+
+class MockFile(object):
+    """
+    One file-level operation. The timeline (start, finish, outcome) is fixed at submission.
+    """
+
+    def __init__(self, file_id, job_id, source_surl, dest_surl, filesize, active_state, start_time, finish_time, failed):
+        self.file_id = file_id
+        self.job_id = job_id
+        self.source_surl = source_surl
+        self.dest_surl = dest_surl
+        self.filesize = filesize
+        # ACTIVE for transfers and deletions, STAGING for staging
+        self.active_state = active_state
+        self.start_time = start_time
+        self.finish_time = finish_time
+        self.failed = failed
+        self.cancel_time = None
+
+    def state(self, now):
+        if self.cancel_time is not None:
+            return 'CANCELED'
+        elif now < self.start_time:
+            return 'SUBMITTED'
+        elif now < self.finish_time:
+            return self.active_state
+        elif self.failed:
+            return 'FAILED'
+        else:
+            return 'FINISHED'
+
+    def to_dict(self, now):
+        state = self.state(now)
+
+        if state == 'FAILED':
+            reason = 'TRANSFER [%d] Simulated failure' % errno.EIO
+        elif state == 'CANCELED':
+            reason = 'Job canceled by the user'
+        else:
+            reason = ''
+
+        if state in TERMINAL_STATES:
+            if self.cancel_time is not None:
+                finish_time = self.cancel_time
+                if self.cancel_time < self.start_time:
+                    start_time = None
+                else:
+                    start_time = self.start_time
+            else:
+                start_time = self.start_time
+                finish_time = self.finish_time
+        elif state == 'SUBMITTED':
+            start_time = None
+            finish_time = None
+        else:
+            start_time = self.start_time
+            finish_time = None
+
+        return {
+            'file_id': self.file_id,
+            'job_id': self.job_id,
+            'file_state': state,
+            'source_surl': self.source_surl,
+            'dest_surl': self.dest_surl,
+            'filesize': self.filesize,
+            'reason': reason,
+            'start_time': format_time(start_time),
+            'finish_time': format_time(finish_time)
+        }
+
+
+class MockJob(object):
+    def __init__(self, job_id, job_type, metadata, submit_time):
+        self.job_id = job_id
+        # 'transfer', 'staging', or 'deletion'
+        self.job_type = job_type
+        self.metadata = metadata
+        self.submit_time = submit_time
+        self.files = []
+
+    def state(self, now):
+        states = set(f.state(now) for f in self.files)
+
+        if len(states) == 0:
+            return 'FINISHED'
+
+        if states <= set(TERMINAL_STATES):
+            if states == set(['FINISHED']):
+                return 'FINISHED'
+            elif states == set(['CANCELED']):
+                return 'CANCELED'
+            elif 'FINISHED' in states:
+                return 'FINISHEDDIRTY'
+            else:
+                return 'FAILED'
+
+        if 'STAGING' in states:
+            return 'STAGING'
+        elif 'ACTIVE' in states:
+            return 'ACTIVE'
+        else:
+            return 'SUBMITTED'
+
+    def to_dict(self, now):
+        return {
+            'job_id': self.job_id,
+            'job_state': self.state(now),
+            'job_type': 'D' if self.job_type == 'deletion' else 'N',
+            'submit_time': format_time(self.submit_time),
+            'job_metadata': self.metadata,
+            'reason': None,
+            'user_dn': '/CN=dynamo',
+            'vo_name': 'dynamo'
+        }
+
+
+class MockFTS(object):
+    """
+    State of the simulated server. Thread-safe.
+    """
+
+    def __init__(self, config = None):
+        self.config = json.loads(json.dumps(DEFAULT_CONFIG))
+        if config is not None:
+            for key, value in config.iteritems():
+                if type(value) is dict and key != 'links':
+                    self.config[key].update(value)
+                else:
+                    self.config[key] = value
+
+        self.jobs = {} # {job_id: MockJob}
+        self._next_file_id = 1
+        self._link_free = {} # {(source host, dest host): time when the link becomes idle}
+        self._lock = threading.Lock()
+
+    def link_params(self, source_host, dest_host):
+        params = dict(self.config['default'])
+        params.update(self.config['links'].get('%s->%s' % (source_host, dest_host), {}))
+        return params
+
+    def submit(self, job_spec):
+        """
+        @param job_spec  Job dictionary made by fts3.new_job, new_staging_job or new_delete_job
+        @return job id
+        """
+
+        now = time.time()
+        params = job_spec.get('params', {})
+        metadata = params.get('job_metadata', None)
+        job_id = str(uuid.uuid4())
+
+        with self._lock:
+            if job_spec.get('delete'):
+                job = MockJob(job_id, 'deletion', metadata, now)
+                dconf = self.config['deletion']
+                start = now + dconf['latency']
+                for entry in job_spec['delete']:
+                    if type(entry) is dict:
+                        surl = entry['surl']
+                    else:
+                        surl = entry
+
+                    # deletions are served sequentially at the given rate
+                    finish = start + 1. / dconf['rate']
+                    failed = random.random() < dconf['failure_rate']
+                    job.files.append(MockFile(self._new_file_id(), job_id, surl, None, None, 'ACTIVE', start, finish, failed))
+                    start = finish
+
+            elif params.get('bring_online', -1) > 0:
+                job = MockJob(job_id, 'staging', metadata, now)
+                sconf = self.config['staging']
+                for transfer in job_spec['files']:
+                    source = transfer['sources'][0]
+                    failed = random.random() < sconf['failure_rate']
+                    job.files.append(MockFile(self._new_file_id(), job_id, source, transfer['destinations'][0], transfer.get('filesize'), 'STAGING', now, now + sconf['latency'], failed))
+
+            else:
+                job = MockJob(job_id, 'transfer', metadata, now)
+                for transfer in job_spec['files']:
+                    source = transfer['sources'][0]
+                    dest = transfer['destinations'][0]
+                    link = (urlparse.urlparse(source).netloc, urlparse.urlparse(dest).netloc)
+                    lconf = self.link_params(*link)
+
+                    size = transfer.get('filesize') or 0
+                    # files on one link are served one after another at the link throughput
+                    start = max(now + lconf['latency'], self._link_free.get(link, 0.))
+                    finish = start + size / (lconf['throughput'] * 1.e+6)
+                    self._link_free[link] = finish
+
+                    failed = random.random() < lconf['failure_rate']
+                    job.files.append(MockFile(self._new_file_id(), job_id, source, dest, size, 'ACTIVE', start, finish, failed))
+
+            self.jobs[job_id] = job
+
+        LOG.debug('Submitted %s job %s with %d files', job.job_type, job_id, len(job.files))
+
+        return job_id
+
+    def get_job(self, job_id):
+        now = time.time()
+        with self._lock:
+            return self.jobs[job_id].to_dict(now)
+
+    def get_files(self, job_id, job_types):
+        now = time.time()
+        with self._lock:
+            job = self.jobs[job_id]
+            if job.job_type not in job_types:
+                return []
+
+            return [f.to_dict(now) for f in job.files]
+
+    def list_jobs(self, states = None):
+        now = time.time()
+        with self._lock:
+            result = []
+            for job in self.jobs.itervalues():
+                state = job.state(now)
+                if states is None:
+                    if state in TERMINAL_STATES or state == 'FINISHEDDIRTY':
+                        continue
+                elif state not in states:
+                    continue
+
+                result.append(job.to_dict(now))
+
+            return result
+
+    def cancel(self, job_id, file_ids = None):
+        now = time.time()
+        with self._lock:
+            job = self.jobs[job_id]
+
+            if file_ids is None:
+                targets = job.files
+            else:
+                targets = [f for f in job.files if f.file_id in file_ids]
+
+            for lfile in targets:
+                if lfile.state(now) not in TERMINAL_STATES:
+                    lfile.cancel_time = now
+
+            if file_ids is None:
+                return job.to_dict(now)
+            else:
+                return [f.state(now) for f in targets]
+
+    def _new_file_id(self):
+        file_id = self._next_file_id
+        self._next_file_id += 1
+        return file_id
+
+
+class MockFTSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Maps the REST calls to the MockFTS methods. self.server.fts is the MockFTS instance.
+    """
+
+    job_pattern = re.compile('/jobs/([^/]+)$')
+    job_files_pattern = re.compile('/jobs/([^/]+)/(files|dm)$')
+    cancel_files_pattern = re.compile('/jobs/([^/]+)/files/([0-9,]+)$')
+    delegation_pattern = re.compile('/delegation/([^/]+)$')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        path = url.path.rstrip('/')
+        query = urlparse.parse_qs(url.query)
+        fts = self.server.fts
+
+        if path == '':
+            self._respond(200, {'api': {'major': 3, 'minor': 0, 'patch': 0}, 'schema': {'major': 3, 'minor': 0, 'patch': 0}, 'delegation': {'major': 1, 'minor': 0, 'patch': 0}})
+            return
+
+        if path == '/whoami':
+            self._respond(200, {'delegation_id': 'mock', 'dn': ['/CN=dynamo'], 'user_dn': '/CN=dynamo', 'vos': ['dynamo']})
+            return
+
+        if self.delegation_pattern.match(path):
+            # Report a long-lived delegation so that the client never tries to delegate
+            self._respond(200, {'termination_time': format_time(time.time() + 86400 * 365), 'voms_attrs': []})
+            return
+
+        if path == '/jobs':
+            if 'state_in' in query:
+                states = set(query['state_in'][0].split(','))
+            else:
+                states = None
+
+            self._respond(200, fts.list_jobs(states))
+            return
+
+        matches = self.job_files_pattern.match(path)
+        if matches:
+            if matches.group(2) == 'files':
+                job_types = ('transfer', 'staging')
+            else:
+                job_types = ('deletion',)
+
+            try:
+                self._respond(200, fts.get_files(matches.group(1), job_types))
+            except KeyError:
+                self._not_found()
+            return
+
+        matches = self.job_pattern.match(path)
+        if matches:
+            try:
+                self._respond(200, fts.get_job(matches.group(1)))
+            except KeyError:
+                self._not_found()
+            return
+
+        self._not_found()
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path.rstrip('/')
+        if path != '/jobs':
+            self._not_found()
+            return
+
+        length = int(self.headers.getheader('content-length', 0))
+        try:
+            job_spec = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._respond(400, {'status': '400 Bad Request', 'message': 'Invalid job description'})
+            return
+
+        job_id = self.server.fts.submit(job_spec)
+        self._respond(200, {'job_id': job_id})
+
+    def do_DELETE(self):
+        path = urlparse.urlparse(self.path).path.rstrip('/')
+        fts = self.server.fts
+
+        try:
+            matches = self.cancel_files_pattern.match(path)
+            if matches:
+                file_ids = set(int(i) for i in matches.group(2).split(','))
+                states = fts.cancel(matches.group(1), file_ids)
+                if len(states) == 1:
+                    self._respond(200, states[0])
+                else:
+                    self._respond(200, states)
+                return
+
+            matches = self.job_pattern.match(path)
+            if matches:
+                self._respond(200, fts.cancel(matches.group(1)))
+                return
+
+        except KeyError:
+            pass
+
+        self._not_found()
+
+    def log_message(self, fmt, *args):
+        LOG.debug('%s - %s', self.address_string(), fmt % args)
+
+    def _not_found(self):
+        self._respond(404, {'status': '404 Not Found', 'message': 'No such resource %s' % self.path})
+
+    def _respond(self, code, content):
+        api_latency = self.server.fts.config['api_latency']
+        if api_latency > 0:
+            time.sleep(api_latency)
+
+        body = json.dumps(content)
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockFTSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server around a MockFTS. Use serve_forever() (possibly in a thread) and shutdown().
+    The server URL to pass as fts_server is http://<host>:<port>.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, config = None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockFTSRequestHandler)
+        self.fts = MockFTS(config)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        """
+        Serve in a daemon thread.
+        """
+
+        thread = threading.Thread(target = self.serve_forever, name = 'MockFTSServer')
+        thread.daemon = True
+        thread.start()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description = 'Mock FTS3 server')
+    parser.add_argument('--host', '-H', metavar = 'HOST', dest = 'host', default = 'localhost', help = 'Address to bind to.')
+    parser.add_argument('--port', '-p', metavar = 'PORT', dest = 'port', type = int, default = 8446, help = 'Port to listen on.')
+    parser.add_argument('--config', '-c', metavar = 'PATH', dest = 'config', help = 'JSON file with simulation parameters.')
+    parser.add_argument('--log-level', '-l', metavar = 'LEVEL', dest = 'log_level', default = 'INFO', help = 'Logging level.')
+
+    args = parser.parse_args()
+    sys.argv = []
+
+    logging.basicConfig(level = getattr(logging, args.log_level.upper()))
+
+    if args.config:
+        with open(args.config) as source:
+            config = json.load(source)
+    else:
+        config = None
+
+    server = MockFTSServer((args.host, args.port), config)
+
+    LOG.info('Mock FTS server listening at %s', server.url)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+#######################################################################
+## Push N synthetic transfer subscriptions through the full RLFSM
+## state machine against a local MySQL and a mock FTS server
+## (fts_mock_server.py in this directory), and report the throughput
+## and the cycle latency.
+## The inventory and history databases (dynamo_bench and
+## dynamohistory_bench by default) are created from mysql/schema if
+## they do not exist and are WIPED at every run. Never point this at
+## a production database.
+## Requires the fts3 REST client in the python path.
+#######################################################################
+
+import os
+import sys
+import json
+import time
+import logging
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description = 'RLFSM throughput benchmark')
+parser.add_argument('--subscriptions', '-n', metavar = 'N', dest = 'num_subscriptions', type = int, default = 10000, help = 'Number of file subscriptions.')
+parser.add_argument('--files-per-block', metavar = 'N', dest = 'files_per_block', type = int, default = 100, help = 'Number of files per block.')
+parser.add_argument('--file-size', metavar = 'MB', dest = 'file_size', type = float, default = 2000., help = 'File size in MB.')
+parser.add_argument('--sources', metavar = 'N', dest = 'num_sources', type = int, default = 2, help = 'Number of source sites holding all blocks.')
+parser.add_argument('--destinations', metavar = 'N', dest = 'num_destinations', type = int, default = 4, help = 'Number of destination sites.')
+parser.add_argument('--mock-config', '-c', metavar = 'PATH', dest = 'mock_config', help = 'JSON file with mock FTS simulation parameters.')
+parser.add_argument('--batch-size', metavar = 'N', dest = 'batch_size', type = int, default = 200, help = 'FTS batch size.')
+parser.add_argument('--batching', metavar = 'MODE', dest = 'batching', default = 'fixed', help = 'FTS batching strategy (fixed or link).')
+parser.add_argument('--source-selection', metavar = 'MODE', dest = 'source_selection', default = 'random', help = 'RLFSM source selection (random or throughput).')
+parser.add_argument('--resident', dest = 'resident', action = 'store_true', help = 'Keep evaluated subscriptions resident in RLFSM.')
+parser.add_argument('--cycle-interval', metavar = 'SECONDS', dest = 'cycle_interval', type = float, default = 0., help = 'Sleep between RLFSM cycles.')
+parser.add_argument('--max-cycles', metavar = 'N', dest = 'max_cycles', type = int, default = 0, help = 'Stop after N cycles (0 = no limit).')
+parser.add_argument('--timeout', metavar = 'SECONDS', dest = 'timeout', type = float, default = 0., help = 'Stop after this wall-clock time (0 = no limit).')
+parser.add_argument('--db', metavar = 'DB', dest = 'db', default = 'dynamo_bench', help = 'Inventory database (wiped).')
+parser.add_argument('--history-db', metavar = 'DB', dest = 'history_db', default = 'dynamohistory_bench', help = 'History database (wiped).')
+parser.add_argument('--scratch-db', metavar = 'DB', dest = 'scratch_db', default = 'dynamo_tmp', help = 'Scratch database for temporary tables.')
+parser.add_argument('--db-host', metavar = 'HOST', dest = 'db_host', default = 'localhost', help = 'MySQL host.')
+parser.add_argument('--db-user', metavar = 'USER', dest = 'db_user', default = 'dynamo', help = 'MySQL user.')
+parser.add_argument('--db-passwd', metavar = 'PASSWD', dest = 'db_passwd', default = '', help = 'MySQL password.')
+parser.add_argument('--schema-dir', metavar = 'PATH', dest = 'schema_dir', default = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'mysql', 'schema'), help = 'Directory with the table definitions.')
+parser.add_argument('--log-level', '-l', metavar = 'LEVEL', dest = 'log_level', default = 'INFO', help = 'Logging level.')
+
+args = parser.parse_args()
+sys.argv = []
+
+logging.basicConfig(level = getattr(logging, args.log_level.upper()))
+LOG = logging.getLogger()
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fts_mock_server import MockFTSServer
+
+from dynamo.dataformat import Configuration, Block
+from dynamo.utils.interface.mysql import MySQL
+from dynamo.core.inventory import ObjectRepository
+from dynamo.core.components.impl.mysqlstore import MySQLInventoryStore
+from dynamo.fileop.rlfsm import RLFSM
+
+MySQL.set_default({
+    'default_user': args.db_user,
+    'scratch_db': args.scratch_db,
+    'params': {args.db_user: {'host': args.db_host, 'passwd': args.db_passwd}}
+})
+
+## Mock FTS
+
+if args.mock_config:
+    with open(args.mock_config) as source:
+        mock_config = json.load(source)
+else:
+    mock_config = None
+
+server = MockFTSServer(('localhost', 0), mock_config)
+server.start()
+
+LOG.info('Mock FTS server running at %s', server.url)
+
+## Databases
+
+def setup_db(db_name, schema_name):
+    mysql = MySQL()
+    mysql.use_db(None)
+    mysql.query('CREATE DATABASE IF NOT EXISTS `%s`' % db_name)
+    mysql.query('CREATE DATABASE IF NOT EXISTS `%s`' % args.scratch_db)
+    mysql.use_db(db_name)
+
+    schema_dir = os.path.join(args.schema_dir, schema_name)
+    for file_name in sorted(os.listdir(schema_dir)):
+        if not file_name.endswith('.sql'):
+            continue
+
+        table = file_name[:-4]
+        if not mysql.table_exists(table):
+            with open(os.path.join(schema_dir, file_name)) as source:
+                mysql.query(source.read())
+
+        mysql.query('TRUNCATE TABLE `%s`' % table)
+
+    return mysql
+
+LOG.info('Setting up databases %s and %s.', args.db, args.history_db)
+
+inventory_db = setup_db(args.db, 'dynamo')
+setup_db(args.history_db, 'dynamohistory')
+
+## Synthetic inventory
+## Every source site has all blocks; every destination has an empty replica of the blocks it subscribes to.
+
+now = time.strftime('%Y-%m-%d %H:%M:%S')
+file_size = int(args.file_size * 1.e+6)
+
+site_names = ['T2_BENCH_SRC%d' % i for i in xrange(args.num_sources)]
+site_names += ['T2_BENCH_DST%d' % i for i in xrange(args.num_destinations)]
+site_ids = dict((name, sid) for sid, name in enumerate(site_names, 1))
+source_ids = [site_ids[name] for name in site_names[:args.num_sources]]
+destination_ids = [site_ids[name] for name in site_names[args.num_sources:]]
+
+inventory_db.insert_many('sites', ('id', 'name', 'host', 'storage_type', 'backend', 'status'), lambda n: (site_ids[n], n, n, 'disk', '', 'ready'), site_names, do_update = False)
+inventory_db.insert_many('filename_mappings', ('site_id', 'protocol', 'chain_id', 'index', 'lfn_pattern', 'pfn_pattern'), lambda n: (site_ids[n], 'gfal2', 0, 0, '/store/(.*)', 'gsiftp://%s/store/{0}' % n), site_names, do_update = False)
+inventory_db.query('INSERT INTO `partitions` (`id`, `name`) VALUES (1, \'Bench\')')
+
+# Spread the subscriptions over the destinations; every destination subscribes to the same files
+num_files = (args.num_subscriptions + args.num_destinations - 1) / args.num_destinations
+num_blocks = (num_files + args.files_per_block - 1) / args.files_per_block
+
+inventory_db.query('INSERT INTO `datasets` (`id`, `name`, `status`, `data_type`, `last_update`, `is_open`) VALUES (1, \'/Bench/RLFSM/RAW\', \'VALID\', \'TEST\', %s, 0)', now)
+
+def blocks():
+    for ib in xrange(num_blocks):
+        nf = min(args.files_per_block, num_files - ib * args.files_per_block)
+        yield (ib + 1, 1, 'block%06d' % ib, nf * file_size, nf, 0, now)
+
+inventory_db.insert_many('blocks', ('id', 'dataset_id', 'name', 'size', 'num_files', 'is_open', 'last_update'), None, blocks(), do_update = False)
+
+def files():
+    for fid in xrange(1, num_files + 1):
+        block_id = (fid - 1) / args.files_per_block + 1
+        yield (fid, block_id, file_size, '/store/bench/RLFSM/RAW/%06d/%09d.root' % (block_id, fid))
+
+inventory_db.insert_many('files', ('id', 'block_id', 'size', 'name'), None, files(), do_update = False)
+
+site_ids_all = source_ids + destination_ids
+inventory_db.insert_many('dataset_replicas', ('dataset_id', 'site_id', 'growing', 'group_id'), lambda sid: (1, sid, 0, 0), site_ids_all, do_update = False)
+
+def block_replicas():
+    for ib in xrange(1, num_blocks + 1):
+        for sid in source_ids:
+            yield (ib, sid, 0, 0, now, 1)
+        for sid in destination_ids:
+            yield (ib, sid, 0, 0, now, 0)
+
+inventory_db.insert_many('block_replicas', ('block_id', 'site_id', 'group_id', 'is_custodial', 'last_update', 'is_complete'), None, block_replicas(), do_update = False)
+
+def block_replica_sizes():
+    for ib in xrange(1, num_blocks + 1):
+        nf = min(args.files_per_block, num_files - (ib - 1) * args.files_per_block)
+        for sid in source_ids:
+            yield (ib, sid, nf, nf * file_size)
+        for sid in destination_ids:
+            yield (ib, sid, 0, 0)
+
+inventory_db.insert_many('block_replica_sizes', ('block_id', 'site_id', 'num_files', 'size'), None, block_replica_sizes(), do_update = False)
+
+def subscriptions():
+    count = 0
+    for sid in destination_ids:
+        for fid in xrange(1, num_files + 1):
+            if count == args.num_subscriptions:
+                return
+            yield (fid, sid, 'new', now, 0)
+            count += 1
+
+num_subscriptions = inventory_db.insert_many('file_subscriptions', ('file_id', 'site_id', 'status', 'created', 'delete'), None, subscriptions(), do_update = False)
+
+LOG.info('Created %d subscriptions of %d files at %d destinations.', num_subscriptions, num_files, args.num_destinations)
+
+## Inventory and RLFSM
+
+store = MySQLInventoryStore(Configuration(db_params = {'db': args.db}))
+inventory = ObjectRepository()
+inventory._store = store
+Block.inventory_store = store
+store.load_data(inventory)
+
+rlfsm_config = Configuration({
+    'db': {'db_params': {'db': args.db}},
+    'history': {'db_params': {'db': args.history_db}},
+    'transfer': [[None, 'fts:FTSFileOperation', {
+        'fts_server': server.url,
+        'db_params': {'db': args.db},
+        'batch_size': args.batch_size,
+        'batching': args.batching
+    }]],
+    'source_selection': args.source_selection,
+    'resident_subscriptions': args.resident
+})
+
+rlfsm = RLFSM(rlfsm_config)
+
+## Run
+
+def count_statuses():
+    return dict(inventory_db.query('SELECT `status`, COUNT(*) FROM `file_subscriptions` GROUP BY `status`'))
+
+cycle_times = []
+start_time = time.time()
+
+while True:
+    cycle_start = time.time()
+    rlfsm.transfer_files(inventory)
+    cycle_times.append(time.time() - cycle_start)
+
+    counts = count_statuses()
+    LOG.info('Cycle %d (%.1f s): %s', len(cycle_times), cycle_times[-1], ', '.join('%s=%d' % item for item in sorted(counts.iteritems())))
+
+    if sum(counts.get(st, 0) for st in ('new', 'inbatch', 'retry')) == 0:
+        break
+
+    if args.max_cycles > 0 and len(cycle_times) >= args.max_cycles:
+        LOG.info('Reached the maximum number of cycles.')
+        break
+
+    if args.timeout > 0 and time.time() - start_time > args.timeout:
+        LOG.info('Timed out.')
+        break
+
+    if args.cycle_interval > 0:
+        time.sleep(args.cycle_interval)
+
+elapsed = time.time() - start_time
+
+server.shutdown()
+
+## Report
+
+counts = count_statuses()
+num_done = counts.get('done', 0)
+
+cycle_times.sort()
+ncycles = len(cycle_times)
+
+print 'Subscriptions:       %d' % num_subscriptions
+print 'Final states:        %s' % ', '.join('%s=%d' % item for item in sorted(counts.iteritems()))
+print 'Elapsed:             %.1f s' % elapsed
+print 'Completed per s:     %.2f' % (num_done / elapsed)
+print 'Completed MB/s:      %.1f' % (num_done * args.file_size / elapsed)
+print 'Cycles:              %d' % ncycles
+print 'Cycle time mean:     %.2f s' % (sum(cycle_times) / ncycles)
+print 'Cycle time median:   %.2f s' % cycle_times[ncycles / 2]
+print 'Cycle time max:      %.2f s' % cycle_times[-1]